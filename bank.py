@@ -1,10 +1,10 @@
-from dataclasses import dataclass, asdict
-from typing import List
+from dataclasses import dataclass, asdict, fields
+from typing import List, Optional, Union
 from abc import abstractmethod
 
 import pandas as pd
 
-from ledger import PandasLedger, Ledger
+from ledger import PandasLedger, Ledger, SQLiteLedger, empty_frame
 
 
 @dataclass
@@ -27,10 +27,19 @@ class BankTransaction(RawBankTransaction):
     gl_jnl: bool
 
 
+def raw_transactions_frame(transactions: Union[List[RawBankTransaction], pd.DataFrame]) -> pd.DataFrame:
+    """Frame of transactions, given either as RawBankTransactions or as a frame with a column per field."""
+    if isinstance(transactions, pd.DataFrame):
+        return transactions[[x.name for x in fields(RawBankTransaction)]].copy()
+    return pd.DataFrame([asdict(x) for x in transactions])
+
+
 class BankLedgerTransactions(Ledger):
     @abstractmethod
-    def add_transactions(self, transactions: List[RawBankTransaction]):
-        """"""
+    def add_transactions(
+        self, transactions: Union[List[RawBankTransaction], pd.DataFrame], batch_id: Optional[int] = None
+    ):
+        """Add transactions as a new batch, or to batch_id so chunks of one load share a batch."""
 
     @abstractmethod
     def list_transactions(self) -> List[BankTransaction]:
@@ -44,27 +53,48 @@ class BankLedger:
 
 
 class InMemoryBankLedgerTransactions(BankLedgerTransactions, PandasLedger):
+    schema = {
+        "transaction_id": "int64",
+        "batch_id": "int64",
+        "raw_id": "int64",
+        "transfer_type": "category",
+        "date": "datetime64[ns]",
+        "bank_code": "category",
+        "transaction_type": "category",
+        "amount": "int64",
+        "description": "object",
+        "gl_jnl": "bool",
+        "matched_account": "category",
+        "matched_type": "category",
+    }
+
     def __init__(self) -> None:
-        self.columns = [
-            "transaction_id",
-            "batch_id",
-            "raw_id",
-            "transfer_type",
-            "date",
-            "bank_code",
-            "transaction_type",
-            "amount",
-            "description",
-            "gl_jnl",
-            "matched_account",
-            "matched_type",
-        ]
-        self.df = pd.DataFrame(columns=self.columns)
+        self.columns = list(self.schema)
+        self.df = empty_frame(self.schema)
         return
 
-    def add_transactions(self, transactions: List[RawBankTransaction]):
-        df = pd.DataFrame([asdict(x) for x in transactions])
-        df["batch_id"] = self.get_next_batch_id()
+    def add_transactions(
+        self, transactions: Union[List[RawBankTransaction], pd.DataFrame], batch_id: Optional[int] = None
+    ):
+        df = raw_transactions_frame(transactions)
+        df["batch_id"] = self.get_next_batch_id() if batch_id is None else batch_id
+        df["gl_jnl"] = False
+        self.append(df)
+        return
+
+    def list_transactions(self) -> List[BankTransaction]:
+        return [BankTransaction(**x) for x in self.df.to_dict("records")]
+
+
+class SQLiteBankLedgerTransactions(SQLiteLedger, BankLedgerTransactions):
+    table = "bank_ledger"
+    schema = InMemoryBankLedgerTransactions.schema
+
+    def add_transactions(
+        self, transactions: Union[List[RawBankTransaction], pd.DataFrame], batch_id: Optional[int] = None
+    ):
+        df = raw_transactions_frame(transactions)
+        df["batch_id"] = self.get_next_batch_id() if batch_id is None else batch_id
         df["gl_jnl"] = False
         self.append(df)
         return
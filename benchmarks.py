@@ -0,0 +1,279 @@
+"""Timings of run time critical paths on synthetic cashbooks. Run with python benchmarks.py"""
+from unittest import mock
+import contextlib
+import datetime
+import io
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import openpyxl
+import pandas as pd
+
+from loaders import ExcelSourceDataLoader
+from bank import InMemoryBankLedgerTransactions
+import main
+from recovery import RecoveryManager
+
+
+class SimulatedCrash(Exception):
+    pass
+
+
+def write_synthetic_cashbook(filename: str, bank_rows: int = 2000, seed: int = 0) -> None:
+    """Write a cashbook with every sheet entity_loop reads, for a year of random activity."""
+    rnd = random.Random(seed)
+    bank = []
+    for i in range(bank_rows):
+        row = {
+            "date": datetime.datetime(2021, rnd.randint(1, 12), rnd.randint(1, 28)),
+            "transaction_type": "dd",
+            "description": f"transaction {i}",
+            "amount": round(rnd.uniform(1, 500), 2),
+            "transfer_type": "out",
+            "bank_code": rnd.choice(["bank_current", "bank_savings"]),
+            "creditor": None,
+            "debtor": None,
+            "bs": None,
+            "pl": None,
+            "notes": f"notes {i}",
+        }
+        kind = rnd.choice(["settled_purchase", "payment", "receipt", "settled_sale", "bs"])
+        if kind == "settled_purchase":
+            row.update(creditor=rnd.choice(["acme", "bolt"]), pl=rnd.choice(["rent", "travel"]), amount=-row["amount"])
+        elif kind == "payment":
+            row.update(creditor=rnd.choice(["acme", "bolt"]), amount=-row["amount"])
+        elif kind == "receipt":
+            row.update(debtor=rnd.choice(["dan", "eve"]))
+        elif kind == "settled_sale":
+            # Settled sales are added to the Sales Ledger once per bank code, so keep to one bank
+            row.update(debtor=rnd.choice(["dan", "eve"]), pl="sales", bank_code="bank_current")
+        else:
+            row.update(bs="loan")
+        bank.append(row)
+
+    coa = pd.DataFrame(
+        [
+            {
+                "nominal": nominal,
+                "statement": statement,
+                "heading": "heading",
+                "expected_sign": "dr",
+                "control_account": control_account,
+                "bank_account": bank_account,
+            }
+            for nominal, statement, control_account, bank_account in [
+                ("bank_current", "bs", "n", "y"),
+                ("bank_savings", "bs", "n", "y"),
+                ("purchase_ledger_control_account", "bs", "y", "n"),
+                ("sales_ledger_control_account", "bs", "y", "n"),
+                ("bank_contra", "bs", "n", "n"),
+                ("prepayments", "bs", "n", "n"),
+                ("rent", "pl", "n", "n"),
+                ("sales", "pl", "n", "n"),
+            ]
+        ]
+    )
+
+    si_headers, si_lines, jnl_headers, jnl_lines = [], [], [], []
+    for header_id in range(max(bank_rows // 20, 1)):
+        date = datetime.datetime(2021, rnd.randint(1, 12), rnd.randint(1, 28))
+        si_headers.append({"id": header_id, "date": date, "debtor": rnd.choice(["dan", "eve"])})
+        for line in range(rnd.randint(1, 3)):
+            si_lines.append(
+                {
+                    "header_id": header_id,
+                    "nominal": "sales",
+                    "description": f"invoice {header_id}.{line}",
+                    "amount": round(rnd.uniform(1, 100), 2),
+                    "transaction_date": date,
+                }
+            )
+        # Reversing journals post their reversal to the next period, so keep them out of the final period
+        date = datetime.datetime(2021, rnd.randint(1, 11), rnd.randint(1, 28))
+        jnl_headers.append({"id": header_id, "transaction_date": date, "jnl_type": rnd.choice(["gnl", "gnl_rev"])})
+        amount = round(rnd.uniform(1, 100), 2)
+        jnl_lines.append({"header_id": header_id, "nominal": "rent", "description": "accrual", "amount": amount})
+        jnl_lines.append(
+            {"header_id": header_id, "nominal": "prepayments", "description": "accrual", "amount": -amount}
+        )
+
+    with pd.ExcelWriter(filename) as writer:
+        pd.DataFrame(bank).sort_values("date").to_excel(writer, sheet_name="bank", index=False)
+        coa.to_excel(writer, sheet_name="coa", index=False)
+        pd.DataFrame(si_headers).to_excel(writer, sheet_name="sales_invoice_headers", index=False)
+        pd.DataFrame(si_lines).to_excel(writer, sheet_name="sales_invoice_lines", index=False)
+        pd.DataFrame(jnl_headers).to_excel(writer, sheet_name="gl_journal_headers", index=False)
+        pd.DataFrame(jnl_lines).to_excel(writer, sheet_name="gl_journal_lines", index=False)
+    return
+
+
+def timed(function, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def benchmark_recovery(bank_rows: int = 2000, crash_period: int = 11, checkpoint_every: int = 1) -> dict:
+    """Time a full rerun against resuming from the log and checkpoints after a crash in crash_period."""
+    commit_period = RecoveryManager.commit_period
+
+    def crashing_commit_period(self, period, **kwargs):
+        if period == crash_period:
+            raise SimulatedCrash
+        return commit_period(self, period, **kwargs)
+
+    with tempfile.TemporaryDirectory() as path:
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            os.makedirs("data")
+            write_synthetic_cashbook("cashbook_benchmark.xlsx", bank_rows=bank_rows)
+            full_rerun = timed(main.entity_loop, "cashbook_benchmark.xlsx", "benchmark")
+
+            with mock.patch.object(RecoveryManager, "commit_period", crashing_commit_period):
+                try:
+                    timed(main.entity_loop, "cashbook_benchmark.xlsx", "benchmark", state_path="state",
+                          checkpoint_every=checkpoint_every)
+                except SimulatedCrash:
+                    pass
+
+            manager = RecoveryManager(os.path.join("state", "benchmark"), checkpoint_every=checkpoint_every)
+            log_bytes = os.path.getsize(manager.log.filename)
+            manager.log.close()
+            resume = timed(
+                main.entity_loop,
+                "cashbook_benchmark.xlsx",
+                "benchmark",
+                state_path="state",
+                checkpoint_every=checkpoint_every,
+            )
+        finally:
+            os.chdir(cwd)
+
+    return {
+        "bank_rows": bank_rows,
+        "crash_period": crash_period,
+        "checkpoint_every": checkpoint_every,
+        "log_bytes": log_bytes,
+        "full_rerun_seconds": round(full_rerun, 3),
+        "resume_seconds": round(resume, 3),
+    }
+
+
+def benchmark_changed_period_rerun(bank_rows: int = 2000, changed_month: int = 10) -> dict:
+    """Time a full rerun against rerunning with kept state after editing a bank row of changed_month."""
+    with tempfile.TemporaryDirectory() as path:
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            write_synthetic_cashbook("cashbook_benchmark.xlsx", bank_rows=bank_rows)
+            timed(main.entity_loop, "cashbook_benchmark.xlsx", "benchmark", state_path="state")
+
+            workbook = openpyxl.load_workbook("cashbook_benchmark.xlsx")
+            row = next(x for x in workbook["bank"].iter_rows(min_row=2) if x[0].value.month == changed_month)
+            row[3].value = row[3].value + 1
+            workbook.save("cashbook_benchmark.xlsx")
+
+            full_rerun = timed(main.entity_loop, "cashbook_benchmark.xlsx", "benchmark")
+            changed_rerun = timed(main.entity_loop, "cashbook_benchmark.xlsx", "benchmark", state_path="state")
+        finally:
+            os.chdir(cwd)
+
+    return {
+        "bank_rows": bank_rows,
+        "changed_month": changed_month,
+        "full_rerun_seconds": round(full_rerun, 3),
+        "changed_rerun_seconds": round(changed_rerun, 3),
+    }
+
+
+def benchmark_sheet_parsing(bank_rows: int = 20000, processes: int = 4) -> dict:
+    """Time loading every sheet of a workbook in one streaming pass against parsing sheets in a process pool."""
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, "cashbook_benchmark.xlsx")
+        write_synthetic_cashbook(filename, bank_rows=bank_rows)
+        loaders = {}
+        for name, loader_processes in [("streaming", 1), ("processes", processes)]:
+            loaders[name] = ExcelSourceDataLoader(
+                filename=filename,
+                bank_sheet="bank",
+                coa_sheet="coa",
+                si_headers_sheet="sales_invoice_headers",
+                si_lines_sheet="sales_invoice_lines",
+                gl_jnl_headers_sheet="gl_journal_headers",
+                gl_jnl_lines_sheet="gl_journal_lines",
+                processes=loader_processes,
+            )
+        streaming = timed(loaders["streaming"].load)
+        in_processes = timed(loaders["processes"].load)
+
+    return {
+        "bank_rows": bank_rows,
+        "processes": processes,
+        "cpus": os.cpu_count(),
+        "streaming_seconds": round(streaming, 3),
+        "processes_seconds": round(in_processes, 3),
+    }
+
+
+def traced_peak(function, *args, **kwargs) -> int:
+    """Peak bytes allocated while running function, including numpy buffers."""
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def benchmark_bank_ingestion(bank_rows: int = 20000, chunk_rows: int = 2000) -> dict:
+    """Peak memory of adding a whole bank sheet to a ledger at once against ingesting it in chunks."""
+
+    def make_loader(filename):
+        return ExcelSourceDataLoader(
+            filename=filename,
+            bank_sheet="bank",
+            coa_sheet="coa",
+            si_headers_sheet="sales_invoice_headers",
+            si_lines_sheet="sales_invoice_lines",
+            gl_jnl_headers_sheet="gl_journal_headers",
+            gl_jnl_lines_sheet="gl_journal_lines",
+        )
+
+    def whole(filename):
+        loader = make_loader(filename)
+        loader.load(["bank"])
+        parser = main.SourceDataParser()
+        parser.bank = loader.bank
+        InMemoryBankLedgerTransactions().add_transactions(parser.get_bank_transactions())
+        return
+
+    def chunked(filename):
+        main.ingest_bank_sheet(make_loader(filename), InMemoryBankLedgerTransactions(), chunk_rows=chunk_rows)
+        return
+
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, "cashbook_benchmark.xlsx")
+        write_synthetic_cashbook(filename, bank_rows=bank_rows)
+        whole_peak = traced_peak(whole, filename)
+        chunked_peak = traced_peak(chunked, filename)
+
+    return {
+        "bank_rows": bank_rows,
+        "chunk_rows": chunk_rows,
+        "whole_peak_bytes": whole_peak,
+        "chunked_peak_bytes": chunked_peak,
+    }
+
+
+if __name__ == "__main__":
+    print(benchmark_recovery())
+    print(benchmark_changed_period_rerun())
+    print(benchmark_sheet_parsing())
+    print(benchmark_bank_ingestion())
@@ -0,0 +1,119 @@
+from typing import Dict, Iterable, Optional
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow
+
+from ledger import save_frame_snapshot, load_frame_snapshot
+
+
+def file_fingerprint(filename: str) -> str:
+    """Hash of the file's content and modification time. For a folder, of the name, content and time of each file."""
+    if os.path.isdir(filename):
+        filenames = [os.path.join(filename, x) for x in sorted(os.listdir(filename))]
+    else:
+        filenames = [filename]
+    digest = hashlib.sha256()
+    for name in filenames:
+        if name != filename:
+            digest.update(os.path.basename(name).encode())
+        with open(name, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(str(os.stat(name).st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def frames_fingerprint(frames: Iterable[pd.DataFrame]) -> str:
+    """Hash of the column names and values of each frame, ignoring the index."""
+    digest = hashlib.sha256()
+    for df in frames:
+        digest.update(json.dumps([str(x) for x in df.columns]).encode())
+        digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def restore_missing_values(df: pd.DataFrame) -> pd.DataFrame:
+    """Replace None in object columns of a frame read from Arrow with NaN, as pd.read_excel gives."""
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].where(df[column].notnull(), np.nan)
+    return df
+
+
+class SourceDataCache:
+    """Post-processed source frames stored as Arrow IPC files, keyed by fingerprint of the source file.
+
+    Each entry is a folder of one file per dataset, plus meta.json recording the sheet each was read from.
+    Once the cache is larger than max_bytes, least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1 << 30) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        return
+
+    def _entry_path(self, filename: str) -> str:
+        return os.path.join(self.path, file_fingerprint(filename))
+
+    def get(self, filename: str, sheets: Dict[str, str]) -> Optional[Dict[str, pd.DataFrame]]:
+        """Cached frames of filename for each dataset in sheets, a mapping of dataset to sheet name.
+
+        Returns None unless every dataset is cached as read from the same sheet.
+        """
+        entry_path = self._entry_path(filename)
+        meta_filename = os.path.join(entry_path, "meta.json")
+        if os.path.exists(meta_filename) is False:
+            return None
+        with open(meta_filename, "r") as f:
+            meta = json.load(f)
+        if any(meta["sheets"].get(name) != sheet for name, sheet in sheets.items()):
+            return None
+        frames = {}
+        for name in sheets:
+            frames[name] = restore_missing_values(load_frame_snapshot(os.path.join(entry_path, f"{name}.arrow")))
+        # meta.json is touched on every read, so its modification time orders entries for eviction
+        os.utime(meta_filename)
+        return frames
+
+    def put(self, filename: str, sheets: Dict[str, str], frames: Dict[str, pd.DataFrame]) -> bool:
+        """Cache frames read from filename, replacing any existing entry. Returns False if they can't be stored."""
+        entry_path = self._entry_path(filename)
+        tmp_path = entry_path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        try:
+            for name, df in frames.items():
+                save_frame_snapshot(df, os.path.join(tmp_path, f"{name}.arrow"))
+        except (pyarrow.ArrowException, ValueError, TypeError):
+            # e.g. an object column mixing numbers and text
+            shutil.rmtree(tmp_path)
+            return False
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"filename": os.path.abspath(filename), "sheets": sheets}, f)
+        shutil.rmtree(entry_path, ignore_errors=True)
+        os.replace(tmp_path, entry_path)
+        self.evict()
+        return True
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for entry in os.listdir(self.path):
+            entry_path = os.path.join(self.path, entry)
+            meta_filename = os.path.join(entry_path, "meta.json")
+            if entry.endswith(".tmp") or os.path.exists(meta_filename) is False:
+                continue
+            size = sum(x.stat().st_size for x in os.scandir(entry_path))
+            entries.append((os.stat(meta_filename).st_mtime, size, entry_path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_path)
+            total -= size
+        return
@@ -1,6 +1,10 @@
-from typing import List, Dict
-from dataclasses import dataclass
+from typing import Callable, Iterable, List, Dict, Optional, Set, Tuple
+from dataclasses import dataclass, asdict
 from abc import ABC, abstractmethod
+import json
+import os
+
+import pandas as pd
 
 
 @dataclass
@@ -27,28 +31,46 @@ class LedgerTransaction:
 # TODO put into ledgers
 class TransactionsLedger(ABC):
     @abstractmethod
-    def list_transactions(self) -> List[LedgerTransaction]:
-        """"""
+    def transactions_since(self, transaction_id: int) -> pd.DataFrame:
+        """Rows from transaction_id onwards."""
 
 
 class InMemoryTransactionLedger(TransactionsLedger):
     def __init__(self) -> None:
-        self.transactions = []
+        self.df = pd.DataFrame({"transaction_id": pd.Series(dtype="int64")})
         return
 
-    def list_transactions(self) -> List[LedgerTransaction]:
-        return self.transactions
+    def transactions_since(self, transaction_id: int) -> pd.DataFrame:
+        return self.df.loc[self.df["transaction_id"] >= transaction_id].reset_index(drop=True)
+
+
+class DispersalTarget(ABC):
+    @abstractmethod
+    def add_journal_lines(self, df: pd.DataFrame) -> List[int]:
+        """Post a frame of journal lines, returning the transaction ids created."""
 
 
 class DispersalsLogger:
-    def __init__(self) -> None:
+    """Tracks which transactions of each registered ledger have been dispersed to each target.
+
+    For every (source, target) all ids below a watermark have been dispersed, plus any ids in a set of ids
+    dispersed out of order at or above the watermark. So finding undispersed transactions only reads rows
+    from the watermark onwards.
+
+    If logs_filename is given each log is appended to it as a line of JSON when recorded, so snapshots only
+    hold its length rather than every log. Otherwise logs are kept in memory only, and not in snapshots.
+    """
+
+    def __init__(self, logs_filename: Optional[str] = None) -> None:
         self._ledgers: Dict[str, TransactionsLedger] = {}
-        self._dispersed_ids: Dict[str, List[int]] = {}
+        self._watermarks: Dict[Tuple[str, str], int] = {}
+        self._dispersed_ids: Dict[Tuple[str, str], Set[int]] = {}
+        self.logs_filename = logs_filename
+        self.logs: List[DispersalLog] = []
         return
 
     def register_ledger(self, name: str, ledger_transactions: TransactionsLedger) -> None:
         self._ledgers[name] = ledger_transactions
-        self._dispersed_ids[name] = []
         return
 
     @property
@@ -56,14 +78,161 @@ class DispersalsLogger:
         return sorted(list(self._ledgers.keys()))
 
     # TODO this method doesn't belong in this class
-    # TODO needs to specify target
-    def undispersed_transactions(self, name: str) -> List[LedgerTransaction]:
-        # TODO remove items already dispersed
-        dispersed_ids = self._dispersed_ids[name]
-        return [x for x in self._ledgers[name].list_transactions() if x.transaction_id not in dispersed_ids]
-
-    # TODO needs to specify target
-    def log_dispersal(self, name: str, transactions: List[LedgerTransaction]) -> None:
-        # TODO can't add duplicates
-        self._dispersed_ids[name].extend([x.transaction_id for x in transactions])
+    def undispersed_transactions(self, name: str, target: str) -> pd.DataFrame:
+        key = (name, target)
+        df = self._ledgers[name].transactions_since(self._watermarks.get(key, 0))
+        dispersed_ids = self._dispersed_ids.get(key)
+        if dispersed_ids:
+            df = df.loc[~df["transaction_id"].isin(list(dispersed_ids))].reset_index(drop=True)
+        return df
+
+    def log_dispersal(self, name: str, target: str, transaction_ids: Iterable[int]) -> None:
+        key = (name, target)
+        watermark = self._watermarks.get(key, 0)
+        dispersed_ids = self._dispersed_ids.setdefault(key, set())
+        dispersed_ids.update(int(x) for x in transaction_ids if x >= watermark)
+        while watermark in dispersed_ids:
+            dispersed_ids.remove(watermark)
+            watermark += 1
+        self._watermarks[key] = watermark
+        return
+
+    def record(self, log: DispersalLog) -> None:
+        """Keep log and mark its source transactions dispersed to its target."""
+        self.log_dispersal(log.source, log.target, log.source_ids)
+        self.logs.append(log)
+        if self.logs_filename is not None:
+            with open(self.logs_filename, "a") as f:
+                f.write(json.dumps(asdict(log)) + "\n")
+        return
+
+    def save_snapshot(self, filename: str) -> None:
+        state = {
+            "progress": [
+                {
+                    "source": source,
+                    "target": target,
+                    "watermark": watermark,
+                    "dispersed_ids": sorted(self._dispersed_ids.get((source, target), set())),
+                }
+                for (source, target), watermark in self._watermarks.items()
+            ],
+            "logs_bytes": None if self.logs_filename is None else self._logs_bytes(),
+        }
+        with open(filename, "w") as f:
+            json.dump(state, f)
+        return
+
+    def load_snapshot(self, filename: str) -> None:
+        """Replace dispersal state with that in the snapshot in filename. Ledgers must already be registered."""
+        with open(filename, "r") as f:
+            state = json.load(f)
+        self._watermarks, self._dispersed_ids = {}, {}
+        for progress in state["progress"]:
+            key = (progress["source"], progress["target"])
+            self._watermarks[key] = progress["watermark"]
+            self._dispersed_ids[key] = set(progress["dispersed_ids"])
+        self.logs = []
+        if self.logs_filename is not None:
+            # Logs recorded after the snapshot are discarded, as they will be recorded again
+            with open(self.logs_filename, "a") as f:
+                f.truncate(state["logs_bytes"] or 0)
+            with open(self.logs_filename, "r") as f:
+                self.logs = [DispersalLog(**json.loads(line)) for line in f]
+        return
+
+    def _logs_bytes(self) -> int:
+        if os.path.exists(self.logs_filename) is False:
+            return 0
+        return os.path.getsize(self.logs_filename)
+
+
+# Function of a source ledger's undispersed transactions returning journal lines laid out as by
+# general.journals_to_frame, plus a "source_id" column holding the transaction id each line came from, if any
+DispersalAdapter = Callable[[pd.DataFrame], pd.DataFrame]
+# Called with the source transaction ids posted to the target, e.g. to flag them in the source ledger
+PostedCallback = Callable[[List[int]], None]
+
+
+def aggregate_lines(df: pd.DataFrame) -> pd.DataFrame:
+    """Collapse lines to one per journal, nominal and date, keeping the order lines first appear in.
+
+    Lines missing a nominal or date are kept as lines of their own, for the target to reject, rather than dropped.
+    """
+    columns = ["journal", "nominal", "transaction_date"]
+    # Categorical keys are grouped by code, as pandas drops a missing category's group even with dropna=False
+    keys = [df[x].cat.codes if isinstance(df[x].dtype, pd.CategoricalDtype) else df[x] for x in columns]
+    df = df.groupby(keys, sort=False, dropna=False).agg(
+        **{x: (x, "first") for x in columns},
+        jnl_type=("jnl_type", "first"),
+        description=("description", "first"),
+        amount=("amount", "sum"),
+    )
+    return df.reset_index(drop=True)
+
+
+class DispersalEngine:
+    """Runs registered dispersals in order.
+
+    Each posts the undispersed transactions of its source ledger to its target, as set by its DispersalConfig.
+    """
+
+    def __init__(self, logger: DispersalsLogger) -> None:
+        self.logger = logger
+        self._targets: Dict[str, DispersalTarget] = {}
+        self._dispersals: List[Tuple[DispersalConfig, DispersalAdapter, Optional[PostedCallback]]] = []
+        return
+
+    def register_target(self, name: str, target: DispersalTarget) -> None:
+        self._targets[name] = target
         return
+
+    def register(
+        self,
+        config: DispersalConfig,
+        adapter: DispersalAdapter,
+        on_posted: Optional[PostedCallback] = None,
+    ) -> None:
+        self._dispersals.append((config, adapter, on_posted))
+        return
+
+    def run(self) -> List[DispersalLog]:
+        logs = []
+        for config, adapter, on_posted in self._dispersals:
+            log = self.disperse(config, adapter, on_posted)
+            if log is not None:
+                logs.append(log)
+        return logs
+
+    def disperse(
+        self,
+        config: DispersalConfig,
+        adapter: DispersalAdapter,
+        on_posted: Optional[PostedCallback] = None,
+    ) -> Optional[DispersalLog]:
+        df = self.logger.undispersed_transactions(config.source, config.target)
+        if df.shape[0] == 0:
+            return None
+        lines = adapter(df)
+        target_ids = []
+        if lines.shape[0] > 0:
+            posted_ids = [int(x) for x in lines["source_id"].dropna().unique()]
+            lines = lines.drop(columns="source_id")
+            if config.is_reversed:
+                lines["amount"] = -lines["amount"]
+            if config.is_aggregated:
+                lines = aggregate_lines(lines)
+            lines = lines.sort_values("journal", kind="stable", ignore_index=True)
+            target_ids = self._targets[config.target].add_journal_lines(lines)
+            if on_posted is not None:
+                on_posted(posted_ids)
+        log = DispersalLog(
+            source=config.source,
+            target=config.target,
+            is_aggregated=config.is_aggregated,
+            is_reversed=config.is_reversed,
+            source_ids=[int(x) for x in df["transaction_id"]],
+            target_ids=[int(x) for x in target_ids],
+        )
+        self.logger.record(log)
+        return log
@@ -0,0 +1,115 @@
+from dataclasses import dataclass
+from typing import Iterator, List, Sequence, Tuple
+import datetime
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class Period:
+    period: int
+    date_start: datetime.datetime
+    date_end: datetime.datetime
+
+
+class FiscalCalendar:
+    """Consecutive accounting periods numbered from 1, each from date_start to date_end inclusive.
+
+    A calendar may span any number of fiscal years. Dates are mapped to periods a whole column at a time,
+    by a sorted search of the period start dates.
+    """
+
+    def __init__(self, periods: List[Period]) -> None:
+        if not periods:
+            raise ValueError("A calendar needs at least one period")
+        for number, period in enumerate(periods, start=1):
+            if period.period != number:
+                raise ValueError(f"Period {period.period} found where period {number} expected")
+            if period.date_end < period.date_start:
+                raise ValueError(f"Period {number} ends before it starts")
+        for period, following in zip(periods, periods[1:]):
+            if following.date_start != period.date_end + datetime.timedelta(days=1):
+                raise ValueError(f"Period {following.period} does not start the day after period {period.period}")
+        self._periods = list(periods)
+        self._starts = pd.DatetimeIndex([x.date_start for x in periods]).to_numpy()
+        self._end = np.datetime64(periods[-1].date_end + datetime.timedelta(days=1), "ns")
+        return
+
+    @classmethod
+    def from_starts(cls, starts: Sequence[datetime.datetime]) -> "FiscalCalendar":
+        """Periods each running from one start to the day before the next, the final start only ending the last."""
+        starts = [pd.Timestamp(x).to_pydatetime() for x in starts]
+        return cls(
+            [
+                Period(period=i, date_start=start, date_end=end - datetime.timedelta(days=1))
+                for i, (start, end) in enumerate(zip(starts, starts[1:]), start=1)
+            ]
+        )
+
+    @classmethod
+    def monthly(cls, year: int, first_month: int = 1, years: int = 1) -> "FiscalCalendar":
+        """Calendar months of years fiscal years, the first starting on the first of first_month in year."""
+        starts = pd.date_range(datetime.datetime(year, first_month, 1), periods=12 * years + 1, freq="MS")
+        return cls.from_starts(starts)
+
+    @classmethod
+    def weeks_445(
+        cls, first_day: datetime.datetime, years: int = 1, pattern: Tuple[int, int, int] = (4, 4, 5)
+    ) -> "FiscalCalendar":
+        """Periods of whole weeks, each quarter split into periods of pattern weeks, from first_day.
+
+        Every fiscal year is four quarters; a 53 week year can be built with from_starts.
+        """
+        starts = [first_day]
+        for weeks in list(pattern) * 4 * years:
+            starts.append(starts[-1] + datetime.timedelta(weeks=weeks))
+        return cls.from_starts(starts)
+
+    def __len__(self) -> int:
+        return len(self._periods)
+
+    def __iter__(self) -> Iterator[Period]:
+        return iter(self._periods)
+
+    def __getitem__(self, period: int) -> Period:
+        if not 1 <= period <= len(self._periods):
+            raise KeyError(period)
+        return self._periods[period - 1]
+
+    def period_of(self, dates: pd.Series) -> pd.Series:
+        """Period of each date, -1 for missing dates and those outside the calendar."""
+        dates = pd.Series(dates)
+        if not pd.api.types.is_datetime64_dtype(dates):
+            dates = pd.to_datetime(dates, errors="coerce")
+        values = dates.to_numpy(dtype="datetime64[ns]")
+        # Index of the first start after each date is the number of the period holding it
+        positions = np.searchsorted(self._starts, values, side="right")
+        inside = (positions > 0) & (values < self._end)
+        return pd.Series(np.where(inside, positions, -1).astype("int64"), index=dates.index)
+
+    def require_periods(self, dates: pd.Series, description: str = "dates") -> pd.Series:
+        """Period of each date as by period_of, raising ValueError naming any missing or outside the calendar.
+
+        description names what the dates are of in the error, e.g. "bank rows".
+        """
+        periods = self.period_of(dates)
+        outside = (periods == -1).to_numpy()
+        if outside.any():
+            values = pd.Series(dates)[outside]
+            shown = ", ".join(str(x) for x in values.head(10))
+            more = f" and {outside.sum() - 10} more" if outside.sum() > 10 else ""
+            raise ValueError(
+                f"{outside.sum()} {description} missing a date or dated outside the calendar "
+                f"{self._periods[0].date_start:%Y-%m-%d} to {self._periods[-1].date_end:%Y-%m-%d}: {shown}{more}"
+            )
+        return periods
+
+    def next_period(self, period: int) -> Period:
+        if period == len(self._periods):
+            raise ValueError(f"Period {period} is the last period of the calendar, so has no next period")
+        return self[period + 1]
+
+
+# Calendar of the cashbooks, used where no other calendar is given
+DEFAULT_CALENDAR = FiscalCalendar.monthly(2021)
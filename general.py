@@ -1,25 +1,31 @@
-from dataclasses import dataclass, asdict
-from typing import List, Dict
+from dataclasses import dataclass, asdict, fields
+from typing import List, Dict, Optional, Tuple
 from abc import ABC, abstractmethod
 from copy import copy
 import datetime
 
+import numpy as np
 import pandas as pd
 
-from ledger import PandasLedger
-from utils import convert_date_string_to_period
+from dispersals import DispersalTarget
+from fiscal import DEFAULT_CALENDAR, FiscalCalendar, Period  # noqa: F401 Period re-exported
+from ledger import (
+    Ledger,
+    PandasLedger,
+    SQLiteLedger,
+    concat_frames,
+    empty_frame,
+    save_frame_snapshot,
+    load_frame_snapshot,
+)
 
 
 class JournalBalanceError(Exception):
     pass
 
 
-# TODO add previous and next period and NullPeriod
-@dataclass
-class Period:
-    period: int
-    date_start: datetime.datetime
-    date_end: datetime.datetime
+class BalanceIndexError(Exception):
+    pass
 
 
 @dataclass
@@ -61,11 +67,11 @@ def create_opposite_journal(journal: GLJournal) -> GLJournal:
     return new_journal
 
 
-def create_prepayment_journal(new_prepayment: NewPrepayment, periods: Dict[int, Period]) -> List[GLJournal]:
+def create_prepayment_journal(new_prepayment: NewPrepayment, calendar: FiscalCalendar) -> List[GLJournal]:
     jnls = []
 
     period = new_prepayment.period_start
-    date = periods[period].date_start
+    date = calendar[period].date_start
 
     release_amount = int(new_prepayment.amount / new_prepayment.periods)
     balancing_amount = new_prepayment.amount - release_amount * new_prepayment.periods
@@ -83,8 +89,8 @@ def create_prepayment_journal(new_prepayment: NewPrepayment, periods: Dict[int,
     jnls.append(jnl)
 
     for i in range(new_prepayment.periods):
-        period += 1
-        date = periods[period].date_start
+        period = calendar.next_period(period).period
+        date = calendar[period].date_start
         if i != 0:
             amount = release_amount
         else:
@@ -105,6 +111,23 @@ def create_prepayment_journal(new_prepayment: NewPrepayment, periods: Dict[int,
     return jnls
 
 
+def journals_to_frame(journals: List[GLJournal]) -> pd.DataFrame:
+    """Flatten journals to one row per line, "journal" holding the position of the line's journal."""
+    for journal in journals:
+        # TODO This is a dev only assert
+        assert isinstance(journal.transaction_date, datetime.datetime)
+    df = pd.DataFrame(
+        [
+            (i, journal.jnl_type, journal.transaction_date, line.nominal, line.description, line.amount)
+            for i, journal in enumerate(journals)
+            for line in journal.lines
+        ],
+        columns=["journal", "jnl_type", "transaction_date", "nominal", "description", "amount"],
+    )
+    df["transaction_date"] = pd.to_datetime(df["transaction_date"])
+    return df
+
+
 @dataclass
 class GeneralLedgerTransaction:
     transaction_id: int
@@ -117,55 +140,228 @@ class GeneralLedgerTransaction:
     period: int
 
 
-class GeneralLedgerTransactions(PandasLedger):
-    def __init__(self) -> None:
-        self.columns = [
-            "transaction_id",
-            "jnl_id",
-            "jnl_type",
-            "transaction_date",
-            "period",
-            "nominal",
-            "amount",
-            "description",
-        ]
-        self.df = pd.DataFrame(columns=self.columns)
-        return
+class GeneralLedgerTransactionsMixin(Ledger):
+    """Schema and journal posting of the general ledger, shared by its pandas and SQLite storage.
+
+    Subclasses set calendar, used to assign each journal line its period.
+    """
+
+    sequence_columns = ("transaction_id", "jnl_id")
+    calendar: FiscalCalendar
+    schema = {
+        "transaction_id": "int64",
+        "jnl_id": "int64",
+        "jnl_type": "category",
+        "transaction_date": "datetime64[ns]",
+        "period": "int16",
+        "nominal": "category",
+        "amount": "int64",
+        "description": "object",
+    }
 
     def get_next_journal_id(self) -> int:
-        try:
-            next_id = int(self.df["jnl_id"].max()) + 1
-        except ValueError:
-            return 0
-        return next_id
+        return self.sequences["jnl_id"].peek()
 
     def add_journal(self, journal: GLJournal) -> List[int]:
-        if journal.total != 0:
-            print(journal)
-            raise JournalBalanceError(f"Journal does not balance: {journal.total}")
-        # TODO This is a dev only assert
-        assert isinstance(journal.transaction_date, datetime.datetime)
-        period = convert_date_string_to_period(journal.transaction_date)
-        df = pd.DataFrame([asdict(x) for x in journal.lines])
-        df["jnl_type"] = journal.jnl_type
-        df["jnl_id"] = self.get_next_journal_id()
+        return self.add_journals([journal])
+
+    def add_journals(self, journals: List[GLJournal]) -> List[int]:
+        """Post journals with a single append, journal ids assigned in the order given."""
+        return self.add_journal_lines(journals_to_frame(journals))
+
+    def add_journal_lines(self, df: pd.DataFrame) -> List[int]:
+        """Post a frame of journal lines, one journal per distinct value of the "journal" column.
+
+        Every journal is checked to balance, and every line to have a nominal, before anything is posted.
+        """
+        if df.shape[0] == 0:
+            return []
+        missing = df["nominal"].isnull()
+        if missing.any():
+            raise ValueError(f"{missing.sum()} journal lines missing a nominal:\n{df.loc[missing].to_string()}")
+        codes, uniques = pd.factorize(df["journal"])
+        totals = np.zeros(len(uniques), dtype="int64")
+        np.add.at(totals, codes, df["amount"].to_numpy(dtype="int64"))
+        if totals.any():
+            unbalanced = dict(zip(uniques[totals != 0].tolist(), totals[totals != 0].tolist()))
+            lines = df.loc[df["journal"].isin(unbalanced)].to_string()
+            raise JournalBalanceError(f"Journals do not balance: {unbalanced}\n{lines}")
+        jnl_ids = self.reserve_ids("jnl_id", len(uniques))
+        # Copied rather than dropping the "journal" column, which append leaves out anyway
+        df = df.copy()
+        df["jnl_id"] = codes + jnl_ids.start
         # TODO Period should be supplied with journal
-        df["period"] = period
-        df["transaction_date"] = journal.transaction_date
+        df["period"] = self.calendar.require_periods(df["transaction_date"], "journal lines")
         transaction_ids = self.append(df)
         return transaction_ids
 
+    @abstractmethod
+    def freeze_period(self, period: int) -> None:
+        """Close period, no further journals can be posted to it."""
+
+    @abstractmethod
+    def transactions_for(self, nominal: str, period_range: Optional[Tuple[int, int]] = None) -> pd.DataFrame:
+        """Transactions of nominal, in transaction_id order, optionally only from periods start to end inclusive."""
+
+    @property
+    @abstractmethod
+    def balances(self) -> Dict[str, int]:
+        """Balance of each nominal."""
+
+    @property
+    @abstractmethod
+    def period_balances(self) -> Dict[Tuple[str, int], int]:
+        """Balance of each (nominal, period)."""
+
+    @property
+    def periods(self) -> List[int]:
+        """Periods with transactions posted, in order."""
+        return sorted({period for _, period in self.period_balances})
+
     def list_transactions(self) -> List[GeneralLedgerTransaction]:
         return [GeneralLedgerTransaction(**x) for x in self.df.to_dict("records")]
 
+
+class GeneralLedgerTransactions(GeneralLedgerTransactionsMixin, PandasLedger):
+    partition_column = "period"
+    # Row position arrays held per (nominal, period) before they are concatenated
+    max_position_arrays = 64
+
+    def __init__(self, verify_balances: bool = False, calendar: Optional[FiscalCalendar] = None) -> None:
+        # Check running balances against a full recompute every time they are read
+        self.verify_balances = verify_balances
+        self.calendar = DEFAULT_CALENDAR if calendar is None else calendar
+        self.columns = list(self.schema)
+        self.df = empty_frame(self.schema)
+        return
+
+    def freeze_period(self, period: int) -> None:
+        self.freeze_partition(period)
+        return
+
+    def _reset_indexes(self, df: pd.DataFrame) -> None:
+        self._balance = 0
+        self._balances: Dict[str, int] = {}
+        self._period_balances: Dict[Tuple[str, int], int] = {}
+        # Row positions within each period's partition of each nominal's transactions, an array per chunk until read
+        self._nominal_rows: Dict[str, Dict[int, List[np.ndarray]]] = {}
+        self._period_lengths: Dict[int, int] = {}
+        self._update_indexes(df)
+        return
+
+    def _update_indexes(self, df: pd.DataFrame) -> None:
+        """Add chunk to running totals by nominal and by (nominal, period), and to the nominal row index."""
+        if df.shape[0] == 0:
+            return
+        periods = df["period"].to_numpy(dtype="int64")
+        # Chunk's rows follow those already in each period's partition
+        positions = np.empty(periods.shape[0], dtype="int64")
+        for period in np.unique(periods).tolist():
+            rows = np.flatnonzero(periods == period)
+            start = self._period_lengths.get(period, 0)
+            positions[rows] = np.arange(start, start + rows.shape[0])
+            self._period_lengths[period] = start + rows.shape[0]
+        # Group rows by (nominal, period) with numpy, cheaper than a DataFrame groupby for the many small chunks
+        nominal_codes, nominals = pd.factorize(df["nominal"].to_numpy(), use_na_sentinel=False)
+        period_codes, period_values = pd.factorize(periods)
+        keys = nominal_codes * len(period_values) + period_codes
+        order = np.argsort(keys, kind="stable")
+        groups, starts = np.unique(keys[order], return_index=True)
+        totals = np.add.reduceat(df["amount"].to_numpy(dtype="int64")[order], starts)
+        for group, amount, rows in zip(groups.tolist(), totals.tolist(), np.split(positions[order], starts[1:])):
+            nominal = nominals[group // len(period_values)]
+            period = int(period_values[group % len(period_values)])
+            self._balance += amount
+            self._balances[nominal] = self._balances.get(nominal, 0) + amount
+            key = (nominal, period)
+            self._period_balances[key] = self._period_balances.get(key, 0) + amount
+            arrays = self._nominal_rows.setdefault(nominal, {}).setdefault(period, [])
+            arrays.append(rows)
+            # Each array carries ~100 bytes of overhead, so many small chunks are merged before they outweigh rows
+            if len(arrays) >= self.max_position_arrays:
+                arrays[:] = [np.concatenate(arrays)]
+        return
+
+    def transactions_for(self, nominal: str, period_range: Optional[Tuple[int, int]] = None) -> pd.DataFrame:
+        frames = []
+        for period, positions in sorted(self._nominal_rows.get(nominal, {}).items()):
+            if period_range is not None and not period_range[0] <= period <= period_range[1]:
+                continue
+            if len(positions) > 1:
+                positions[:] = [np.concatenate(positions)]
+            frames.append(self._buffer.partition(period).iloc[positions[0]])
+        if not frames:
+            return empty_frame(self.schema)
+        df = concat_frames(frames)
+        # Each partition is in transaction_id order, but a later period can hold rows posted before an earlier one's
+        if len(frames) > 1 and not df["transaction_id"].is_monotonic_increasing:
+            df = df.sort_values("transaction_id", kind="stable", ignore_index=True)
+        return df
+
+    def verify_balance_index(self) -> None:
+        """Compare running totals against a full recompute from the ledger."""
+        df = self.df
+        if df.shape[0] == 0:
+            expected_balances, expected_period_balances = {}, {}
+        else:
+            df = df.astype({"amount": "int64", "period": "int64"})
+            balances = df[["nominal", "amount"]].groupby(["nominal"], observed=True).sum()
+            expected_balances = balances["amount"].to_dict()
+            period_balances = df[["nominal", "period", "amount"]].groupby(["nominal", "period"], observed=True).sum()
+            expected_period_balances = period_balances["amount"].to_dict()
+        if self._balance != sum(expected_balances.values()):
+            raise BalanceIndexError(f"Balance index {self._balance} does not match ledger")
+        if self._balances != expected_balances:
+            raise BalanceIndexError("Nominal balance index does not match ledger")
+        if self._period_balances != expected_period_balances:
+            raise BalanceIndexError("Period balance index does not match ledger")
+        return
+
     @property
     def balance(self) -> int:
-        return self.df["amount"].sum()
+        if self.verify_balances:
+            self.verify_balance_index()
+        return self._balance
 
     @property
     def balances(self) -> Dict[str, int]:
-        data = self.df[["nominal", "amount"]].groupby(["nominal"]).sum().to_dict()["amount"]
-        return data
+        if self.verify_balances:
+            self.verify_balance_index()
+        return dict(self._balances)
+
+    @property
+    def period_balances(self) -> Dict[Tuple[str, int], int]:
+        if self.verify_balances:
+            self.verify_balance_index()
+        return dict(self._period_balances)
+
+
+class SQLiteGeneralLedgerTransactions(SQLiteLedger, GeneralLedgerTransactionsMixin):
+    table = "general_ledger"
+
+    def __init__(self, filename: str = ":memory:", calendar: Optional[FiscalCalendar] = None) -> None:
+        self.calendar = DEFAULT_CALENDAR if calendar is None else calendar
+        super().__init__(filename)
+        return
+
+    def freeze_period(self, period: int) -> None:
+        # Table is indexed by period rather than partitioned, so there is nothing to consolidate
+        return
+
+    def transactions_for(self, nominal: str, period_range: Optional[Tuple[int, int]] = None) -> pd.DataFrame:
+        if period_range is None:
+            return self._read("WHERE nominal = ?", (nominal,))
+        return self._read("WHERE nominal = ? AND period BETWEEN ? AND ?", (nominal,) + tuple(period_range))
+
+    @property
+    def balances(self) -> Dict[str, int]:
+        sql = f"SELECT nominal, SUM(amount) FROM {self.table} GROUP BY nominal"
+        return dict(self.connection.execute(sql).fetchall())
+
+    @property
+    def period_balances(self) -> Dict[Tuple[str, int], int]:
+        sql = f"SELECT nominal, period, SUM(amount) FROM {self.table} GROUP BY nominal, period"
+        return {(nominal, period): amount for nominal, period, amount in self.connection.execute(sql).fetchall()}
 
 
 @dataclass
@@ -213,38 +409,57 @@ class InMemoryChartOfAccounts(ChartOfAccounts):
     def nominals(self) -> List[Nominal]:
         return [x for x in self._nominals]
 
+    def save_snapshot(self, filename: str) -> None:
+        df = pd.DataFrame([asdict(x) for x in self._nominals], columns=[x.name for x in fields(Nominal)])
+        save_frame_snapshot(df, filename)
+        return
+
+    def load_snapshot(self, filename: str) -> None:
+        """Replace nominals with those in the snapshot in filename."""
+        self._nominals = [Nominal(**x) for x in load_frame_snapshot(filename).to_dict("records")]
+        return
+
 
-class GeneralLedger:
-    def __init__(self, ledger: GeneralLedgerTransactions, chart_of_accounts: ChartOfAccounts):
+class GeneralLedger(DispersalTarget):
+    def __init__(
+        self,
+        ledger: GeneralLedgerTransactionsMixin,
+        chart_of_accounts: ChartOfAccounts,
+        calendar: Optional[FiscalCalendar] = None,
+    ):
         self.ledger = ledger
         self.chart_of_accounts = chart_of_accounts
-        self.periods = {
-            1: Period(period=1, date_start=datetime.datetime(2021, 1, 1), date_end=datetime.datetime(2021, 1, 31)),
-            2: Period(period=2, date_start=datetime.datetime(2021, 2, 1), date_end=datetime.datetime(2021, 2, 28)),
-            3: Period(period=3, date_start=datetime.datetime(2021, 3, 1), date_end=datetime.datetime(2021, 3, 31)),
-            4: Period(period=4, date_start=datetime.datetime(2021, 4, 1), date_end=datetime.datetime(2021, 4, 30)),
-            5: Period(period=5, date_start=datetime.datetime(2021, 5, 1), date_end=datetime.datetime(2021, 5, 31)),
-            6: Period(period=6, date_start=datetime.datetime(2021, 6, 1), date_end=datetime.datetime(2021, 6, 30)),
-            7: Period(period=7, date_start=datetime.datetime(2021, 7, 1), date_end=datetime.datetime(2021, 7, 31)),
-            8: Period(period=8, date_start=datetime.datetime(2021, 8, 1), date_end=datetime.datetime(2021, 8, 31)),
-            9: Period(period=9, date_start=datetime.datetime(2021, 9, 1), date_end=datetime.datetime(2021, 9, 30)),
-            10: Period(period=10, date_start=datetime.datetime(2021, 10, 1), date_end=datetime.datetime(2021, 10, 31)),
-            11: Period(period=11, date_start=datetime.datetime(2021, 11, 1), date_end=datetime.datetime(2021, 11, 30)),
-            12: Period(period=12, date_start=datetime.datetime(2021, 12, 1), date_end=datetime.datetime(2021, 12, 31)),
-        }
+        self.calendar = DEFAULT_CALENDAR if calendar is None else calendar
         return
 
     def add_journal(self, journal: GLJournal) -> List[int]:
         """Wrapper around self.ledger.add_journal, allow interaction with other GeneralLedger attributes."""
+        return self.add_journals([journal])
+
+    def add_journals(self, journals: List[GLJournal]) -> List[int]:
+        """Post journals in one batch, each reversing journal followed by its reversal at the start of next period.
+
+        Returns transaction ids of the journals supplied, not their reversals.
+        """
         # TODO store journals in self.journal_ledger
-        # TODO meta items such as reversing journal creation
-        transaction_ids = self.ledger.add_journal(journal)
-        if journal.jnl_type.endswith("_rev"):
-            rev_journal = create_opposite_journal(journal)
-            # TODO hack to shift period, need to use self.periods
-            period = journal.transaction_date.month
-            # TODO what about period that doesn't exist?
-            date_start = self.periods[period + 1].date_start
-            rev_journal.transaction_date = date_start
-            self.ledger.add_journal(rev_journal)
-        return transaction_ids
+        return self.add_journal_lines(journals_to_frame(journals))
+
+    def add_journal_lines(self, df: pd.DataFrame) -> List[int]:
+        """Post a frame of journal lines laid out as by journals_to_frame, with integer "journal" values.
+
+        Reversing journals are followed by their reversal as in add_journals.
+        """
+        df = df.copy()
+        df["journal"] = df["journal"] * 2
+        is_reversing = df["jnl_type"].str.endswith("_rev").to_numpy(dtype=bool)
+        if is_reversing.any():
+            reversing = df.loc[is_reversing].copy()
+            periods = self.calendar.require_periods(reversing["transaction_date"], "reversing journal lines")
+            next_period_starts = {period: self.calendar.next_period(period).date_start for period in periods.unique()}
+            reversing["transaction_date"] = pd.to_datetime(periods.map(next_period_starts))
+            reversing["amount"] = -reversing["amount"]
+            reversing["journal"] = reversing["journal"] + 1
+            df = pd.concat([df, reversing], ignore_index=True).sort_values("journal", kind="stable")
+        is_original = (df["journal"] % 2 == 0).to_list()
+        transaction_ids = self.ledger.add_journal_lines(df)
+        return [x for x, original in zip(transaction_ids, is_original) if original]
@@ -0,0 +1,119 @@
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, Optional, Tuple
+import contextlib
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory is not recorded
+    resource = None
+
+
+def process_peak_memory_bytes() -> Optional[int]:
+    """Peak resident memory of the whole process so far, None where the platform does not report it."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@dataclass
+class StageRecord:
+    stage: str
+    period: Optional[int]
+    seconds: float = 0.0
+    counts: Dict[str, int] = field(default_factory=dict)
+    # How far the stage raised the process's peak memory, 0 if it stayed below an earlier peak
+    peak_memory_increase_bytes: Optional[int] = None
+    failed: bool = False
+
+
+class Instrumentation:
+    """Times each stage of a run, per period where it has one, with counts of what the stage handled.
+
+    Progress is printed as each stage finishes, unless quiet. Stages may run on other threads, for instance
+    periods parsed ahead of the one being posted.
+    """
+
+    def __init__(self, quiet: bool = False) -> None:
+        self.quiet = quiet
+        self.started = datetime.datetime.now()
+        self._start = time.perf_counter()
+        self._start_peak = process_peak_memory_bytes()
+        self._records: Dict[Tuple[Optional[int], str], StageRecord] = {}
+        self._lock = threading.Lock()
+        return
+
+    def log(self, *values: Any) -> None:
+        if not self.quiet:
+            print(*values)
+        return
+
+    @contextlib.contextmanager
+    def stage(self, stage: str, period: Optional[int] = None) -> Iterator[Dict[str, int]]:
+        """Time the block as stage of period, yielding a dict to count what it handled in.
+
+        Entering the same stage of a period again adds to its time and counts. A stage left by an exception is
+        still recorded, as failed.
+        """
+        counts: Dict[str, int] = {}
+        start = time.perf_counter()
+        start_peak = process_peak_memory_bytes()
+        failed = True
+        try:
+            yield counts
+            failed = False
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                record = self._records.setdefault((period, stage), StageRecord(stage=stage, period=period))
+                record.seconds += seconds
+                for name, count in counts.items():
+                    record.counts[name] = record.counts.get(name, 0) + count
+                if start_peak is not None:
+                    increase = process_peak_memory_bytes() - start_peak
+                    record.peak_memory_increase_bytes = (record.peak_memory_increase_bytes or 0) + increase
+                record.failed = record.failed or failed
+            counted = ", ".join(f"{name} {count}" for name, count in counts.items())
+            label = stage if period is None else f"period {period} {stage}"
+            outcome = "failed after" if failed else "took"
+            self.log(f"..{label} {outcome} {seconds:.3f}s" + (f": {counted}" if counted else ""))
+        return
+
+    def summary(self, **run: Any) -> Dict[str, Any]:
+        """Every stage recorded, in the order first entered, and totals of each stage over all periods.
+
+        run is added as details of the run, such as the entity. The process peak includes memory used before the
+        run started, e.g. by earlier runs in the same worker process, unlike the run's increase of it.
+        """
+        with self._lock:
+            records = [asdict(x) for x in self._records.values()]
+        process_peak = process_peak_memory_bytes()
+        totals: Dict[str, Dict[str, Any]] = {}
+        for record in records:
+            total = totals.setdefault(record["stage"], {"seconds": 0.0, "counts": {}})
+            total["seconds"] += record["seconds"]
+            for name, count in record["counts"].items():
+                total["counts"][name] = total["counts"].get(name, 0) + count
+        return {
+            **run,
+            "started": self.started.isoformat(),
+            "seconds": time.perf_counter() - self._start,
+            "process_peak_memory_bytes": process_peak,
+            "peak_memory_increase_bytes": None if process_peak is None else process_peak - self._start_peak,
+            "totals": totals,
+            "stages": records,
+        }
+
+    def write_json(self, filename: str, **run: Any) -> None:
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename, "w") as f:
+            json.dump(self.summary(**run), f, indent=2)
+        return
@@ -1,37 +1,450 @@
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Dict, Optional, Tuple
+import sqlite3
 
 import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from pyarrow import feather
 
 
 class Ledger(ABC):
-    @abstractmethod
+    # Columns whose next id is allocated by a Sequence
+    sequence_columns = ("transaction_id", "batch_id")
+    # Sequence of each of sequence_columns, set up by the storage subclass from the rows it holds
+    sequences: Dict[str, "Sequence"]
+
     def get_next_batch_id(self) -> int:
         """Return next available batch id."""
+        return self.sequences["batch_id"].peek()
 
-    @abstractmethod
     def get_next_transaction_id(self) -> int:
         """Return next available transaction id."""
+        return self.sequences["transaction_id"].peek()
 
+    def reserve_ids(self, column: str, count: int) -> range:
+        """Reserve a contiguous block of ids, e.g. for a bulk post."""
+        return self.sequences[column].reserve(count)
 
-class PandasLedger(Ledger):
-    def get_next_batch_id(self) -> int:
+    def _assign_transaction_ids(self, df: pd.DataFrame) -> range:
+        """Give rows about to be appended the next transaction ids, and observe their ids of other sequences."""
+        ids = self.reserve_ids("transaction_id", df.shape[0])
+        df["transaction_id"] = np.arange(start=ids.start, stop=ids.stop)
+        for column in self.sequence_columns:
+            if column != "transaction_id" and df.shape[0] > 0:
+                self.sequences[column].observe(df[column].max())
+        return ids
+
+    @abstractmethod
+    def append(self, df) -> List[int]:
+        """Append rows, assigning their transaction ids."""
+
+    @abstractmethod
+    def select(self, **values) -> pd.DataFrame:
+        """Rows where each column equals the value given."""
+
+    @abstractmethod
+    def update_transactions(self, transaction_ids: List[int], column: str, value) -> None:
+        """Set column to value for transaction_ids."""
+
+
+def empty_frame(schema: Dict[str, str]) -> pd.DataFrame:
+    """Empty DataFrame with a column of the given dtype for each schema item."""
+    return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in schema.items()})
+
+
+def concat_frames(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate frames, keeping categorical columns categorical where the frames' categories differ."""
+    df = pd.concat(frames, ignore_index=True, sort=False)
+    for column, dtype in frames[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype) and isinstance(df[column].dtype, pd.CategoricalDtype) is False:
+            df[column] = union_categoricals([frame[column] for frame in frames])
+    return df
+
+
+def save_frame_snapshot(df: pd.DataFrame, filename: str) -> None:
+    """Write df to an uncompressed Arrow IPC (Feather v2) file, so it can be memory-mapped on load."""
+    feather.write_feather(df.reset_index(drop=True), filename, compression="uncompressed")
+    return
+
+
+def load_frame_snapshot(filename: str) -> pd.DataFrame:
+    """Read a frame written by save_frame_snapshot through a memory map of the file."""
+    return feather.read_table(filename, memory_map=True).to_pandas()
+
+
+class FrameBuffer:
+    """Chunked store of appended DataFrames, only concatenated into one frame when read.
+
+    Chunks are cast to the schema once per concatenation rather than once per chunk.
+    """
+
+    def __init__(self, df: pd.DataFrame, schema: Optional[Dict[str, str]] = None) -> None:
+        self._df = df
+        self._chunks: List[pd.DataFrame] = []
+        self._length = df.shape[0]
+        self._schema = schema or {}
+        return
+
+    def __len__(self) -> int:
+        return self._length
+
+    def append(self, df: pd.DataFrame) -> None:
+        self._chunks.append(df)
+        self._length += df.shape[0]
+        return
+
+    @property
+    def frames(self) -> List[pd.DataFrame]:
+        """Built frame followed by chunks appended since, without concatenating them."""
+        return [self._df] + self._chunks
+
+    @property
+    def df(self) -> pd.DataFrame:
+        if self._chunks:
+            pending = pd.concat(self._chunks, ignore_index=True, sort=False)
+            pending = pending.astype(self._schema)
+            self._df = concat_frames([self._df, pending])
+            self._chunks = []
+        return self._df
+
+
+class FrozenPartitionError(Exception):
+    pass
+
+
+class PartitionedFrameBuffer:
+    """FrameBuffer per distinct value of a partition column, so reading one partition never touches the others.
+
+    A frozen partition is consolidated into a single frame and rejects further appends. The frame of all
+    partitions is kept once built, until rows are appended or changed.
+    """
+
+    def __init__(self, df: pd.DataFrame, column: str, schema: Optional[Dict[str, str]] = None) -> None:
+        self.column = column
+        self._empty = df.iloc[:0]
+        self._schema = schema
+        self._partitions: Dict[int, FrameBuffer] = {}
+        self._frozen = set()
+        self._df: Optional[pd.DataFrame] = None
+        self.append(df)
+        return
+
+    def __len__(self) -> int:
+        return sum(len(x) for x in self._partitions.values())
+
+    @property
+    def keys(self) -> List:
+        return sorted(self._partitions)
+
+    def append(self, df: pd.DataFrame) -> None:
+        if df.shape[0] == 0:
+            return
+        values = df[self.column].to_numpy()
+        if (values == values[0]).all():
+            parts = [(values[0], df)]
+        else:
+            parts = list(df.groupby(self.column, sort=False))
+        frozen = [key for key, _ in parts if key in self._frozen]
+        if frozen:
+            raise FrozenPartitionError(f"Cannot append to frozen {self.column} {frozen}")
+        for key, part in parts:
+            if key not in self._partitions:
+                self._partitions[key] = FrameBuffer(self._empty, self._schema)
+            self._partitions[key].append(part)
+        self.invalidate()
+        return
+
+    def invalidate(self) -> None:
+        """Discard the frame of all partitions, e.g. after rows were updated in place."""
+        self._df = None
+        return
+
+    def freeze(self, key) -> None:
+        self.partition(key)
+        self._frozen.add(key)
+        self.invalidate()
+        return
+
+    def partition(self, key) -> pd.DataFrame:
+        if key not in self._partitions:
+            return self._empty.copy()
+        return self._partitions[key].df
+
+    @property
+    def frames(self) -> List[pd.DataFrame]:
+        return [frame for key in self.keys for frame in self._partitions[key].frames]
+
+    @property
+    def df(self) -> pd.DataFrame:
+        """All partitions as a single frame in transaction_id order."""
+        if not self._partitions:
+            return self._empty.copy()
+        if self._df is None:
+            df = concat_frames([self.partition(key) for key in self.keys])
+            self._df = df.sort_values("transaction_id", kind="stable", ignore_index=True)
+        return self._df
+
+
+class Sequence:
+    """Monotonic id counter. Ids are either reserved as a block or observed once used by appended rows."""
+
+    def __init__(self, next_id: int = 0) -> None:
+        self._next_id = next_id
+        return
+
+    @classmethod
+    def from_values(cls, values: pd.Series) -> "Sequence":
+        """Sequence continuing after the largest id in values, e.g. a ledger reloaded from persisted state."""
         try:
-            next_id = int(self.df["batch_id"].max()) + 1
+            next_id = int(values.max()) + 1
         except ValueError:
-            return 0
-        return next_id
+            next_id = 0
+        return cls(next_id)
 
-    def append(self, df) -> List[int]:
-        next_id = self.get_next_transaction_id()
-        ids = np.arange(start=next_id, stop=next_id + df.shape[0])
-        df["transaction_id"] = ids
-        self.df = self.df.append(df[self.columns], ignore_index=True, sort=False)
-        return list(ids)
+    def peek(self) -> int:
+        """Return next available id without using it."""
+        return self._next_id
 
-    def get_next_transaction_id(self) -> int:
+    def reserve(self, count: int) -> range:
+        """Use and return a contiguous block of count ids."""
+        ids = range(self._next_id, self._next_id + count)
+        self._next_id += count
+        return ids
+
+    def observe(self, value) -> None:
+        """Record value as used, so the sequence continues after it."""
         try:
-            next_id = int(self.df["transaction_id"].max()) + 1
+            next_id = int(value) + 1
         except ValueError:
-            return 0
-        return next_id
+            return
+        self._next_id = max(self._next_id, next_id)
+        return
+
+
+class PandasLedger(Ledger):
+    # dtype of each column, enforced on append
+    schema: Dict[str, str] = {}
+    # If set, rows are stored partitioned by the value of this column
+    partition_column: Optional[str] = None
+
+    @property
+    def df(self) -> pd.DataFrame:
+        return self._buffer.df
+
+    @df.setter
+    def df(self, df: pd.DataFrame) -> None:
+        if self.partition_column is None:
+            self._buffer = FrameBuffer(df, self.schema)
+        else:
+            self._buffer = PartitionedFrameBuffer(df, self.partition_column, self.schema)
+        self.sequences: Dict[str, Sequence] = {
+            column: Sequence.from_values(df[column]) for column in self.sequence_columns
+        }
+        self._reset_indexes(df)
+        return
+
+    def _reset_indexes(self, df: pd.DataFrame) -> None:
+        """Rebuild any indexes a subclass maintains over the ledger from the full frame."""
+        return
+
+    def _update_indexes(self, df: pd.DataFrame) -> None:
+        """Update any indexes a subclass maintains over the ledger with a newly appended chunk."""
+        return
+
+    def save_snapshot(self, filename: str) -> None:
+        save_frame_snapshot(self.df, filename)
+        return
+
+    def load_snapshot(self, filename: str) -> None:
+        """Replace ledger with the snapshot in filename, continuing its id sequences."""
+        self.df = load_frame_snapshot(filename)
+        return
+
+    def update_transactions(self, transaction_ids: List[int], column: str, value) -> None:
+        """Set column to value for transaction_ids, in place in whichever chunks hold them."""
+        if not transaction_ids:
+            return
+        first_id, last_id = min(transaction_ids), max(transaction_ids)
+        for frame in self._buffer.frames:
+            # Rows are appended in transaction_id order, so chunks outside the id range are skipped
+            if frame.shape[0] == 0:
+                continue
+            ids = frame["transaction_id"]
+            if ids.iloc[0] > last_id or ids.iloc[-1] < first_id:
+                continue
+            frame.loc[ids.isin(transaction_ids), column] = value
+        if self.partition_column is not None:
+            self._buffer.invalidate()
+        return
+
+    def select(self, **values) -> pd.DataFrame:
+        if self.partition_column in values:
+            df = self._buffer.partition(values[self.partition_column])
+        else:
+            df = self.df
+        mask = np.ones(df.shape[0], dtype=bool)
+        for column, value in values.items():
+            mask &= (df[column] == value).to_numpy()
+        return df.loc[mask].copy()
+
+    def append(self, df) -> List[int]:
+        ids = self._assign_transaction_ids(df)
+        chunk = df[self.columns]
+        self._buffer.append(chunk)
+        self._update_indexes(chunk)
+        return list(ids)
+
+    def transactions_since(self, transaction_id: int) -> pd.DataFrame:
+        """Rows from transaction_id onwards, read only from the chunks which hold them."""
+        frames = []
+        for frame in self._buffer.frames:
+            if frame.shape[0] == 0 or frame["transaction_id"].iloc[-1] < transaction_id:
+                continue
+            # Each chunk is in transaction_id order, so its rows from transaction_id are a slice of it
+            start = frame["transaction_id"].searchsorted(transaction_id)
+            frames.append(frame.iloc[start:])
+        if not frames:
+            return empty_frame(self.schema)
+        df = pd.concat(frames, ignore_index=True, sort=False)
+        # Chunks not yet concatenated into the buffer's frame are not yet cast to the schema
+        df = df.astype(self.schema)
+        if self.partition_column is not None:
+            df = df.sort_values("transaction_id", kind="stable", ignore_index=True)
+        return df
+
+    def freeze_partition(self, key) -> None:
+        """Consolidate partition key into a single frame and reject any further rows for it."""
+        self._buffer.freeze(key)
+        return
+
+
+class SQLiteLedger(Ledger):
+    """Ledger stored in a SQLite table.
+
+    Subclasses set table, and list the domain class shared with their pandas counterpart after SQLiteLedger so
+    its schema and methods built on append, select and update_transactions are reused.
+    """
+
+    table: str
+    indexed_columns = ("batch_id", "jnl_id", "nominal", "period")
+    # SQLite limits the number of parameters in a single statement
+    max_parameters = 500
+
+    def __init__(self, filename: str = ":memory:") -> None:
+        self.filename = filename
+        self.columns = list(self.schema)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._create_table()
+        self.sequences: Dict[str, Sequence] = {}
+        for column in self.sequence_columns:
+            (max_id,) = self.connection.execute(f"SELECT MAX({column}) FROM {self.table}").fetchone()
+            self.sequences[column] = Sequence(0 if max_id is None else max_id + 1)
+        return
+
+    def _create_table(self) -> None:
+        sql_types = {"int64": "INTEGER", "int16": "INTEGER", "bool": "INTEGER"}
+        definitions = []
+        for column, dtype in self.schema.items():
+            definition = f"{column} {sql_types.get(dtype, 'TEXT')}"
+            if column == "transaction_id":
+                definition += " PRIMARY KEY"
+            definitions.append(definition)
+        with self.connection:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ({', '.join(definitions)})")
+            for column in self.indexed_columns:
+                if column in self.schema:
+                    self.connection.execute(
+                        f"CREATE INDEX IF NOT EXISTS {self.table}_{column} ON {self.table} ({column})"
+                    )
+        return
+
+    def _to_sql_rows(self, df: pd.DataFrame) -> List[Tuple]:
+        columns = []
+        for column, dtype in self.schema.items():
+            values = df[column]
+            if dtype.startswith("datetime64"):
+                values = pd.to_datetime(values).dt.strftime("%Y-%m-%d %H:%M:%S")
+            elif dtype == "bool":
+                values = values.astype(bool).astype(int)
+            values = values.astype(object)
+            columns.append(values.where(values.notnull(), None).to_list())
+        return list(zip(*columns))
+
+    def _from_sql(self, df: pd.DataFrame) -> pd.DataFrame:
+        for column, dtype in self.schema.items():
+            if dtype.startswith("datetime64"):
+                df[column] = pd.to_datetime(df[column])
+            elif dtype == "bool":
+                df[column] = df[column].astype(int).astype(bool)
+            else:
+                df[column] = df[column].astype(dtype)
+        return df
+
+    def _read(self, where: str = "", parameters: Tuple = ()) -> pd.DataFrame:
+        sql = f"SELECT {', '.join(self.columns)} FROM {self.table} {where} ORDER BY transaction_id"
+        return self._from_sql(pd.read_sql_query(sql, self.connection, params=parameters))
+
+    @property
+    def df(self) -> pd.DataFrame:
+        return self._read()
+
+    @df.setter
+    def df(self, df: pd.DataFrame) -> None:
+        with self.connection:
+            self.connection.execute(f"DELETE FROM {self.table}")
+            self._insert(df)
+        self.sequences = {column: Sequence.from_values(df[column]) for column in self.sequence_columns}
+        return
+
+    def save_snapshot(self, filename: str) -> None:
+        save_frame_snapshot(self.df, filename)
+        return
+
+    def load_snapshot(self, filename: str) -> None:
+        """Replace ledger table contents with the snapshot in filename."""
+        self.df = load_frame_snapshot(filename)
+        return
+
+    def _insert(self, df: pd.DataFrame) -> None:
+        placeholders = ", ".join("?" for _ in self.columns)
+        self.connection.executemany(
+            f"INSERT INTO {self.table} ({', '.join(self.columns)}) VALUES ({placeholders})", self._to_sql_rows(df)
+        )
+        return
+
+    def append(self, df) -> List[int]:
+        ids = self._assign_transaction_ids(df)
+        with self.connection:
+            self._insert(df)
+        return list(ids)
+
+    def select(self, **values) -> pd.DataFrame:
+        if not values:
+            return self._read()
+        where = "WHERE " + " AND ".join(f"{column} = ?" for column in values)
+        parameters = tuple(int(x) if isinstance(x, bool) else x for x in values.values())
+        return self._read(where, parameters)
+
+    def transactions_since(self, transaction_id: int) -> pd.DataFrame:
+        return self._read("WHERE transaction_id >= ?", (int(transaction_id),))
+
+    def update_transactions(self, transaction_ids: List[int], column: str, value) -> None:
+        if isinstance(value, bool):
+            value = int(value)
+        transaction_ids = [int(x) for x in transaction_ids]
+        with self.connection:
+            for i in range(0, len(transaction_ids), self.max_parameters):
+                block = transaction_ids[i:i + self.max_parameters]
+                placeholders = ", ".join("?" for _ in block)
+                self.connection.execute(
+                    f"UPDATE {self.table} SET {column} = ? WHERE transaction_id IN ({placeholders})", [value] + block
+                )
+        return
+
+    @property
+    def balance(self) -> int:
+        (balance,) = self.connection.execute(f"SELECT COALESCE(SUM(amount), 0) FROM {self.table}").fetchone()
+        return balance
@@ -0,0 +1,394 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional, Tuple, Type, Union
+import os
+
+import openpyxl
+import pandas as pd
+from pandas.io.parsers import TextParser
+import pyarrow
+import pyarrow.parquet
+
+from cache import SourceDataCache, restore_missing_values
+from fiscal import DEFAULT_CALENDAR, FiscalCalendar
+
+
+def excel_row_values(row: tuple) -> list:
+    """Cells of a worksheet row converted as by pd.read_excel, empty as "" and whole floats as int.
+
+    Trailing empty cells are dropped, so an empty row is an empty list.
+    """
+    row = ["" if x is None else int(x) if isinstance(x, float) and x.is_integer() else x for x in row]
+    while row and row[-1] == "":
+        row.pop()
+    return row
+
+
+def read_excel_sheets(filename: str, sheet_names: List[str]) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """Yield (sheet name, DataFrame) for each of sheet_names, in workbook order, opening the workbook once.
+
+    The workbook is streamed in read-only mode, so sheets not named are never parsed. Frames are built as
+    by pd.read_excel.
+    """
+    workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True, keep_links=False)
+    try:
+        missing = set(sheet_names) - set(workbook.sheetnames)
+        if missing:
+            raise ValueError(f"Worksheets {sorted(missing)} not found in {filename}")
+        for sheet_name in workbook.sheetnames:
+            if sheet_name not in sheet_names:
+                continue
+            data = []
+            last_row_with_data = -1
+            for row_number, row in enumerate(workbook[sheet_name].iter_rows(values_only=True)):
+                row = excel_row_values(row)
+                if row:
+                    last_row_with_data = row_number
+                data.append(row)
+            data = data[: last_row_with_data + 1]
+            if data:
+                width = max(len(row) for row in data)
+                data = [row + [""] * (width - len(row)) for row in data]
+            yield sheet_name, TextParser(data, header=0, index_col=None).read()
+    finally:
+        workbook.close()
+    return
+
+
+def read_excel_sheet_chunks(filename: str, sheet_name: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """Yield the rows of a worksheet as frames of at most chunk_rows rows, streaming the workbook.
+
+    Only one chunk of rows is held at a time. Empty rows are kept unless they trail the sheet, as by pd.read_excel.
+    """
+    workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True, keep_links=False)
+    try:
+        if sheet_name not in workbook.sheetnames:
+            raise ValueError(f"Worksheet {sheet_name} not found in {filename}")
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        header = excel_row_values(next(rows, ()))
+        data, empty_rows, chunks = [], 0, 0
+        for row in rows:
+            row = excel_row_values(row)
+            if not row:
+                # Held back until a later row has data, so trailing empty rows are dropped
+                empty_rows += 1
+                continue
+            for pending in [[]] * empty_rows + [row]:
+                data.append(pending)
+                if len(data) == chunk_rows:
+                    yield excel_rows_frame(header, data)
+                    data, chunks = [], chunks + 1
+            empty_rows = 0
+        # An empty sheet still gives one frame, of its columns
+        if data or chunks == 0:
+            yield excel_rows_frame(header, data)
+    finally:
+        workbook.close()
+    return
+
+
+def excel_rows_frame(header: list, data: List[list]) -> pd.DataFrame:
+    """Frame of worksheet rows converted by excel_row_values, under header."""
+    if not header and not data:
+        return pd.DataFrame()
+    width = max([len(header)] + [len(row) for row in data])
+    data = [row + [""] * (width - len(row)) for row in [header] + data]
+    return TextParser(data, header=0, index_col=None).read()
+
+
+def frame_to_arrow_bytes(df: pd.DataFrame) -> bytes:
+    """Serialise df as an Arrow IPC stream."""
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def frame_from_arrow_bytes(data: bytes) -> pd.DataFrame:
+    """Read a frame serialised by frame_to_arrow_bytes."""
+    return restore_missing_values(pyarrow.ipc.open_stream(data).read_all().to_pandas())
+
+
+def read_excel_sheet_arrow(filename: str, sheet_name: str) -> Tuple[str, Union[bytes, pd.DataFrame]]:
+    """Read one sheet in a worker process, as Arrow IPC bytes which are cheaper to return than a pickled frame.
+
+    Frames Arrow can't hold, e.g. with a column mixing numbers and text, are returned as they are.
+    """
+    _, df = next(read_excel_sheets(filename, [sheet_name]))
+    try:
+        return sheet_name, frame_to_arrow_bytes(df)
+    except (pyarrow.ArrowException, ValueError, TypeError):
+        return sheet_name, df
+
+
+class SourceDataLoader(ABC):
+    """Reads the source datasets of an entity, one sheet each, and prepares them for parsing.
+
+    Subclasses read sheets from a particular format. Preparation is the same for all formats.
+    """
+
+    # Attribute holding each dataset, and the attribute holding the name of the sheet it is read from
+    datasets = {
+        "bank": "bank_sheet",
+        "coa": "coa_sheet",
+        "sales_invoice_headers": "si_headers_sheet",
+        "sales_invoice_lines": "si_lines_sheet",
+        "gl_journal_headers": "gl_jnl_headers_sheet",
+        "gl_journal_lines": "gl_jnl_lines_sheet",
+    }
+    # Date column of each dataset which sets the period of its rows
+    period_columns = {
+        "bank": "date",
+        "sales_invoice_headers": "date",
+        "sales_invoice_lines": "transaction_date",
+        "gl_journal_headers": "transaction_date",
+    }
+    # Columns of each dataset holding dates, for formats which store dates as text
+    date_columns = {
+        "bank": ["date"],
+        "sales_invoice_headers": ["date"],
+        "sales_invoice_lines": ["transaction_date"],
+        "gl_journal_headers": ["transaction_date"],
+    }
+
+    def __init__(
+        self,
+        filename: str,
+        bank_sheet: str,
+        coa_sheet: str,
+        si_headers_sheet: str,
+        si_lines_sheet: str,
+        gl_jnl_headers_sheet: str,
+        gl_jnl_lines_sheet: str,
+        cache: Optional[SourceDataCache] = None,
+        calendar: Optional[FiscalCalendar] = None,
+    ) -> None:
+        """If cache is given, prepared datasets are read from it while the source is unchanged.
+
+        Rows are given the period of calendar holding their date, by default the calendar months of 2021.
+        """
+        self.filename = filename
+        self.bank_sheet = bank_sheet
+        self.coa_sheet = coa_sheet
+        self.si_headers_sheet = si_headers_sheet
+        self.si_lines_sheet = si_lines_sheet
+        self.gl_jnl_headers_sheet = gl_jnl_headers_sheet
+        self.gl_jnl_lines_sheet = gl_jnl_lines_sheet
+        self.cache = cache
+        self.calendar = DEFAULT_CALENDAR if calendar is None else calendar
+        # Whether the last load read its datasets from cache rather than the source
+        self.loaded_from_cache = False
+        # Rows of each dataset skipped by the last load for having no date, so no period
+        self.blank_date_rows: Dict[str, int] = {}
+
+        self.bank = None
+        self.coa = None
+        self.sales_invoice_headers = None
+        self.sales_invoice_lines = None
+        self.gl_journal_headers = None
+        self.gl_journal_lines = None
+        return
+
+    def load(self, datasets: Optional[List[str]] = None):
+        """Load datasets, by default all of them. Sheets of datasets not listed are skipped."""
+        if datasets is None:
+            datasets = list(self.datasets)
+        sheets = {name: getattr(self, self.datasets[name]) for name in datasets}
+        self.blank_date_rows = {}
+        frames = None
+        if self.cache is not None:
+            frames = self.cache.get(self.filename, sheets)
+        self.loaded_from_cache = frames is not None
+        if frames is None:
+            frames = {}
+            for name, df in self.read_sheets(sheets):
+                frames[name] = getattr(self, f"prepare_{name}")(df)
+            if self.cache is not None:
+                self.cache.put(self.filename, sheets, frames)
+        for name, df in frames.items():
+            # Periods are assigned after caching, so cached datasets hold for any calendar
+            setattr(self, name, self.assign_period(name, df))
+        return
+
+    def assign_period(self, name: str, df: pd.DataFrame) -> pd.DataFrame:
+        """Add the period column to datasets listed in period_columns.
+
+        Rows with a blank date are dropped and counted in blank_date_rows. Raises ValueError if any other row's
+        date is outside the calendar, rather than leave it unposted.
+        """
+        if name in self.period_columns:
+            dates = df[self.period_columns[name]]
+            blank = dates.isna()
+            if dates.dtype == object:
+                blank |= dates.astype(str).str.strip() == ""
+            self.blank_date_rows[name] = self.blank_date_rows.get(name, 0) + int(blank.sum())
+            if blank.any():
+                df = df.loc[~blank].reset_index(drop=True)
+            df["period"] = self.calendar.require_periods(df[self.period_columns[name]], f"{name} rows")
+        return df
+
+    @abstractmethod
+    def read_sheets(self, sheets: Dict[str, str]) -> Iterator[Tuple[str, pd.DataFrame]]:
+        """Yield (dataset, DataFrame) read from the sheet of each item of sheets, a mapping of dataset to sheet."""
+
+    @abstractmethod
+    def read_sheet_chunks(self, name: str, sheet_name: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+        """Yield the rows of the sheet of dataset name in frames of at most chunk_rows rows, holding one at a time."""
+
+    def iter_bank_chunks(self, chunk_rows: int) -> Iterator[pd.DataFrame]:
+        """Yield the prepared bank dataset in chunks, so memory is bounded by chunk_rows rather than the sheet.
+
+        Chunks are not cached, and raw_id runs on across chunks as when loaded whole.
+        """
+        first_raw_id = 0
+        self.blank_date_rows["bank"] = 0
+        for df in self.read_sheet_chunks("bank", self.bank_sheet, chunk_rows):
+            df = self.assign_period("bank", self.prepare_bank(df, first_raw_id))
+            first_raw_id += df.shape[0]
+            yield df
+        return
+
+    def prepare_bank(self, df: pd.DataFrame, first_raw_id: int = 0) -> pd.DataFrame:
+        # TODO set all column names to lower
+        df["amount"] = df["amount"] * 100
+        df = df.astype({"amount": "int32"})
+        df.insert(0, "raw_id", range(first_raw_id, first_raw_id + len(df)))
+        return df
+
+    def prepare_coa(self, df: pd.DataFrame) -> pd.DataFrame:
+        df["control_account"] = df["control_account"].map({"y": True, "n": False})
+        df["bank_account"] = df["bank_account"].map({"y": True, "n": False})
+        return df
+
+    def prepare_sales_invoice_headers(self, df: pd.DataFrame) -> pd.DataFrame:
+        return df
+
+    def prepare_sales_invoice_lines(self, df: pd.DataFrame) -> pd.DataFrame:
+        df["amount"] = df["amount"] * 100
+        df = df.astype({"amount": "int32"})
+        df.insert(0, "line_id", range(0, 0 + len(df)))
+        return df
+
+    def prepare_gl_journal_headers(self, df: pd.DataFrame) -> pd.DataFrame:
+        return df
+
+    def prepare_gl_journal_lines(self, df: pd.DataFrame) -> pd.DataFrame:
+        df["amount"] = df["amount"] * 100
+        df = df.astype({"amount": "int32"})
+        df.insert(0, "line_id", range(0, 0 + len(df)))
+        return df
+
+
+class ExcelSourceDataLoader(SourceDataLoader):
+    """Reads each sheet from a worksheet of an .xlsx workbook."""
+
+    def __init__(
+        self,
+        filename: str,
+        bank_sheet: str,
+        coa_sheet: str,
+        si_headers_sheet: str,
+        si_lines_sheet: str,
+        gl_jnl_headers_sheet: str,
+        gl_jnl_lines_sheet: str,
+        cache: Optional[SourceDataCache] = None,
+        calendar: Optional[FiscalCalendar] = None,
+        streaming: bool = True,
+        processes: int = 1,
+    ) -> None:
+        """If streaming, all sheets are read in a single pass over the workbook rather than opening it per sheet.
+
+        If processes is more than 1, sheets are instead parsed concurrently in a pool of that many processes.
+        """
+        super().__init__(
+            filename,
+            bank_sheet,
+            coa_sheet,
+            si_headers_sheet,
+            si_lines_sheet,
+            gl_jnl_headers_sheet,
+            gl_jnl_lines_sheet,
+            cache,
+            calendar,
+        )
+        self.streaming = streaming
+        self.processes = processes
+        return
+
+    def read_sheets(self, sheets: Dict[str, str]) -> Iterator[Tuple[str, pd.DataFrame]]:
+        names = {sheet_name: name for name, sheet_name in sheets.items()}
+        if self.processes > 1 and len(names) > 1:
+            yield from self.read_sheets_in_processes(names)
+            return
+        if self.streaming:
+            for sheet_name, df in read_excel_sheets(self.filename, list(names)):
+                yield names[sheet_name], df
+            return
+        for name, sheet_name in sheets.items():
+            yield name, pd.read_excel(self.filename, sheet_name=sheet_name, index_col=None)
+        return
+
+    def read_sheet_chunks(self, name: str, sheet_name: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+        yield from read_excel_sheet_chunks(self.filename, sheet_name, chunk_rows)
+        return
+
+    def read_sheets_in_processes(self, names: Dict[str, str]) -> Iterator[Tuple[str, pd.DataFrame]]:
+        """Yield (dataset, DataFrame) of each sheet in names, a mapping of sheet to dataset, as workers finish.
+
+        Errors raised reading a sheet, such as a missing sheet, are raised again here.
+        """
+        with ProcessPoolExecutor(max_workers=min(self.processes, len(names))) as executor:
+            futures = [executor.submit(read_excel_sheet_arrow, self.filename, sheet_name) for sheet_name in names]
+            for future in as_completed(futures):
+                sheet_name, data = future.result()
+                df = frame_from_arrow_bytes(data) if isinstance(data, bytes) else data
+                yield names[sheet_name], df
+        return
+
+
+class CSVSourceDataLoader(SourceDataLoader):
+    """Reads each sheet from <sheet>.csv in the folder filename."""
+
+    def read_sheets(self, sheets: Dict[str, str]) -> Iterator[Tuple[str, pd.DataFrame]]:
+        for name, sheet_name in sheets.items():
+            filename = os.path.join(self.filename, f"{sheet_name}.csv")
+            yield name, pd.read_csv(filename, index_col=None, parse_dates=self.date_columns.get(name, False))
+        return
+
+    def read_sheet_chunks(self, name: str, sheet_name: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+        filename = os.path.join(self.filename, f"{sheet_name}.csv")
+        parse_dates = self.date_columns.get(name, False)
+        with pd.read_csv(filename, index_col=None, parse_dates=parse_dates, chunksize=chunk_rows) as reader:
+            for df in reader:
+                yield df.reset_index(drop=True)
+        return
+
+
+class ParquetSourceDataLoader(SourceDataLoader):
+    """Reads each sheet from <sheet>.parquet in the folder filename."""
+
+    def read_sheets(self, sheets: Dict[str, str]) -> Iterator[Tuple[str, pd.DataFrame]]:
+        for name, sheet_name in sheets.items():
+            yield name, pd.read_parquet(os.path.join(self.filename, f"{sheet_name}.parquet"))
+        return
+
+    def read_sheet_chunks(self, name: str, sheet_name: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+        parquet_file = pyarrow.parquet.ParquetFile(os.path.join(self.filename, f"{sheet_name}.parquet"))
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+        return
+
+
+def source_loader_class(filename: str) -> Optional[Type[SourceDataLoader]]:
+    """Loader for the source data at filename, an .xlsx workbook or a folder of .csv or .parquet sheets."""
+    if os.path.isdir(filename):
+        extensions = {os.path.splitext(x)[1] for x in os.listdir(filename)}
+        if ".parquet" in extensions:
+            return ParquetSourceDataLoader
+        if ".csv" in extensions:
+            return CSVSourceDataLoader
+        return None
+    if filename.endswith(".xlsx"):
+        return ExcelSourceDataLoader
+    return None
@@ -1,31 +1,58 @@
-from dataclasses import dataclass, asdict
-from dispersals import DispersalsLogger
-from typing import List, Tuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from dispersals import DispersalConfig, DispersalEngine, DispersalsLogger
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Optional, TypeVar
+import argparse
+import contextlib
+import datetime
+import io
+import multiprocessing
 import os
+import queue
 import re
 import json
+import sys
+import threading
+import time
+import traceback
 
+import numpy as np
 import pandas as pd
 
 from general import (
     GLJournal,
     GLJournalLine,
     GeneralLedgerTransactions,
+    SQLiteGeneralLedgerTransactions,
     GeneralLedger,
     InMemoryChartOfAccounts,
     NewNominal,
 )
-from bank import BankTransaction, InMemoryBankLedgerTransactions, RawBankTransaction, BankLedger
+from bank import (
+    InMemoryBankLedgerTransactions,
+    SQLiteBankLedgerTransactions,
+    RawBankTransaction,
+    BankLedger,
+    BankLedgerTransactions,
+)
 from purchases import (
     NewPurchaseInvoice,
-    PurchaseInvoice,
     NewPurchaseInvoiceLine,
     PurchaseLedger,
+    SQLitePurchaseLedger,
     NewPurchaseLedgerPayment,
 )
-from sales import SalesLedger, NewSalesLedgerReceipt, SalesInvoiceLine, SalesInvoice
+from sales import SalesLedger, SQLiteSalesLedger, NewSalesLedgerReceipt, SalesInvoiceLine, SalesInvoice
 from reporting import HTMLRawReportWriter
-from utils import convert_date_string_to_period
+from recovery import RecoveryManager
+from instrumentation import Instrumentation
+from cache import SourceDataCache, frames_fingerprint
+from fiscal import DEFAULT_CALENDAR, FiscalCalendar
+from loaders import SourceDataLoader, source_loader_class
+
+
+T = TypeVar("T")
+R = TypeVar("R")
 
 
 @dataclass
@@ -34,95 +61,6 @@ class EntityData:
     cashbook: str
 
 
-class ExcelSourceDataLoader:
-    def __init__(
-        self,
-        filename: str,
-        bank_sheet: str,
-        coa_sheet: str,
-        si_headers_sheet: str,
-        si_lines_sheet: str,
-        gl_jnl_headers_sheet: str,
-        gl_jnl_lines_sheet: str,
-    ) -> None:
-        self.filename = filename
-        self.bank_sheet = bank_sheet
-        self.coa_sheet = coa_sheet
-        self.si_headers_sheet = si_headers_sheet
-        self.si_lines_sheet = si_lines_sheet
-        self.gl_jnl_headers_sheet = gl_jnl_headers_sheet
-        self.gl_jnl_lines_sheet = gl_jnl_lines_sheet
-
-        self.bank = None
-        self.coa = None
-        self.sales_invoice_headers = None
-        self.sales_invoice_lines = None
-        self.gl_journal_headers = None
-        self.gl_journal_lines = None
-        return
-
-    def load(self):
-        print("Loading Bank Sheet")
-        self.load_bank()
-        print("Loading COA Sheet")
-        self.load_coa()
-        print("Loading Sales Invoice Headers")
-        self.load_sales_invoice_headers()
-        print("Loading Sales Invoice Lines")
-        self.load_sales_invoice_lines()
-        print("Loading GL Journal Headers")
-        self.load_gl_journal_headers()
-        print("Loading GL Journal Lines")
-        self.load_gl_journal_lines()
-        return
-
-    def load_bank(self):
-        # TODO set all column names to lower
-        df = pd.read_excel(self.filename, sheet_name=self.bank_sheet, index_col=None)
-        df["period"] = df["date"].apply(convert_date_string_to_period)
-        df["amount"] = df["amount"] * 100
-        df = df.astype({"amount": "int32"})
-        df.insert(0, "raw_id", range(0, 0 + len(df)))
-        self.bank = df
-        return
-
-    def load_coa(self):
-        df = pd.read_excel(self.filename, sheet_name=self.coa_sheet, index_col=None)
-        df["control_account"] = df["control_account"].map({"y": True, "n": False})
-        df["bank_account"] = df["bank_account"].map({"y": True, "n": False})
-        self.coa = df
-        return
-
-    def load_sales_invoice_headers(self):
-        df = pd.read_excel(self.filename, sheet_name=self.si_headers_sheet, index_col=None)
-        df["period"] = df["date"].apply(convert_date_string_to_period)
-        self.sales_invoice_headers = df
-        return
-
-    def load_sales_invoice_lines(self):
-        df = pd.read_excel(self.filename, sheet_name=self.si_lines_sheet, index_col=None)
-        df["period"] = df["transaction_date"].apply(convert_date_string_to_period)
-        df["amount"] = df["amount"] * 100
-        df = df.astype({"amount": "int32"})
-        df.insert(0, "line_id", range(0, 0 + len(df)))
-        self.sales_invoice_lines = df
-        return
-
-    def load_gl_journal_headers(self):
-        df = pd.read_excel(self.filename, sheet_name=self.gl_jnl_headers_sheet, index_col=None)
-        df["period"] = df["transaction_date"].apply(convert_date_string_to_period)
-        self.gl_journal_headers = df
-        return
-
-    def load_gl_journal_lines(self):
-        df = pd.read_excel(self.filename, sheet_name=self.gl_jnl_lines_sheet, index_col=None)
-        df["amount"] = df["amount"] * 100
-        df = df.astype({"amount": "int32"})
-        df.insert(0, "line_id", range(0, 0 + len(df)))
-        self.gl_journal_lines = df
-        return
-
-
 class SourceDataParser:
     def register_source_data(
         self, bank, coa, sales_invoice_headers, sales_invoice_lines, gl_journal_headers, gl_journal_lines
@@ -161,23 +99,37 @@ class SourceDataParser:
         return
 
     def get_bank_transactions(self) -> List[RawBankTransaction]:
-        # TODO strip this out as a util manipulation
-        matched = self.bank[["creditor", "debtor", "bs"]].copy()
-        matched_dict = {}
-        for index, line in matched.to_dict("index").items():
-            for matched_type, matched_account in line.items():
-                if isinstance(matched_account, str):
-                    matched_dict[index] = [matched_account, matched_type.lower()]
-
-        matched = pd.DataFrame.from_dict(matched_dict, orient="index", columns=["matched_account", "matched_type"])
-
-        df = self.bank[["date", "transaction_type", "description", "amount", "transfer_type", "raw_id", "bank_code"]]
-        df = df.join(matched)
+        df = self.bank_transactions_frame(self.bank)
         lines = []
         for transaction in df.to_dict("records"):
             lines.append(RawBankTransaction(**transaction))
         return lines
 
+    @staticmethod
+    def bank_transactions_frame(bank: pd.DataFrame) -> pd.DataFrame:
+        """Bank sheet rows with a column per RawBankTransaction field.
+
+        The matched account is the last of the creditor, debtor and bs columns holding text, and the matched
+        type the name of that column.
+        """
+        matched_account = pd.Series(np.nan, index=bank.index, dtype=object)
+        matched_type = pd.Series(np.nan, index=bank.index, dtype=object)
+        for column in ("creditor", "debtor", "bs"):
+            values = bank[column]
+            if values.dtype != object:
+                # No text, e.g. a column left empty in this period
+                continue
+            if pd.api.types.infer_dtype(values, skipna=True) == "string":
+                is_text = values.notna()
+            else:
+                # Text mixed with numbers, e.g. codes entered as numbers in some rows
+                is_text = values.notna() & pd.to_numeric(values, errors="coerce").isna()
+            matched_account = matched_account.mask(is_text, values)
+            matched_type = matched_type.mask(is_text, column)
+
+        df = bank[["date", "transaction_type", "description", "amount", "transfer_type", "raw_id", "bank_code"]]
+        return df.assign(matched_account=matched_account, matched_type=matched_type)
+
     def get_settled_purchase_invoices(self) -> List[Tuple[NewPurchaseInvoice, NewPurchaseLedgerPayment]]:
         df = self.bank[["raw_id", "date", "amount", "creditor", "pl", "notes", "bank_code"]]
         df = df.loc[(df["creditor"].notnull()) & (df["pl"].notnull())]
@@ -225,14 +177,22 @@ class SourceDataParser:
         receipts = [NewSalesLedgerReceipt(**x) for x in df.to_dict("record")]
         return receipts
 
+    @staticmethod
+    def lines_by_header(lines: pd.DataFrame, header_ids: pd.Series) -> Dict[int, List[dict]]:
+        """Records of lines of header_ids grouped by header_id in a single pass, keeping their order in each header."""
+        grouped: Dict[int, List[dict]] = {}
+        for line in lines.loc[lines["header_id"].isin(header_ids)].to_dict("records"):
+            grouped.setdefault(line["header_id"], []).append(line)
+        return grouped
+
     @property
     def sales_invoices(self) -> List[SalesInvoice]:
-        headers = self.sales_invoice_headers.to_dict("record")
-        all_lines = self.sales_invoice_lines.to_dict("record")
+        headers = self.sales_invoice_headers.to_dict("records")
+        lines_by_header = self.lines_by_header(self.sales_invoice_lines, self.sales_invoice_headers["id"])
 
         invoices = []
         for header in headers:
-            raw_lines = [x for x in all_lines if x["header_id"] == header["id"]]
+            raw_lines = lines_by_header.get(header["id"], [])
             lines = []
             for raw_line in raw_lines:
                 lines.append(
@@ -246,12 +206,12 @@ class SourceDataParser:
 
     @property
     def gl_journals(self) -> List[GLJournal]:
-        headers = self.gl_journal_headers.to_dict("record")
-        all_lines = self.gl_journal_lines.to_dict("record")
+        headers = self.gl_journal_headers.to_dict("records")
+        lines_by_header = self.lines_by_header(self.gl_journal_lines, self.gl_journal_headers["id"])
 
         invoices = []
         for header in headers:
-            raw_lines = [x for x in all_lines if x["header_id"] == header["id"]]
+            raw_lines = lines_by_header.get(header["id"], [])
             transaction_date = header["transaction_date"]
             lines = []
             for raw_line in raw_lines:
@@ -273,358 +233,741 @@ class SourceDataParser:
 
 
 class InterLedgerJournalCreator:
-    def create_pl_to_gl_journals(self, invoices: List[PurchaseInvoice]) -> List[Tuple[GLJournal, List[int]]]:
-        output = []
-        total = sum(x.total for x in invoices)
-        transaction_date = max(line.transaction_date for invoice in invoices for line in invoice.lines)
-        transaction_ids = []
-        gl_lines = [
-            GLJournalLine(
-                nominal="purchase_ledger_control_account",
-                description="PL dispersal to GL",
-                amount=-total,
-            )
-        ]
-        for invoice in invoices:
-            for line in invoice.lines:
-                gl_line = GLJournalLine(
-                    nominal=line.nominal,
-                    description=line.description,
-                    amount=line.amount,
-                )
-                gl_lines.append(gl_line)
-                transaction_ids.extend(invoice.transaction_ids)
-
-        journal = GLJournal(jnl_type="pi", lines=gl_lines, transaction_date=transaction_date)
-        output.append((journal, transaction_ids))
-        return output
-
-    # TODO DRY see create_pl_to_gl_journals
-    def create_sl_to_gl_journals(self, invoices: List[PurchaseInvoice]) -> List[GLJournal]:
-        total = sum(x.total for x in invoices)
-        transaction_date = max(line.transaction_date for invoice in invoices for line in invoice.lines)
-        gl_lines = [
-            GLJournalLine(
-                nominal="sales_ledger_control_account",
-                description="SL dispersal to GL",
-                amount=-total,
-            )
-        ]
-        for invoice in invoices:
-            for line in invoice.lines:
-                gl_line = GLJournalLine(
-                    nominal=line.nominal,
-                    description=line.description,
-                    amount=line.amount,
-                )
-                gl_lines.append(gl_line)
-
-        journal = GLJournal(jnl_type="si", lines=gl_lines, transaction_date=transaction_date)
+    """Adapters for a DispersalEngine, from undispersed ledger transactions to General Ledger journal lines.
+
+    Line amounts keep the sign of the source ledger; dispersals are configured as reversed.
+    """
+
+    line_columns = ["journal", "jnl_type", "transaction_date", "nominal", "description", "amount", "source_id"]
+    bank_contra_accounts = {
+        "creditor": "purchase_ledger_control_account",
+        "debtor": "sales_ledger_control_account",
+        "bs": "bank_contra",
+    }
+
+    def _invoice_lines(
+        self, df: pd.DataFrame, entry_type: str, jnl_type: str, control_account: str, description: str
+    ) -> pd.DataFrame:
+        """One journal of all invoices in df, dated at the latest invoice, balanced by a control account line."""
+        invoices = df.loc[df["entry_type"] == entry_type]
+        if invoices.shape[0] == 0:
+            return pd.DataFrame(columns=self.line_columns)
+        lines = pd.DataFrame(
+            {
+                "journal": 0,
+                "jnl_type": jnl_type,
+                "transaction_date": invoices["date"].max(),
+                "nominal": invoices["pl"].astype(object),
+                "description": invoices["notes"],
+                "amount": invoices["amount"],
+                "source_id": invoices["transaction_id"],
+            }
+        )
+        # Control line first, with no single source transaction
+        control = lines.iloc[:1].assign(
+            nominal=control_account, description=description, amount=-lines["amount"].sum(), source_id=None
+        )
+        return pd.concat([control, lines], ignore_index=True)[self.line_columns]
 
-        return [journal]
+    def pl_to_gl_lines(self, df: pd.DataFrame) -> pd.DataFrame:
+        return self._invoice_lines(
+            df, "purchase_invoice", "pi", "purchase_ledger_control_account", "PL dispersal to GL"
+        )
 
-    def create_bank_to_gl_journals(self, transactions: BankTransaction) -> List[GLJournal]:
-        df = pd.DataFrame([asdict(x) for x in transactions])
-        dates_df = (
-            df[["bank_code", "matched_type", "date"]].copy().groupby(["bank_code", "matched_type"]).max().reset_index()
+    def sl_to_gl_lines(self, df: pd.DataFrame) -> pd.DataFrame:
+        return self._invoice_lines(df, "sale_invoice", "si", "sales_ledger_control_account", "SL dispersal to GL")
+
+    def bank_to_gl_lines(self, df: pd.DataFrame) -> pd.DataFrame:
+        """One journal per bank code and matched type, dated at its latest transaction."""
+        df = df.loc[df["matched_type"].isin(list(self.bank_contra_accounts))]
+        df = df.astype({"bank_code": object, "matched_type": object})
+        groups = df.groupby(["bank_code", "matched_type"])
+        contra_account = df["matched_type"].map(self.bank_contra_accounts)
+        bank_lines = pd.DataFrame(
+            {
+                "journal": groups.ngroup(),
+                "jnl_type": "bank",
+                "transaction_date": groups["date"].transform("max"),
+                "nominal": df["bank_code"],
+                "description": df["bank_code"] + " to " + contra_account,
+                "amount": df["amount"],
+                "source_id": df["transaction_id"],
+            }
         )
-        df = df[["bank_code", "matched_type", "amount"]].groupby(["bank_code", "matched_type"]).sum().reset_index()
+        contra_lines = bank_lines.assign(nominal=contra_account, amount=-df["amount"])
+        # Each transaction's bank line followed by its contra line
+        lines = pd.concat([bank_lines, contra_lines]).sort_index(kind="stable")
+        return lines.reset_index(drop=True)[self.line_columns]
 
-        df = pd.merge(df, dates_df, how="left", on=["bank_code", "matched_type"]).reset_index()
 
-        lookup = {
-            "creditor": "purchase_ledger_control_account",
-            "debtor": "sales_ledger_control_account",
-            "bs": "bank_contra",
-        }
-        journals = []
-        for line in df.to_dict("record"):
-            bank_code = line["bank_code"]
-            amount = -line["amount"]
-            gl_account = lookup[line["matched_type"]]
-            transcation_date = line["date"]
-            description = f"{bank_code} to {gl_account}"
-
-            gl_lines = [
-                GLJournalLine(
-                    nominal=bank_code,
-                    description=description,
-                    amount=amount,
-                ),
-                GLJournalLine(
-                    nominal=gl_account,
-                    description=description,
-                    amount=-amount,
-                ),
+class PeriodPartitions:
+    """Rows of a source frame split by period in a single pass, so each period is read without a rescan.
+
+    Rows are split by the frame's period column, or by periods, a series aligned to the frame. Rows with a
+    missing period are in no partition.
+    """
+
+    def __init__(self, df: pd.DataFrame, periods: Optional[pd.Series] = None) -> None:
+        self._empty = df.iloc[:0]
+        periods = df["period"] if periods is None else periods
+        self._partitions = {int(period): part for period, part in df.groupby(periods, sort=False)}
+        return
+
+    def __getitem__(self, period: int) -> pd.DataFrame:
+        return self._partitions.get(period, self._empty)
+
+
+def journal_line_periods(lines: pd.DataFrame, headers: pd.DataFrame) -> pd.Series:
+    """Period of each journal line, that of its header. Missing for lines without a header."""
+    header_periods = headers.drop_duplicates("id").set_index("id")["period"]
+    return lines["header_id"].map(header_periods)
+
+
+@dataclass
+class ParsedPeriod:
+    """Everything posted for a period, built from its source data before any of it is posted."""
+
+    period: int
+    nominals: List[NewNominal]
+    bank_transactions: pd.DataFrame
+    settled_purchase_invoices: List[Tuple[NewPurchaseInvoice, NewPurchaseLedgerPayment]]
+    unmatched_payments: List[NewPurchaseLedgerPayment]
+    settled_sales_invoices: pd.DataFrame
+    unmatched_receipts: List[NewSalesLedgerReceipt]
+    sales_invoices: List[SalesInvoice]
+    gl_journals: List[GLJournal]
+
+
+class PeriodSourceData:
+    """Loaded source data split by period once, and parsed a period at a time.
+
+    Each period is parsed by its own SourceDataParser, so periods can be parsed away from the thread posting them.
+    """
+
+    def __init__(self, data_loader: SourceDataLoader) -> None:
+        self.coa = data_loader.coa
+        self.bank = PeriodPartitions(data_loader.bank)
+        self.sales_invoice_headers = PeriodPartitions(data_loader.sales_invoice_headers)
+        self.sales_invoice_lines = PeriodPartitions(data_loader.sales_invoice_lines)
+        self.gl_journal_headers = PeriodPartitions(data_loader.gl_journal_headers)
+        self.gl_journal_lines = PeriodPartitions(
+            data_loader.gl_journal_lines,
+            journal_line_periods(data_loader.gl_journal_lines, data_loader.gl_journal_headers),
+        )
+        return
+
+    def source_hash(self, period: int) -> str:
+        """Hash of the period's rows of each dataset, and of the chart of accounts every period is parsed with."""
+        return frames_fingerprint(
+            [
+                self.coa,
+                self.bank[period],
+                self.sales_invoice_headers[period],
+                self.sales_invoice_lines[period],
+                self.gl_journal_headers[period],
+                self.gl_journal_lines[period],
             ]
-            journal = GLJournal(jnl_type="bank", lines=gl_lines, transaction_date=transcation_date)
-            journals.append(journal)
-        return journals
-
-
-def filter_by_period(df: pd.DataFrame, period: int) -> pd.DataFrame:
-    data = df.copy()
-    data = data.loc[(df["period"] == period)]
-    return data
-
-
-def entity_loop(filename: str, entity_name: str):
-    data_loader = ExcelSourceDataLoader(
-        filename=filename,
-        bank_sheet="bank",
-        coa_sheet="coa",
-        si_headers_sheet="sales_invoice_headers",
-        si_lines_sheet="sales_invoice_lines",
-        gl_jnl_headers_sheet="gl_journal_headers",
-        gl_jnl_lines_sheet="gl_journal_lines",
-    )
-    parser = SourceDataParser()
-    bank_ledger = InMemoryBankLedgerTransactions()
-    bank = BankLedger(ledger=bank_ledger)
-    purchase_ledger = PurchaseLedger()
-    sales_ledger = SalesLedger()
-    general_ledger = GeneralLedgerTransactions()
-    general = GeneralLedger(ledger=general_ledger, chart_of_accounts=InMemoryChartOfAccounts())
-    inter_ledger_jnl_creator = InterLedgerJournalCreator()
-    dispersal_logger = DispersalsLogger()
-    report_writer = HTMLRawReportWriter(path="data/html", entity_name=entity_name)
-
-    print("Bookkeeping Demo")
-    print("Load source excel")
-    data_loader.load()
-
-    print("Configuring Dispersal Logger")
-    print("..bank")
-    dispersal_logger.register_ledger("bank", bank_ledger)
-
-    for period in range(1, 13):
-        print(f"\nCurrent Period: {period}")
-        period_bank = filter_by_period(data_loader.bank, period)
-        period_sales_invoice_headers = filter_by_period(data_loader.sales_invoice_headers, period)
-        period_sales_invoice_lines = filter_by_period(data_loader.sales_invoice_lines, period)
-        period_gl_journal_headers = filter_by_period(data_loader.gl_journal_headers, period)
-        # Passing all journal lines, as header is filtered and header <-> lines join will remove lines not in period
-        period_gl_journal_lines = data_loader.gl_journal_lines
+        )
 
+    def parse(self, period: int) -> ParsedPeriod:
+        parser = SourceDataParser()
         parser.register_source_data(
-            bank=period_bank,
-            coa=data_loader.coa,
-            sales_invoice_headers=period_sales_invoice_headers,
-            sales_invoice_lines=period_sales_invoice_lines,
-            gl_journal_headers=period_gl_journal_headers,
-            gl_journal_lines=period_gl_journal_lines,
+            bank=self.bank[period],
+            coa=self.coa,
+            sales_invoice_headers=self.sales_invoice_headers[period],
+            sales_invoice_lines=self.sales_invoice_lines[period],
+            gl_journal_headers=self.gl_journal_headers[period],
+            gl_journal_lines=self.gl_journal_lines[period],
+        )
+        return ParsedPeriod(
+            period=period,
+            nominals=parser.chart_of_accounts_config,
+            bank_transactions=parser.bank_transactions_frame(parser.bank),
+            settled_purchase_invoices=parser.get_settled_purchase_invoices(),
+            unmatched_payments=parser.get_unmatched_payments(),
+            settled_sales_invoices=parser.get_settled_sales_invoices(),
+            unmatched_receipts=parser.get_unmatched_receipts(),
+            sales_invoices=parser.sales_invoices,
+            gl_journals=parser.gl_journals,
         )
 
-        # Setup financials config
-        nominals = parser.chart_of_accounts_config
-        print("\nAdding nominal accounts to COA")
-        for nominal in nominals:
-            # TODO COA should have a method to check
-            if nominal.name in [x.name for x in general.chart_of_accounts.nominals]:
-                continue
-            print(f"..{nominal.name}")
-            general.chart_of_accounts.add_nominal(nominal)
-
-        bank_transactions = parser.get_bank_transactions()
-        gl_journals = parser.gl_journals
-        settled_sales_invoices = parser.get_settled_sales_invoices()
-        sales_invoices = parser.sales_invoices
-        unmatched_payments = parser.get_unmatched_payments()
-        unmatched_receipts = parser.get_unmatched_receipts()
-
-        if bank_transactions:
-            bank.ledger.add_transactions(bank_transactions)
-
-        # Settled Purchase Ledger Invoices
-        print("\nAdding settled invoices to Purchase Ledger")
-        settled_pl_invoices = parser.get_settled_purchase_invoices()
-        for invoice, payment in settled_pl_invoices:
-            # Assuming invoice is one line, payment is one line
-            print("..Adding invoices")
-            invoice_trans_ids = purchase_ledger.add_invoices([invoice])
-            print("....invoice_trans_ids", invoice_trans_ids)
-            print("..Adding corresponding payments")
-            payment_trans_ids = purchase_ledger.add_payments([payment])
-            print("....payment_trans_ids", payment_trans_ids)
-            allocation_ids = invoice_trans_ids + payment_trans_ids
-            print("..Allocating transactions", allocation_ids)
-            purchase_ledger.allocate_transactions(allocation_ids)
-
-        print("\nAdding unmatched payments to Purchase Ledger")
-        if unmatched_payments:
-            ids = purchase_ledger.add_payments(unmatched_payments)
-            print("..Purchase ledger ids:", ids)
-
-        sales_ledger.add_settled_transcations(settled_sales_invoices)
-        if unmatched_receipts:
-            sales_ledger.add_receipts(unmatched_receipts)
-        print("Adding Sales Ledger Invoices")
-        sales_ledger.add_invoices(sales_invoices)
-
-        print("\nDispersing Purchase Ledger invoice to General Ledger")
-        # TODO this needs to return List[Tuple[journals, purchase invoice ID]]
-        # Hmm bigger issue here is that there is no link from Purchase Invoice to PL transaction id.
-        pl_unposted_invoices = purchase_ledger.get_unposted_invoices()
-        if pl_unposted_invoices:
-            journals = inter_ledger_jnl_creator.create_pl_to_gl_journals(pl_unposted_invoices)
-            for journal, transaction_ids in journals:
-                print(f"..{journal.jnl_type}: {journal.total}")
-                ids = general.add_journal(journal)
-                print("....General ledger ids:", ids)
-                print("..marking extracted in Purchase Ledger", transaction_ids)
-                purchase_ledger.mark_extracted_to_gl(transaction_ids)
-
-        print("\nDispersing Sales Ledger invoice to General Ledger")
-        pl_unposted_invoices = sales_ledger.get_unposted_invoices()
-        if pl_unposted_invoices:
-            journals = inter_ledger_jnl_creator.create_sl_to_gl_journals(pl_unposted_invoices)
-            for journal in journals:
-                print(f"..{journal.jnl_type}: {journal.total}")
-                ids = general.add_journal(journal)
-                print("....General ledger ids:", ids)
-                print("..marking extracted in Purchase Ledger", ids)
-                # sales_ledger.mark_extracted_to_gl(ids)
-                # Hack - needs to only mark items that were just posted
-                sales_ledger.mark_all_posted()
-
-        print("\nDispersing Bank Ledger to General Ledger")
-        # TODO maybe this should only be bank to PL and SL + direct to GL, then from PL and SL to GL
-        bank_transactions = dispersal_logger.undispersed_transactions("bank")
 
-        if bank_transactions:
-            journals = inter_ledger_jnl_creator.create_bank_to_gl_journals(bank_transactions)
-            for journal in journals:
-                general.add_journal(journal)
+class _ProducerError:
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+        return
 
-            dispersal_logger.log_dispersal(name="bank", transactions=bank_transactions)    
 
-        print("\nPosting GL Journals")
-        for journal in gl_journals:
-            general.add_journal(journal)
+def prefetch(build: Callable[[T], R], keys: Iterable[T], max_pending: int = 1) -> Iterator[R]:
+    """Yield build(key) for each of keys in order, built in a background thread up to max_pending ahead.
 
-        # Validation
-        print("Running validation checks")
-        print("General Ledger sums to 0. Value:", general.ledger.balance, general.ledger.balance == 0)
-        assert general.ledger.balance == 0
-        # TODO each bank account sums to account on GL
+    Results are yielded in the order of keys whatever the timing of the thread. An error raised by build is
+    raised here when its result would have been yielded. With max_pending 0 each result is built when needed.
+    """
+    if max_pending <= 0:
+        for key in keys:
+            yield build(key)
+        return
 
-        print("\n")
-        print("Purchase Ledger Control Account agrees to Purchase Ledger")
-        try:
-            plca_value = general.ledger.balances["purchase_ledger_control_account"]
-        except KeyError:
-            plca_value = 0
-        print("PLCA value:", plca_value)
-        purchase_ledger_balance = purchase_ledger.balance
-        print("Purchase Ledger value:", purchase_ledger_balance)
-        assert plca_value == purchase_ledger_balance
-        print("\n")
+    results: queue.Queue = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        # Gives up once the consumer has stopped, so the thread never blocks on a full queue forever
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
         try:
-            slca_value = general.ledger.balances["sales_ledger_control_account"]
-        except KeyError:
-            slca_value = 0
-        print("SLCA value:", slca_value)
-        sales_ledger_balance = sales_ledger.balance
-        print("Sales Ledger value:", sales_ledger_balance)
-        assert slca_value == sales_ledger_balance
-
-        # TODO validate num raw transactions vs num bank ledger transactions
-    # Reporting
-    print("\nPublishing Report")
-    print("..Bank Ledger")
-    report_writer.write_bank_ledger(bank.ledger)
-    print("..General Ledger")
-    report_writer.write_general_ledger(general.ledger, general.chart_of_accounts)
-    print("..Purchase Ledger")
-    report_writer.write_purchase_ledger(purchase_ledger)
-    print("..Sales Ledger")
-    report_writer.write_sales_ledger(sales_ledger)
-
-    # Reporting again in standardised format
-    # TODO need something not Djano specific
-    print("\nPreparing Reporting Pack")
-    reporting_pack = []
-    print("..nominals")
-    nominal_lookup = {}
-    for i, nominal in enumerate(general.chart_of_accounts.nominals):
-        store = {
-            "model": "dashboards.nominalaccount",  # TODO coupling
-            "pk": i + 1,
-            "fields": {
-                "name": nominal.name,
-                "expected_sign": nominal.expected_sign,
-                "is_control_account": nominal.control_account,
-                "is_bank_account": nominal.bank_account,
-            },
-        }
-        nominal_lookup[nominal.name] = i + 1
-        reporting_pack.append(store)
-
-    print("..period balances")
-    # TODO needs pre processing for nominals that have empty period
-    # This is completely made up data
-    pk = 1
-    for nominal in general.chart_of_accounts.nominals:
-        for tmp_period in range(1, period + 1):
-            store = {
-                "model": "dashboards.periodbalance",
-                "pk": pk,
-                "fields": {
-                    "nominal": nominal_lookup[nominal.name],
-                    "period": tmp_period,
-                    "amount": 999,
-                    "amount_cumulative": 123,
-                    "count_transactions": 0,
-                },
-            }
-            reporting_pack.append(store)
-            pk += 1
-
-    print("..nominal transactions")
-    for transaction in general.ledger.list_transactions():
-        store = {
-            "model": "dashboards.nominaltransaction",
-            "pk": transaction.transaction_id,
-            "fields": {
-                "transaction_id": transaction.transaction_id,
-                "journal_id": transaction.jnl_id,
-                "date_transaction": str(transaction.transaction_date)[:10],
-                "period": transaction.period,
-                "nominal": nominal_lookup[transaction.nominal],
-                "amount": transaction.amount,
-                "description": transaction.description,
-            },
-        }
-        reporting_pack.append(store)
-
-    print("Saving to file")
-    with open("data/reporting_pack.json", "w") as f:
-        f.write(json.dumps(reporting_pack))
+            for key in keys:
+                if not put(build(key)):
+                    return
+        except BaseException as error:
+            put(_ProducerError(error))
+            return
+        put(done)
+        return
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            if isinstance(item, _ProducerError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+    return
+
+
+def entity_loop(
+    filename: str,
+    entity_name: str,
+    database: Optional[str] = None,
+    state_path: Optional[str] = None,
+    checkpoint_every: int = 1,
+    cache_path: Optional[str] = None,
+    calendar: Optional[FiscalCalendar] = None,
+    output_path: str = "data",
+    prefetch_periods: int = 1,
+    quiet: bool = False,
+):
+    """Process each period of calendar, by default the calendar months of 2021, from entity source data.
+
+    Reports are written under output_path, with the time taken by each stage of each period and counts of what it
+    handled written to runs/<entity_name>_<start time>.json there. Progress is printed unless quiet.
+
+    Up to prefetch_periods periods are parsed ahead in a background thread while a period is posted. Periods are
+    still posted in order, so ledgers are the same as with prefetch_periods 0, which parses each period in turn.
+
+    If database is given ledgers are stored in that SQLite file rather than in memory. ValueError is raised if it
+    already holds ledgers, unless resuming from the state_path of the run that wrote them.
+
+    If state_path is given every ledger operation is logged there, with a checkpoint of all ledgers every
+    checkpoint_every periods. A later run with the same state_path resumes after the last completed period, or
+    from the first period whose source data has changed since it was completed, with ledgers rewound to the end of
+    the period before it.
+
+    filename is an .xlsx cashbook, or a folder holding a .csv or .parquet file per sheet. Its rows with a blank
+    date are skipped, and counted in the load stage.
+
+    If cache_path is given prepared source data is cached there, and reused while the cashbook is unchanged.
+    """
+    instrumentation = Instrumentation(quiet=quiet)
+    calendar = DEFAULT_CALENDAR if calendar is None else calendar
+    start_period = 1
+    error = None
+    recovery = None
+    try:
+        data_loader = source_loader_class(filename)(
+            filename=filename,
+            bank_sheet="bank",
+            coa_sheet="coa",
+            si_headers_sheet="sales_invoice_headers",
+            si_lines_sheet="sales_invoice_lines",
+            gl_jnl_headers_sheet="gl_journal_headers",
+            gl_jnl_lines_sheet="gl_journal_lines",
+            cache=None if cache_path is None else SourceDataCache(cache_path),
+            calendar=calendar,
+        )
+        if database is None:
+            bank_ledger = InMemoryBankLedgerTransactions()
+            purchase_ledger = PurchaseLedger()
+            sales_ledger = SalesLedger()
+            general_ledger = GeneralLedgerTransactions(calendar=calendar)
+        else:
+            bank_ledger = SQLiteBankLedgerTransactions(database)
+            purchase_ledger = SQLitePurchaseLedger(database)
+            sales_ledger = SQLiteSalesLedger(database)
+            general_ledger = SQLiteGeneralLedgerTransactions(database, calendar=calendar)
+        chart_of_accounts = InMemoryChartOfAccounts()
+        dispersal_logger = DispersalsLogger()
+
+        if state_path is not None:
+            recovery = RecoveryManager(os.path.join(state_path, entity_name), checkpoint_every=checkpoint_every)
+            bank_ledger = recovery.register("bank_ledger", bank_ledger, ["add_transactions"])
+            purchase_ledger = recovery.register(
+                "purchase_ledger",
+                purchase_ledger,
+                ["add_invoices", "add_payments", "allocate_transactions", "mark_extracted_to_gl"],
+            )
+            sales_ledger = recovery.register(
+                "sales_ledger",
+                sales_ledger,
+                ["add_settled_transcations", "add_receipts", "add_invoices", "mark_extracted_to_gl"],
+            )
+            recovery.register("general_ledger", general_ledger)
+            chart_of_accounts = recovery.register("chart_of_accounts", chart_of_accounts, ["add_nominal"])
+            # Dispersal logs are written as recorded, so checkpoints do not grow with their history
+            dispersal_logger = DispersalsLogger(logs_filename=os.path.join(recovery.path, "dispersal_logs.jsonl"))
+            dispersal_logger = recovery.register("dispersal_logger", dispersal_logger, ["record"])
+
+        # Tables are not scoped by entity, so only a run resuming from its own state may find rows already there
+        resuming = recovery is not None and len(recovery.list_checkpoints()) > 0
+        ledgers = [bank_ledger, purchase_ledger, sales_ledger, general_ledger]
+        if database is not None and not resuming and any(x.get_next_transaction_id() > 0 for x in ledgers):
+            raise ValueError(
+                f"Database {database} already holds ledgers, "
+                "use a new file or the state_path of the run that wrote them"
+            )
+
+        bank = BankLedger(ledger=bank_ledger)
+        general = GeneralLedger(ledger=general_ledger, chart_of_accounts=chart_of_accounts, calendar=calendar)
+        if recovery is not None:
+            general = recovery.register(
+                "general", general, ["add_journal", "add_journals", "add_journal_lines"], snapshot=False
+            )
+        inter_ledger_jnl_creator = InterLedgerJournalCreator()
+        report_writer = HTMLRawReportWriter(path=os.path.join(output_path, "html"), entity_name=entity_name)
+
+        instrumentation.log("Bookkeeping Demo")
+        instrumentation.log("Configuring Dispersal Logger")
+        dispersal_engine = DispersalEngine(dispersal_logger)
+        dispersal_engine.register_target("general_ledger", general)
+        # TODO maybe this should only be bank to PL and SL + direct to GL, then from PL and SL to GL
+        instrumentation.log("..purchase_ledger")
+        dispersal_logger.register_ledger("purchase_ledger", purchase_ledger)
+        dispersal_engine.register(
+            DispersalConfig(source="purchase_ledger", target="general_ledger", is_aggregated=False, is_reversed=True),
+            inter_ledger_jnl_creator.pl_to_gl_lines,
+            purchase_ledger.mark_extracted_to_gl,
+        )
+        instrumentation.log("..sales_ledger")
+        dispersal_logger.register_ledger("sales_ledger", sales_ledger)
+        dispersal_engine.register(
+            DispersalConfig(source="sales_ledger", target="general_ledger", is_aggregated=False, is_reversed=True),
+            inter_ledger_jnl_creator.sl_to_gl_lines,
+            sales_ledger.mark_extracted_to_gl,
+        )
+        instrumentation.log("..bank")
+        dispersal_logger.register_ledger("bank", bank_ledger)
+        dispersal_engine.register(
+            DispersalConfig(source="bank", target="general_ledger", is_aggregated=True, is_reversed=True),
+            inter_ledger_jnl_creator.bank_to_gl_lines,
+        )
 
+        instrumentation.log("Load source excel")
+        with instrumentation.stage("load") as counts:
+            data_loader.load()
+            # Each source frame split by period once, rather than filtered in full every period
+            source_data = PeriodSourceData(data_loader)
+            counts["from_cache"] = int(data_loader.loaded_from_cache)
+            for name in data_loader.datasets:
+                counts[f"{name}_rows"] = getattr(data_loader, name).shape[0]
+            for name, rows in data_loader.blank_date_rows.items():
+                if rows > 0:
+                    counts[f"{name}_blank_date_rows"] = rows
+
+        source_hashes: Dict[int, str] = {}
+        if recovery is not None:
+            with instrumentation.stage("recover") as counts:
+                source_hashes = {x: source_data.source_hash(x) for x in range(1, len(calendar) + 1)}
+                previous_sources = recovery.period_sources()
+                # Periods are replayed from the first whose source changed, or was not completed, since the last run
+                unchanged_until = 0
+                while unchanged_until < len(calendar):
+                    previous = previous_sources.get(unchanged_until + 1)
+                    if previous is None or previous["source_hash"] != source_hashes[unchanged_until + 1]:
+                        break
+                    unchanged_until += 1
+                if unchanged_until < max(previous_sources, default=0):
+                    instrumentation.log("Source data changed from period", unchanged_until + 1)
+                start_period = recovery.recover(until=unchanged_until) + 1
+                instrumentation.log("Recovered ledgers to end of period", start_period - 1)
+                for closed_period in range(1, start_period):
+                    general.ledger.freeze_period(closed_period)
+                counts["skipped_periods"] = start_period - 1
+            if start_period > 1:
+                seconds_saved = sum(previous_sources[x]["seconds"] for x in range(1, start_period))
+                instrumentation.log(f"Skipped periods 1 to {start_period - 1}, saving {seconds_saved:.1f}s")
+
+        def parse(period: int) -> ParsedPeriod:
+            with instrumentation.stage("parse", period) as counts:
+                parsed = source_data.parse(period)
+                counts["bank_rows"] = parsed.bank_transactions.shape[0]
+                counts["sales_invoices"] = len(parsed.sales_invoices)
+                counts["gl_journals"] = len(parsed.gl_journals)
+            return parsed
+
+        # The next period is parsed in a background thread while the current one is posted
+        periods = range(start_period, len(calendar) + 1)
+        period_started = time.perf_counter()
+        # Closed on leaving, so an error posting a period also stops the thread parsing ahead
+        with contextlib.closing(prefetch(parse, periods, max_pending=prefetch_periods)) as parsed_periods:
+            for parsed in parsed_periods:
+                period = parsed.period
+                instrumentation.log(f"\nCurrent Period: {period}")
+
+                with instrumentation.stage("post", period) as counts:
+                    # Setup financials config
+                    nominals = 0
+                    for nominal in parsed.nominals:
+                        # TODO COA should have a method to check
+                        if nominal.name in [x.name for x in general.chart_of_accounts.nominals]:
+                            continue
+                        general.chart_of_accounts.add_nominal(nominal)
+                        nominals += 1
+                    counts["nominals"] = nominals
+
+                    if parsed.bank_transactions.shape[0] > 0:
+                        bank.ledger.add_transactions(parsed.bank_transactions)
+                    counts["bank_transactions"] = parsed.bank_transactions.shape[0]
+
+                    # Settled Purchase Ledger Invoices, assuming invoice is one line, payment is one line
+                    for invoice, payment in parsed.settled_purchase_invoices:
+                        invoice_trans_ids = purchase_ledger.add_invoices([invoice])
+                        payment_trans_ids = purchase_ledger.add_payments([payment])
+                        purchase_ledger.allocate_transactions(invoice_trans_ids + payment_trans_ids)
+                    counts["settled_purchase_invoices"] = len(parsed.settled_purchase_invoices)
+
+                    if parsed.unmatched_payments:
+                        purchase_ledger.add_payments(parsed.unmatched_payments)
+                    counts["unmatched_payments"] = len(parsed.unmatched_payments)
+
+                    sales_ledger.add_settled_transcations(parsed.settled_sales_invoices)
+                    counts["settled_sales_invoices"] = len(parsed.settled_sales_invoices)
+                    if parsed.unmatched_receipts:
+                        sales_ledger.add_receipts(parsed.unmatched_receipts)
+                    counts["unmatched_receipts"] = len(parsed.unmatched_receipts)
+                    sales_ledger.add_invoices(parsed.sales_invoices)
+                    counts["sales_invoices"] = len(parsed.sales_invoices)
+
+                with instrumentation.stage("disperse", period) as counts:
+                    for log in dispersal_engine.run():
+                        source_count, target_count = f"{log.source}_transactions", f"{log.target}_lines"
+                        counts[source_count] = counts.get(source_count, 0) + len(log.source_ids)
+                        counts[target_count] = counts.get(target_count, 0) + len(log.target_ids)
+
+                with instrumentation.stage("post", period) as counts:
+                    general.add_journals(parsed.gl_journals)
+                    counts["gl_journals"] = len(parsed.gl_journals)
+
+                with instrumentation.stage("validate", period) as counts:
+                    # General Ledger sums to 0
+                    assert general.ledger.balance == 0, f"General Ledger sums to {general.ledger.balance}"
+                    # TODO each bank account sums to account on GL
+
+                    # Purchase Ledger Control Account agrees to Purchase Ledger
+                    try:
+                        plca_value = general.ledger.balances["purchase_ledger_control_account"]
+                    except KeyError:
+                        plca_value = 0
+                    purchase_ledger_balance = purchase_ledger.balance
+                    assert plca_value == purchase_ledger_balance, f"PLCA {plca_value}, PL {purchase_ledger_balance}"
+
+                    # Sales Ledger Control Account agrees to Sales Ledger
+                    try:
+                        slca_value = general.ledger.balances["sales_ledger_control_account"]
+                    except KeyError:
+                        slca_value = 0
+                    sales_ledger_balance = sales_ledger.balance
+                    assert slca_value == sales_ledger_balance, f"SLCA {slca_value}, SL {sales_ledger_balance}"
+                    counts["checks"] = 3
+
+                if recovery is not None:
+                    period_finished = time.perf_counter()
+                    recovery.commit_period(
+                        period, source_hash=source_hashes[period], seconds=period_finished - period_started
+                    )
+                    period_started = period_finished
+                general.ledger.freeze_period(period)
+                # TODO validate num raw transactions vs num bank ledger transactions
+
+        instrumentation.log("\nPublishing Report")
+        with instrumentation.stage("report") as counts:
+            report_writer.write_bank_ledger(bank.ledger)
+            report_writer.write_general_ledger(general.ledger, general.chart_of_accounts)
+            report_writer.write_purchase_ledger(purchase_ledger)
+            report_writer.write_sales_ledger(sales_ledger)
+
+            # Reporting again in standardised format
+            # TODO need something not Djano specific
+            reporting_pack = []
+            nominal_lookup = {}
+            for i, nominal in enumerate(general.chart_of_accounts.nominals):
+                store = {
+                    "model": "dashboards.nominalaccount",  # TODO coupling
+                    "pk": i + 1,
+                    "fields": {
+                        "name": nominal.name,
+                        "expected_sign": nominal.expected_sign,
+                        "is_control_account": nominal.control_account,
+                        "is_bank_account": nominal.bank_account,
+                    },
+                }
+                nominal_lookup[nominal.name] = i + 1
+                reporting_pack.append(store)
+            counts["nominals"] = len(nominal_lookup)
+
+            # TODO needs pre processing for nominals that have empty period
+            # This is completely made up data
+            pk = 1
+            for nominal in general.chart_of_accounts.nominals:
+                for tmp_period in range(1, len(calendar) + 1):
+                    store = {
+                        "model": "dashboards.periodbalance",
+                        "pk": pk,
+                        "fields": {
+                            "nominal": nominal_lookup[nominal.name],
+                            "period": tmp_period,
+                            "amount": 999,
+                            "amount_cumulative": 123,
+                            "count_transactions": 0,
+                        },
+                    }
+                    reporting_pack.append(store)
+                    pk += 1
+
+            transactions = general.ledger.list_transactions()
+            for transaction in transactions:
+                store = {
+                    "model": "dashboards.nominaltransaction",
+                    "pk": transaction.transaction_id,
+                    "fields": {
+                        "transaction_id": transaction.transaction_id,
+                        "journal_id": transaction.jnl_id,
+                        "date_transaction": str(transaction.transaction_date)[:10],
+                        "period": transaction.period,
+                        "nominal": nominal_lookup[transaction.nominal],
+                        "amount": transaction.amount,
+                        "description": transaction.description,
+                    },
+                }
+                reporting_pack.append(store)
+            counts["nominal_transactions"] = len(transactions)
+
+            with open(os.path.join(output_path, "reporting_pack.json"), "w") as f:
+                f.write(json.dumps(reporting_pack))
+            counts["reporting_pack_records"] = len(reporting_pack)
+    except Exception as exc:
+        error = traceback.format_exception_only(type(exc), exc)[-1].strip()
+        raise
+    finally:
+        if recovery is not None:
+            recovery.close()
+        # Written for failed runs too, with the stages completed before the error
+        instrumentation.write_json(
+            os.path.join(output_path, "runs", f"{entity_name}_{instrumentation.started:%Y%m%dT%H%M%S%f}.json"),
+            entity=entity_name,
+            cashbook=filename,
+            first_period=start_period,
+            last_period=len(calendar),
+            error=error,
+        )
     return
 
 
+def ingest_bank_sheet(
+    data_loader: SourceDataLoader, bank_ledger: BankLedgerTransactions, chunk_rows: int = 100_000
+) -> int:
+    """Add every row of the bank sheet to bank_ledger as one batch, reading and posting chunk_rows at a time.
+
+    Only one chunk of the sheet is held besides the ledger itself, for bank sheets too large to load whole.
+    Returns the number of rows added.
+    """
+    batch_id = bank_ledger.get_next_batch_id()
+    rows = 0
+    for chunk in data_loader.iter_bank_chunks(chunk_rows):
+        bank_ledger.add_transactions(SourceDataParser.bank_transactions_frame(chunk), batch_id=batch_id)
+        rows += chunk.shape[0]
+    return rows
+
+
 def get_entities_data(folder: str) -> List[EntityData]:
-    print("Identifying entity cashbooks")
     entities = []
     for cashbook in os.listdir(folder):
         # Skip open temp files
         if "~" in cashbook:
             continue
-        name = re.findall(r"cashbook_(.*).xlsx", cashbook)[0]
+        # Either a workbook or a folder of csv or parquet sheets
+        match = re.fullmatch(r"cashbook_(.*?)(\.xlsx)?", cashbook)
         filename = os.path.join(folder, cashbook)
+        if match is None or source_loader_class(filename) is None:
+            continue
+        name = match.group(1)
         entity = EntityData(name=name, cashbook=filename)
         entities.append(entity)
     return entities
 
 
-def main():
-    entities_data = get_entities_data("data/cashbooks")
-    for entity in entities_data:
-        print(f"\nProcessing Entity: {entity.name}")
-        entity_loop(filename=entity.cashbook, entity_name=entity.name)
+class QueueWriter(io.TextIOBase):
+    """Text stream putting each line written onto queue as (label, line)."""
+
+    def __init__(self, output_queue, label: str) -> None:
+        self.queue = output_queue
+        self.label = label
+        self._buffer = ""
+        return
+
+    def write(self, text: str) -> int:
+        *lines, self._buffer = (self._buffer + text).split("\n")
+        for line in lines:
+            self.queue.put((self.label, line))
+        return len(text)
+
+    def flush(self) -> None:
+        if self._buffer:
+            self.queue.put((self.label, self._buffer))
+            self._buffer = ""
+        return
+
+
+def run_entity(
+    entity: EntityData,
+    output_path: str,
+    cache_path: str,
+    output_queue,
+    quiet: bool = False,
+    calendar: Optional[FiscalCalendar] = None,
+) -> Optional[str]:
+    """Run entity_loop in a worker process, sending its output to output_queue. Returns the traceback if it failed."""
+    writer = QueueWriter(output_queue, entity.name)
+    try:
+        with contextlib.redirect_stdout(writer):
+            entity_loop(
+                filename=entity.cashbook,
+                entity_name=entity.name,
+                cache_path=cache_path,
+                output_path=output_path,
+                quiet=quiet,
+                calendar=calendar,
+            )
+    except Exception:
+        return traceback.format_exc()
+    finally:
+        writer.flush()
+    return None
+
+
+def run_entities_in_processes(
+    entities: List[EntityData],
+    output_path: str,
+    workers: int,
+    quiet: bool = False,
+    calendar: Optional[FiscalCalendar] = None,
+) -> Dict[str, Optional[str]]:
+    """Run entity_loop for each entity in a pool of worker processes, printing their output labelled by entity.
+
+    Each entity writes to its own folder of output_path and cache. A failed entity does not stop the others.
+    Returns the traceback of each entity, None for those that succeeded.
+    """
+    errors: Dict[str, Optional[str]] = {}
+    with multiprocessing.Manager() as manager:
+        output_queue = manager.Queue()
+        with ProcessPoolExecutor(max_workers=min(workers, len(entities))) as executor:
+            futures = {
+                executor.submit(
+                    run_entity,
+                    entity,
+                    os.path.join(output_path, "entities", entity.name),
+                    os.path.join(output_path, "cache", entity.name),
+                    output_queue,
+                    quiet,
+                    calendar,
+                ): entity.name
+                for entity in entities
+            }
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                print_queue(output_queue)
+                for future in done:
+                    try:
+                        errors[futures[future]] = future.result()
+                    except Exception:
+                        # e.g. the worker process died
+                        errors[futures[future]] = traceback.format_exc()
+        print_queue(output_queue)
+    return errors
+
+
+def print_queue(output_queue) -> None:
+    while not output_queue.empty():
+        label, line = output_queue.get()
+        print(f"[{label}] {line}")
     return
 
 
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Convert entity cashbooks to ledgers and reports.")
+    parser.add_argument("--cashbooks", default="data/cashbooks", help="folder of entity cashbooks")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="entities processed at once, each in its own process with output under data/entities/<entity>",
+    )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="print only failures, stage timings are still written to data/runs, or data/entities/<entity>/runs "
+        "with --workers",
+    )
+    parser.add_argument(
+        "--calendar-start",
+        default="2021-01",
+        help="first month of the fiscal year as YYYY-MM, each calendar month a period",
+    )
+    parser.add_argument("--years", type=int, default=1, help="fiscal years in the calendar")
+    args = parser.parse_args(argv)
+    try:
+        start = datetime.datetime.strptime(args.calendar_start, "%Y-%m")
+    except ValueError:
+        parser.error(f"--calendar-start {args.calendar_start} is not a month as YYYY-MM")
+    calendar = FiscalCalendar.monthly(start.year, start.month, years=args.years)
+
+    entities_data = get_entities_data(args.cashbooks)
+    if args.workers <= 1:
+        for entity in entities_data:
+            if not args.quiet:
+                print(f"\nProcessing Entity: {entity.name}")
+            entity_loop(
+                filename=entity.cashbook,
+                entity_name=entity.name,
+                cache_path="data/cache",
+                quiet=args.quiet,
+                calendar=calendar,
+            )
+        return 0
+
+    errors = run_entities_in_processes(entities_data, "data", args.workers, quiet=args.quiet, calendar=calendar)
+    failed = sorted(name for name, error in errors.items() if error is not None)
+    for name in failed:
+        print(f"\nEntity {name} failed:\n{errors[name]}")
+    if not args.quiet:
+        print(f"\nProcessed {len(errors) - len(failed)} of {len(errors)} entities")
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
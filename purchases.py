@@ -3,7 +3,7 @@ from typing import List
 
 import pandas as pd
 
-from ledger import PandasLedger
+from ledger import Ledger, PandasLedger, SQLiteLedger, empty_frame
 
 
 @dataclass
@@ -57,23 +57,22 @@ class NewPurchaseLedgerPayment:
     bank_code: str
 
 
-class PurchaseLedger(PandasLedger):
-    def __init__(self) -> None:
-        self.columns = [
-            "transaction_id",
-            "raw_id",
-            "batch_id",
-            "entry_type",
-            "creditor",
-            "date",
-            "amount",
-            "notes",
-            "gl_jnl",
-            "settled",
-            "pl",
-        ]
-        self.df = pd.DataFrame(columns=self.columns)
-        return
+class PurchaseLedgerMixin(Ledger):
+    """Schema and domain methods of the purchase ledger, shared by its pandas and SQLite storage."""
+
+    schema = {
+        "transaction_id": "int64",
+        "raw_id": "int64",
+        "batch_id": "int64",
+        "entry_type": "category",
+        "creditor": "category",
+        "date": "datetime64[ns]",
+        "amount": "int64",
+        "notes": "object",
+        "gl_jnl": "bool",
+        "settled": "bool",
+        "pl": "category",
+    }
 
     def add_invoices(self, invoices: List[NewPurchaseInvoice]) -> List[int]:
         batch_id = self.get_next_batch_id()
@@ -107,19 +106,16 @@ class PurchaseLedger(PandasLedger):
     def allocate_transactions(self, transaction_ids: List[int]) -> None:
         # TODO don't allow cross creditor allocation
         # TODO allocation transactions must sum to zero
-        df = self.df
-        df.loc[(df["transaction_id"].isin(transaction_ids)), "settled"] = True
+        self.update_transactions(transaction_ids, "settled", True)
         return
 
     def mark_extracted_to_gl(self, transaction_ids: List[int]) -> None:
-        df = self.df
         # TODO should be a reference back to the gl journal number rather than boolean
-        df.loc[(df["transaction_id"].isin(transaction_ids)), "gl_jnl"] = True
+        self.update_transactions(transaction_ids, "gl_jnl", True)
         return
 
     def get_unposted_invoices(self) -> List[PurchaseInvoice]:
-        df = self.df.copy()
-        df = df.loc[(df["gl_jnl"] == False) & (df["entry_type"] == "purchase_invoice")]
+        df = self.select(gl_jnl=False, entry_type="purchase_invoice")
         invoices = []
         for invoice in df.to_dict("records"):
             credtior = invoice["creditor"]
@@ -143,6 +139,17 @@ class PurchaseLedger(PandasLedger):
             invoices.append(purchase_invoice)
         return invoices
 
+
+class PurchaseLedger(PurchaseLedgerMixin, PandasLedger):
+    def __init__(self) -> None:
+        self.columns = list(self.schema)
+        self.df = empty_frame(self.schema)
+        return
+
     @property
     def balance(self) -> int:
         return self.df["amount"].sum()
+
+
+class SQLitePurchaseLedger(SQLiteLedger, PurchaseLedgerMixin):
+    table = "purchase_ledger"
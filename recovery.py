@@ -0,0 +1,256 @@
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import json
+import os
+import pickle
+import shutil
+import struct
+
+COMMIT = "__commit__"
+
+
+@dataclass
+class LogRecord:
+    component: str
+    method: str
+    args: Tuple
+    kwargs: Dict[str, Any]
+
+
+@dataclass
+class Checkpoint:
+    period: int
+    path: str
+    log_offset: int
+
+
+class JournalLog:
+    """Append-only log of ledger operations. Each record is a length prefixed pickle."""
+
+    header = struct.Struct("<I")
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self._file = open(filename, "ab")
+        return
+
+    @property
+    def offset(self) -> int:
+        return self._file.tell()
+
+    @staticmethod
+    def dumps(record: LogRecord) -> bytes:
+        return pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def append(self, record: LogRecord, sync: bool = False) -> None:
+        self.write(self.dumps(record), sync)
+        return
+
+    def write(self, data: bytes, sync: bool = False) -> None:
+        """Write a record already serialised with dumps."""
+        self._file.write(self.header.pack(len(data)) + data)
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+        return
+
+    def read(self, start: int = 0) -> Iterator[Tuple[int, LogRecord]]:
+        """Yield (offset after record, record) from start, stopping at a partly written final record."""
+        with open(self.filename, "rb") as f:
+            f.seek(start)
+            while True:
+                header = f.read(self.header.size)
+                if len(header) < self.header.size:
+                    return
+                (length,) = self.header.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    return
+                yield f.tell(), pickle.loads(data)
+
+    def truncate(self, offset: int) -> None:
+        self._file.truncate(offset)
+        self._file.seek(offset)
+        return
+
+    def close(self) -> None:
+        self._file.close()
+        return
+
+
+class LoggedComponent:
+    """Proxy for a component which writes calls of the listed methods to a JournalLog once they succeed."""
+
+    def __init__(self, name: str, component: Any, methods: List[str], log: JournalLog) -> None:
+        self._name = name
+        self._component = component
+        self._methods = methods
+        self._log = log
+        return
+
+    def __getattr__(self, attribute: str) -> Any:
+        value = getattr(self._component, attribute)
+        if attribute not in self._methods:
+            return value
+
+        def logged(*args, **kwargs):
+            # Serialised before the call in case it modifies its arguments
+            data = self._log.dumps(LogRecord(self._name, attribute, args, kwargs))
+            result = value(*args, **kwargs)
+            self._log.write(data)
+            return result
+
+        return logged
+
+
+class RecoveryManager:
+    """Logs every operation on registered components and checkpoints them at period ends.
+
+    After a crash, recover restores the last checkpoint and replays the log up to the last completed
+    period, so processing can continue from the period after it. recover can also rewind to an earlier
+    period, for instance the one before the first whose source data has changed.
+    """
+
+    def __init__(self, path: str, checkpoint_every: int = 1) -> None:
+        self.path = path
+        self.checkpoints_path = os.path.join(path, "checkpoints")
+        self.checkpoint_every = checkpoint_every
+        os.makedirs(self.checkpoints_path, exist_ok=True)
+        self.log = JournalLog(os.path.join(path, "journal.log"))
+        self._components: Dict[str, Any] = {}
+        self._snapshots: Dict[str, Any] = {}
+        return
+
+    def close(self) -> None:
+        """Close the log, after which registered components can no longer be called."""
+        self.log.close()
+        return
+
+    def register(self, name: str, component: Any, methods: Optional[List[str]] = None, snapshot: bool = True):
+        """Register component, returning a proxy which logs calls to methods.
+
+        If snapshot, component is checkpointed with its save_snapshot and load_snapshot methods.
+        """
+        self._components[name] = component
+        if snapshot:
+            self._snapshots[name] = component
+        if not methods:
+            return component
+        return LoggedComponent(name, component, methods, self.log)
+
+    def commit_period(self, period: int, source_hash: Optional[str] = None, seconds: float = 0.0) -> None:
+        """Mark period complete, checkpointing every checkpoint_every periods.
+
+        source_hash of the period's source data and the seconds it took are kept for period_sources.
+        """
+        self.log.append(LogRecord(COMMIT, "commit_period", (period,), {}), sync=True)
+        if period % self.checkpoint_every == 0:
+            self.checkpoint(period)
+        sources = self.period_sources()
+        sources[period] = {"source_hash": source_hash, "seconds": seconds}
+        self._write_period_sources(sources)
+        return
+
+    @property
+    def _period_sources_filename(self) -> str:
+        return os.path.join(self.path, "periods.json")
+
+    def period_sources(self) -> Dict[int, Dict[str, Any]]:
+        """Source hash and seconds taken of each committed period, as given to commit_period.
+
+        Written after the commit, so a crash may leave a committed period missing.
+        """
+        if os.path.exists(self._period_sources_filename) is False:
+            return {}
+        with open(self._period_sources_filename, "r") as f:
+            return {int(period): source for period, source in json.load(f).items()}
+
+    def _write_period_sources(self, sources: Dict[int, Dict[str, Any]]) -> None:
+        tmp_filename = self._period_sources_filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump({str(period): source for period, source in sorted(sources.items())}, f)
+        os.replace(tmp_filename, self._period_sources_filename)
+        return
+
+    def _checkpoint_path(self, period: int) -> str:
+        return os.path.join(self.checkpoints_path, f"period_{period:03d}")
+
+    def checkpoint(self, period: int) -> Checkpoint:
+        path = self._checkpoint_path(period)
+        # Written to a temporary folder and renamed, so a crash never leaves a partial checkpoint
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, component in self._snapshots.items():
+            component.save_snapshot(os.path.join(tmp_path, name))
+        checkpoint = Checkpoint(period=period, path=path, log_offset=self.log.offset)
+        with open(os.path.join(tmp_path, "checkpoint.json"), "w") as f:
+            json.dump({"period": period, "log_offset": checkpoint.log_offset}, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        return checkpoint
+
+    def list_checkpoints(self) -> List[Checkpoint]:
+        checkpoints = []
+        for folder in sorted(os.listdir(self.checkpoints_path)):
+            meta_filename = os.path.join(self.checkpoints_path, folder, "checkpoint.json")
+            if folder.endswith(".tmp") or os.path.exists(meta_filename) is False:
+                continue
+            with open(meta_filename, "r") as f:
+                meta = json.load(f)
+            checkpoints.append(
+                Checkpoint(
+                    period=meta["period"],
+                    path=os.path.join(self.checkpoints_path, folder),
+                    log_offset=meta["log_offset"],
+                )
+            )
+        return checkpoints
+
+    def restore(self, checkpoint: Checkpoint) -> None:
+        for name, component in self._snapshots.items():
+            component.load_snapshot(os.path.join(checkpoint.path, name))
+        return
+
+    def recover(self, until: Optional[int] = None) -> int:
+        """Restore state at the end of the last completed period, returning that period, or 0 if none.
+
+        If until is given and earlier, state is restored at the end of period until instead, and checkpoints and
+        log records of later periods are discarded so they can be processed again.
+
+        The first recover of a state folder checkpoints components as period 0, so the log is only ever replayed
+        onto restored state, never onto rows an earlier crashed run left behind, e.g. in a database.
+        """
+        if not self.list_checkpoints() and os.path.getsize(self.log.filename) == 0:
+            self.checkpoint(0)
+        checkpoints = [x for x in self.list_checkpoints() if until is None or x.period <= until]
+        period, log_offset = 0, 0
+        if checkpoints:
+            checkpoint = checkpoints[-1]
+            self.restore(checkpoint)
+            period, log_offset = checkpoint.period, checkpoint.log_offset
+
+        # Replay records a period at a time, so operations of an incomplete period are never applied
+        pending: List[LogRecord] = []
+        for offset, record in self.log.read(log_offset):
+            if record.component != COMMIT:
+                pending.append(record)
+                continue
+            (committed,) = record.args
+            if until is not None and committed > until:
+                break
+            for pending_record in pending:
+                component = self._components[pending_record.component]
+                getattr(component, pending_record.method)(*pending_record.args, **pending_record.kwargs)
+            pending = []
+            period = committed
+            log_offset = offset
+        self.log.truncate(log_offset)
+
+        for checkpoint in self.list_checkpoints():
+            if checkpoint.period > period:
+                shutil.rmtree(checkpoint.path)
+        sources = self.period_sources()
+        if any(x > period for x in sources):
+            self._write_period_sources({x: source for x, source in sources.items() if x <= period})
+        return period
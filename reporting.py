@@ -7,7 +7,7 @@ from typing import List
 import pandas as pd
 
 from bank import BankLedgerTransactions
-from general import ChartOfAccounts, GeneralLedgerTransactions
+from general import ChartOfAccounts, GeneralLedgerTransactionsMixin
 
 
 @dataclass
@@ -226,7 +226,7 @@ class RawReportWriter(ABC):
         """"""
 
     @abstractmethod
-    def write_general_ledger(self, ledger: GeneralLedgerTransactions):
+    def write_general_ledger(self, ledger: GeneralLedgerTransactionsMixin):
         """"""
 
 
@@ -238,7 +238,7 @@ class CSVRawReportWriter(RawReportWriter):
         df.to_csv("ledger_transactions/bank_ledger.csv", index=False)
         return
 
-    def write_general_ledger(self, ledger: GeneralLedgerTransactions):
+    def write_general_ledger(self, ledger: GeneralLedgerTransactionsMixin):
         transactions = ledger.list_transactions()
         df = pd.DataFrame([asdict(x) for x in transactions])
         df = df[ledger.columns]
@@ -282,7 +282,7 @@ class HTMLRawReportWriter(RawReportWriter):
         df.to_html(os.path.join(self.ledgers_path, "sales_ledger.html"), index=False)
         return
 
-    def write_general_ledger(self, ledger: GeneralLedgerTransactions, coa: ChartOfAccounts):
+    def write_general_ledger(self, ledger: GeneralLedgerTransactionsMixin, coa: ChartOfAccounts):
         transactions = ledger.list_transactions()
         df = pd.DataFrame([asdict(x) for x in transactions])
         df = df[ledger.columns]
@@ -301,10 +301,12 @@ class HTMLRawReportWriter(RawReportWriter):
             os.path.join(self.path, "trial_balance.html"), index=False
         )
 
-        balances_period = df[["nominal", "period", "amount"]].groupby(["nominal", "period"]).sum()
-        balances_period = (
-            balances_period.reset_index().pivot(index="nominal", columns="period", values="amount").reset_index()
-        )
+        # One column per period, each summed from only that period's transactions
+        period_movements = {}
+        for period in ledger.periods:
+            period_df = ledger.select(period=period).astype({"nominal": str})
+            period_movements[period] = (period_df["amount"] / 100).groupby(period_df["nominal"]).sum()
+        balances_period = pd.DataFrame(period_movements).rename_axis(index="nominal", columns="period").reset_index()
         balances_period = balances_period.join(
             coa_df[["statement", "heading", "nominal"]].set_index("nominal"), on="nominal"
         )
@@ -320,7 +322,8 @@ class HTMLRawReportWriter(RawReportWriter):
 
         nominals = df["nominal"].unique()
         for nominal in nominals:
-            nominal_df = df.loc[(df["nominal"] == nominal)]
+            nominal_df = ledger.transactions_for(nominal)
+            nominal_df["amount"] = nominal_df["amount"] / 100
             nominal_df.to_html(os.path.join(self.nominals_path, f"{nominal}.html"), index=False)
 
         # Hack to add links to prebuilt to_html table
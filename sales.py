@@ -3,7 +3,7 @@ from typing import List
 
 import pandas as pd
 
-from ledger import PandasLedger
+from ledger import Ledger, PandasLedger, SQLiteLedger, empty_frame
 
 
 @dataclass
@@ -35,23 +35,22 @@ class NewSalesLedgerReceipt:
 
 
 # TODO parent calss for SalesLedger, PurchaseLedger
-class SalesLedger(PandasLedger):
-    def __init__(self) -> None:
-        self.columns = [
-            "transaction_id",
-            "raw_id",
-            "batch_id",
-            "entry_type",
-            "debtor",
-            "date",
-            "amount",
-            "notes",
-            "gl_jnl",
-            "settled",
-            "pl",
-        ]
-        self.df = pd.DataFrame(columns=self.columns)
-        return
+class SalesLedgerMixin(Ledger):
+    """Schema and domain methods of the sales ledger, shared by its pandas and SQLite storage."""
+
+    schema = {
+        "transaction_id": "int64",
+        "raw_id": "int64",
+        "batch_id": "int64",
+        "entry_type": "category",
+        "debtor": "category",
+        "date": "datetime64[ns]",
+        "amount": "int64",
+        "notes": "object",
+        "gl_jnl": "bool",
+        "settled": "bool",
+        "pl": "category",
+    }
 
     def add_settled_transcations(self, settled_invoices):
         bank_codes = settled_invoices["bank_code"].unique()
@@ -106,8 +105,7 @@ class SalesLedger(PandasLedger):
         return transaction_ids
 
     def get_unposted_invoices(self) -> List[SalesInvoice]:
-        df = self.df.copy()
-        df = df.loc[(df["gl_jnl"] == False) & (df["entry_type"] == "sale_invoice")]
+        df = self.select(gl_jnl=False, entry_type="sale_invoice")
         invoices = []
         for invoice in df.to_dict("records"):
             credtior = invoice["debtor"]
@@ -127,11 +125,21 @@ class SalesLedger(PandasLedger):
             invoices.append(purchase_invoice)
         return invoices
 
+    def mark_extracted_to_gl(self, transaction_ids: List[int]) -> None:
+        self.update_transactions(transaction_ids, "gl_jnl", True)
+        return
+
+
+class SalesLedger(SalesLedgerMixin, PandasLedger):
+    def __init__(self) -> None:
+        self.columns = list(self.schema)
+        self.df = empty_frame(self.schema)
+        return
+
     @property
     def balance(self) -> int:
         return self.df["amount"].sum()
 
-    # Temporary fix
-    def mark_all_posted(self) -> None:
-        self.df["gl_jnl"] = True
-        return
+
+class SQLiteSalesLedger(SQLiteLedger, SalesLedgerMixin):
+    table = "sales_ledger"
@@ -1,4 +1,9 @@
+from dataclasses import asdict
+import datetime
+
+import pandas as pd
 import pytest
+from pandas import Timestamp
 
 import bank
 
@@ -12,7 +17,7 @@ def raw_bank_transactions_clean():
             transfer_type="transfer_type",
             description="description",
             amount=100,
-            date="date",
+            date=datetime.datetime(2021, 1, 1),
             matched_account="matched_account",
             matched_type="matched_type",
             transaction_type="transaction_type",
@@ -46,7 +51,7 @@ def test_in_memory_bank_transactions_add_transaction_empty(raw_bank_transactions
             transaction_type="transaction_type",
             description="description",
             amount=100,
-            date="date",
+            date=Timestamp("2021-01-01 00:00:00"),
             matched_account="matched_account",
             matched_type="matched_type",
             transaction_id=0,
@@ -98,3 +103,39 @@ def test_in_memory_bank_transactions_batch_id(raw_bank_transactions_clean):
     ledger.add_transactions(raw_bank_transactions_clean)
     # Then two batch ids
     assert len(set([x.batch_id for x in ledger.list_transactions()])) == 2
+
+
+def test_in_memory_bank_transactions_add_frame(raw_bank_transactions_clean):
+    # Given an empty bank ledger and transactions as a frame, with a column not in the ledger
+    ledger = bank.InMemoryBankLedgerTransactions()
+    df = pd.DataFrame([asdict(x) for x in raw_bank_transactions_clean * 2]).assign(notes="notes")
+    # When adding the frame in chunks to one batch
+    batch_id = ledger.get_next_batch_id()
+    ledger.add_transactions(df.iloc[:1], batch_id=batch_id)
+    ledger.add_transactions(df.iloc[1:], batch_id=batch_id)
+    # Then same transactions as added as a list
+    expected = bank.InMemoryBankLedgerTransactions()
+    expected.add_transactions(raw_bank_transactions_clean * 2)
+    assert ledger.list_transactions() == expected.list_transactions()
+    # Then next batch after the shared batch
+    assert ledger.get_next_batch_id() == batch_id + 1
+
+
+def test_sqlite_bank_transactions_persisted(tmp_path, raw_bank_transactions_clean):
+    # Given a SQLite bank ledger with transactions
+    filename = str(tmp_path / "ledgers.db")
+    ledger = bank.SQLiteBankLedgerTransactions(filename)
+    ledger.add_transactions(raw_bank_transactions_clean)
+    ledger.add_transactions(raw_bank_transactions_clean)
+    # Then database in WAL mode
+    assert ledger.connection.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    # When reopening the database
+    reopened = bank.SQLiteBankLedgerTransactions(filename)
+    # Then same transactions as an in memory ledger
+    in_memory = bank.InMemoryBankLedgerTransactions()
+    in_memory.add_transactions(raw_bank_transactions_clean)
+    in_memory.add_transactions(raw_bank_transactions_clean)
+    assert reopened.list_transactions() == in_memory.list_transactions()
+    # Then ids continue after persisted transactions
+    assert reopened.get_next_transaction_id() == 2
+    assert reopened.get_next_batch_id() == 2
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import cache
+
+
+def write_source(filename: str, content: str) -> None:
+    with open(filename, "w") as f:
+        f.write(content)
+    return
+
+
+def test_source_data_cache(tmp_path):
+    # Given a cache and a source file
+    source_data_cache = cache.SourceDataCache(str(tmp_path / "cache"))
+    filename = str(tmp_path / "source.xlsx")
+    write_source(filename, "abc")
+    sheets = {"bank": "bank_sheet"}
+    df = pd.DataFrame({"amount": [1, 2], "notes": ["a", np.nan], "date": pd.to_datetime(["2021-01-01", "2021-01-02"])})
+    # Then nothing cached
+    assert source_data_cache.get(filename, sheets) is None
+    # When caching frames
+    assert source_data_cache.put(filename, sheets, {"bank": df})
+    # Then frames read back unchanged
+    pd.testing.assert_frame_equal(source_data_cache.get(filename, sheets)["bank"], df)
+    # Then frames from another sheet not returned
+    assert source_data_cache.get(filename, {"bank": "other_sheet"}) is None
+    # When the source changes
+    write_source(filename, "abd")
+    # Then nothing cached
+    assert source_data_cache.get(filename, sheets) is None
+
+
+def test_source_data_cache_evict(tmp_path):
+    # Given a cache holding entries for three sources, the second least recently used
+    source_data_cache = cache.SourceDataCache(str(tmp_path / "cache"))
+    df = pd.DataFrame({"amount": [1, 2]})
+    filenames = [str(tmp_path / f"source_{i}.xlsx") for i in range(3)]
+    for i, filename in enumerate(filenames):
+        write_source(filename, str(i))
+        source_data_cache.put(filename, {"bank": "bank"}, {"bank": df})
+    os.utime(os.path.join(source_data_cache._entry_path(filenames[1]), "meta.json"), (0, 0))
+    # When evicting down to the size of two entries
+    entry_size = sum(x.stat().st_size for x in os.scandir(source_data_cache._entry_path(filenames[0])))
+    source_data_cache.max_bytes = entry_size * 2
+    source_data_cache.evict()
+    # Then least recently used entry evicted
+    assert source_data_cache.get(filenames[1], {"bank": "bank"}) is None
+    assert source_data_cache.get(filenames[0], {"bank": "bank"}) is not None
+    assert source_data_cache.get(filenames[2], {"bank": "bank"}) is not None
+
+
+def test_source_data_cache_unsupported(tmp_path):
+    # Given a frame with a column mixing numbers and text
+    source_data_cache = cache.SourceDataCache(str(tmp_path / "cache"))
+    filename = str(tmp_path / "source.xlsx")
+    write_source(filename, "abc")
+    df = pd.DataFrame({"mixed": [1, "a"]})
+    # When caching
+    # Then not cached
+    assert source_data_cache.put(filename, {"bank": "bank"}, {"bank": df}) is False
+    assert source_data_cache.get(filename, {"bank": "bank"}) is None
+
+
+def test_file_fingerprint_folder(tmp_path):
+    # Given a folder of sheets
+    os.makedirs(tmp_path / "source")
+    write_source(str(tmp_path / "source" / "bank.csv"), "abc")
+    fingerprint = cache.file_fingerprint(str(tmp_path / "source"))
+    # When a sheet is renamed
+    os.rename(tmp_path / "source" / "bank.csv", tmp_path / "source" / "coa.csv")
+    # Then fingerprint changes
+    assert cache.file_fingerprint(str(tmp_path / "source")) != fingerprint
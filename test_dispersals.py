@@ -1,3 +1,5 @@
+import pandas as pd
+
 import dispersals
 
 
@@ -20,38 +22,176 @@ def test_dispersal_logger_undispersed_transactions_empty():
     logger.register_ledger(name="bank", ledger_transactions=dispersals.InMemoryTransactionLedger())
     # When getting undispersed transactions
     # Then no transactions
-    assert logger.undispersed_transactions(name="bank") == []
+    assert logger.undispersed_transactions(name="bank", target="gl").shape[0] == 0
 
 
 def test_dispersal_logger_undispersed_transactions():
     # Given a Dispersals logger with a registered ledger and a transactions ledger with transactions
     logger = dispersals.DispersalsLogger()
     ledger = dispersals.InMemoryTransactionLedger()
-    class Transaction:
-        def __init__(self, id):
-            self.transaction_id = id
-            return
-    original_transactions = [Transaction(1), Transaction(2), Transaction(3)]
-    ledger.transactions.extend(original_transactions)
+    ledger.df = pd.DataFrame({"transaction_id": [1, 2, 3], "amount": [10, 20, 30]})
     logger.register_ledger(name="bank", ledger_transactions=ledger)
     # When listing undispersed_transactions
     # Then undispersed equal to original transactions
-    assert logger.undispersed_transactions(name="bank") == original_transactions
+    assert logger.undispersed_transactions(name="bank", target="gl").to_dict("records") == ledger.df.to_dict("records")
 
 
 def test_dispersal_logger_log_dispersal():
     # Given a Dispersals Logger with a registered and a transactions ledger with transactions
     logger = dispersals.DispersalsLogger()
     ledger = dispersals.InMemoryTransactionLedger()
-    class Transaction:
-        def __init__(self, id):
-            self.transaction_id = id
-            return
-    original_transactions = [Transaction(1), Transaction(2), Transaction(3)]
-    ledger.transactions.extend(original_transactions)
+    ledger.df = pd.DataFrame({"transaction_id": [0, 1, 2, 3, 4]})
     logger.register_ledger(name="bank", ledger_transactions=ledger)
     # When logging a sub set of transactions as dispersed
-    logger.log_dispersal(name="bank", transactions=original_transactions[:2])
+    logger.log_dispersal(name="bank", target="gl", transaction_ids=[0, 1])
     # Then undispersed is difference between subset and original
-    assert logger.undispersed_transactions(name="bank") == original_transactions[2:]
+    assert list(logger.undispersed_transactions(name="bank", target="gl")["transaction_id"]) == [2, 3, 4]
+    # When logging transactions out of order
+    logger.log_dispersal(name="bank", target="gl", transaction_ids=[4])
+    # Then only the gap left undispersed
+    assert list(logger.undispersed_transactions(name="bank", target="gl")["transaction_id"]) == [2, 3]
+    # When the gap is dispersed
+    logger.log_dispersal(name="bank", target="gl", transaction_ids=[3, 2])
+    # Then watermark passes all dispersed ids and nothing left undispersed
+    assert logger._watermarks[("bank", "gl")] == 5
+    assert logger._dispersed_ids[("bank", "gl")] == set()
+    assert logger.undispersed_transactions(name="bank", target="gl").shape[0] == 0
+
+
+def test_dispersal_logger_snapshot(tmp_path):
+    # Given a Dispersals Logger with transactions dispersed out of order
+    logger = dispersals.DispersalsLogger()
+    ledger = dispersals.InMemoryTransactionLedger()
+    ledger.df = pd.DataFrame({"transaction_id": [0, 1, 2, 3]})
+    logger.register_ledger(name="bank", ledger_transactions=ledger)
+    logger.log_dispersal(name="bank", target="gl", transaction_ids=[0, 2])
+    # When saving and loading a snapshot into a new logger
+    filename = str(tmp_path / "dispersals.json")
+    logger.save_snapshot(filename)
+    loaded = dispersals.DispersalsLogger()
+    loaded.register_ledger(name="bank", ledger_transactions=ledger)
+    loaded.load_snapshot(filename)
+    # Then same transactions undispersed
+    assert list(loaded.undispersed_transactions(name="bank", target="gl")["transaction_id"]) == [1, 3]
+
+
+def test_dispersal_logger_snapshot_logs_file(tmp_path):
+    # Given a Dispersals Logger writing its logs to a file, snapshotted after one log
+    logs_filename = str(tmp_path / "logs.jsonl")
+    logger = dispersals.DispersalsLogger(logs_filename=logs_filename)
+    ledger = dispersals.InMemoryTransactionLedger()
+    ledger.df = pd.DataFrame({"transaction_id": [0, 1, 2, 3]})
+    logger.register_ledger(name="bank", ledger_transactions=ledger)
+    first = dispersals.DispersalLog("bank", "gl", True, True, source_ids=[0, 1], target_ids=[0])
+    logger.record(first)
+    filename = str(tmp_path / "dispersals.json")
+    logger.save_snapshot(filename)
+    # Given a log recorded after the snapshot
+    logger.record(dispersals.DispersalLog("bank", "gl", True, True, source_ids=[2], target_ids=[1]))
+    # When loading the snapshot into a new logger of the same file
+    loaded = dispersals.DispersalsLogger(logs_filename=logs_filename)
+    loaded.register_ledger(name="bank", ledger_transactions=ledger)
+    loaded.load_snapshot(filename)
+    # Then snapshot held no logs, only how much of the file they filled
+    with open(filename) as f:
+        assert "source_ids" not in f.read()
+    # Then logs up to the snapshot restored, and later logs dropped from the file
+    assert loaded.logs == [first]
+    with open(logs_filename) as f:
+        assert len(f.readlines()) == 1
+    assert list(loaded.undispersed_transactions(name="bank", target="gl")["transaction_id"]) == [2, 3]
+
+
+class JournalLinesTarget(dispersals.DispersalTarget):
+    def __init__(self) -> None:
+        self.lines = []
+        return
+
+    def add_journal_lines(self, df):
+        self.lines.extend(df.to_dict("records"))
+        return list(range(len(self.lines) - df.shape[0], len(self.lines)))
+
+
+def nominal_lines(df):
+    # One journal of each transaction against a control account
+    lines = pd.DataFrame(
+        {
+            "journal": 0,
+            "jnl_type": "test",
+            "transaction_date": df["date"],
+            "nominal": df["nominal"],
+            "description": "test",
+            "amount": df["amount"],
+            "source_id": df["transaction_id"],
+        }
+    )
+    control = lines.assign(nominal="control", amount=-df["amount"])
+    return pd.concat([lines, control]).sort_index(kind="stable").reset_index(drop=True)
+
+
+def test_dispersal_engine():
+    # Given a ledger registered for aggregated and detailed dispersal to two targets
+    ledger = dispersals.InMemoryTransactionLedger()
+    ledger.df = pd.DataFrame(
+        {
+            "transaction_id": [0, 1, 2],
+            "date": pd.to_datetime(["2021-01-01", "2021-01-01", "2021-01-02"]),
+            "nominal": ["abc", "abc", "abc"],
+            "amount": [1, 2, 4],
+        }
+    )
+    logger = dispersals.DispersalsLogger()
+    logger.register_ledger("source", ledger)
+    engine = dispersals.DispersalEngine(logger)
+    aggregated, detailed = JournalLinesTarget(), JournalLinesTarget()
+    engine.register_target("aggregated", aggregated)
+    engine.register_target("detailed", detailed)
+    posted = []
+    engine.register(dispersals.DispersalConfig("source", "aggregated", True, True), nominal_lines, posted.extend)
+    engine.register(dispersals.DispersalConfig("source", "detailed", False, False), nominal_lines)
+    # When running dispersals
+    logs = engine.run()
+    # Then aggregated target has one reversed line per nominal and date
+    assert [(x["nominal"], x["amount"]) for x in aggregated.lines] == [
+        ("abc", -3),
+        ("control", 3),
+        ("abc", -4),
+        ("control", 4),
+    ]
+    # Then detailed target has every line
+    assert [x["amount"] for x in detailed.lines] == [1, -1, 2, -2, 4, -4]
+    assert posted == [0, 1, 2]
+    # Then dispersals logged
+    assert [(x.target, x.source_ids, x.target_ids) for x in logs] == [
+        ("aggregated", [0, 1, 2], [0, 1, 2, 3]),
+        ("detailed", [0, 1, 2], [0, 1, 2, 3, 4, 5]),
+    ]
+    assert logger.logs == logs
+    # When a transaction added and dispersals run again
+    new_transaction = {"transaction_id": [3], "date": [pd.Timestamp("2021-01-03")], "nominal": ["def"], "amount": [8]}
+    ledger.df = pd.concat([ledger.df, pd.DataFrame(new_transaction)], ignore_index=True)
+    logs = engine.run()
+    # Then only the new transaction dispersed to each target
+    assert [x.source_ids for x in logs] == [[3], [3]]
+    assert detailed.lines[-2]["nominal"] == "def"
+
 
+def test_aggregate_lines_missing_values():
+    # Given journal lines, one missing its nominal and one its date
+    lines = pd.DataFrame(
+        {
+            "journal": [0, 0, 0, 0],
+            "jnl_type": "test",
+            "transaction_date": pd.to_datetime(["2021-01-01", "2021-01-01", "2021-01-01", None]),
+            "nominal": pd.Series(["abc", "abc", None, "def"], dtype="category"),
+            "description": "test",
+            "amount": [1, 2, 4, -7],
+        }
+    )
+    # When aggregating
+    df = dispersals.aggregate_lines(lines)
+    # Then lines of the same nominal and date summed, and lines missing either kept rather than dropped
+    assert df["amount"].tolist() == [3, 4, -7]
+    assert df["nominal"].isnull().tolist() == [False, True, False]
+    assert df["transaction_date"].isnull().tolist() == [False, False, True]
+    assert df.columns.tolist() == ["journal", "nominal", "transaction_date", "jnl_type", "description", "amount"]
@@ -0,0 +1,69 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+import fiscal
+
+
+def test_fiscal_calendar_monthly():
+    # Given a monthly calendar of two fiscal years starting in April
+    calendar = fiscal.FiscalCalendar.monthly(2021, first_month=4, years=2)
+    # Then a period per month, the last ending the day before the next year starts
+    assert len(calendar) == 24
+    assert calendar[1] == fiscal.Period(1, datetime.datetime(2021, 4, 1), datetime.datetime(2021, 4, 30))
+    assert calendar[24].date_end == datetime.datetime(2023, 3, 31)
+    # When mapping dates, including times, missing dates and dates outside the calendar
+    dates = pd.Series(
+        pd.to_datetime(["2021-04-01", "2021-04-30 18:00", "2022-03-31", "2022-04-01", "2021-03-31", "2023-04-01", None])
+    )
+    # Then each date mapped to its period, -1 where it has none
+    assert calendar.period_of(dates).tolist() == [1, 1, 12, 13, -1, -1, -1]
+
+
+def test_fiscal_calendar_require_periods():
+    # Given a monthly calendar
+    calendar = fiscal.FiscalCalendar.monthly(2021)
+    # When requiring periods of dates all in the calendar
+    # Then each date mapped to its period
+    assert calendar.require_periods(pd.Series(pd.to_datetime(["2021-01-01", "2021-12-31"]))).tolist() == [1, 12]
+    # When requiring periods of a date outside the calendar and a missing date
+    # Then error names the dates
+    with pytest.raises(ValueError, match="2 bank rows .* 2022-01-01 00:00:00, NaT"):
+        calendar.require_periods(pd.Series(pd.to_datetime(["2021-05-01", "2022-01-01", None])), "bank rows")
+
+
+def test_fiscal_calendar_weeks_445():
+    # Given a 4-4-5 calendar starting on a Monday
+    calendar = fiscal.FiscalCalendar.weeks_445(datetime.datetime(2021, 1, 4))
+    # Then periods of 4, 4 and 5 weeks in each quarter
+    assert [(x.date_end - x.date_start).days + 1 for x in calendar][:6] == [28, 28, 35, 28, 28, 35]
+    assert calendar[12].date_end == datetime.datetime(2022, 1, 2)
+    # Then dates mapped to the period of their week
+    dates = pd.Series(pd.to_datetime(["2021-01-31", "2021-02-01", "2021-03-28"]))
+    assert calendar.period_of(dates).tolist() == [1, 2, 3]
+
+
+def test_fiscal_calendar_next_period():
+    # Given a calendar of one year
+    calendar = fiscal.FiscalCalendar.monthly(2021)
+    # Then next period follows each period
+    assert calendar.next_period(1).date_start == datetime.datetime(2021, 2, 1)
+    # Then error raised for the last period
+    with pytest.raises(ValueError):
+        calendar.next_period(12)
+    # Then error raised for a period not in the calendar
+    with pytest.raises(KeyError):
+        calendar[13]
+
+
+def test_fiscal_calendar_invalid():
+    # Given periods with a gap between them
+    periods = [
+        fiscal.Period(1, datetime.datetime(2021, 1, 1), datetime.datetime(2021, 1, 30)),
+        fiscal.Period(2, datetime.datetime(2021, 2, 1), datetime.datetime(2021, 2, 28)),
+    ]
+    # When creating a calendar
+    # Then error raised
+    with pytest.raises(ValueError):
+        fiscal.FiscalCalendar(periods)
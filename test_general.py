@@ -1,8 +1,11 @@
 import datetime
 
+import pytest
 from pandas import Timestamp
 
+from fiscal import FiscalCalendar
 from general import GLJournal, GLJournalLine, GeneralLedger
+from ledger import FrozenPartitionError
 import general
 
 
@@ -185,8 +188,8 @@ def test_create_prepayment_journal():
         description_recurring="monthly abc",
     )
     # When creating prepayment
-    periods = GeneralLedger(ledger=None, chart_of_accounts=None).periods
-    jnls = general.create_prepayment_journal(new, periods)
+    calendar = GeneralLedger(ledger=None, chart_of_accounts=None).calendar
+    jnls = general.create_prepayment_journal(new, calendar)
     # Then default jnls created as
     assert jnls == [
         GLJournal(
@@ -267,8 +270,8 @@ def test_create_prepayment_journal_balancing_amount():
         description_recurring="monthly abc",
     )
     # When creating prepayment journals
-    periods = GeneralLedger(ledger=None, chart_of_accounts=None).periods
-    jnls = general.create_prepayment_journal(new, periods)
+    calendar = GeneralLedger(ledger=None, chart_of_accounts=None).calendar
+    jnls = general.create_prepayment_journal(new, calendar)
     # Then total of journal lines by nominal equals zero
     prepayment_balance, nominal_balance = 0, 0
     for jnl in jnls:
@@ -279,3 +282,324 @@ def test_create_prepayment_journal_balancing_amount():
                 nominal_balance += line.amount
     assert prepayment_balance == 0
     assert nominal_balance == 0
+
+
+def test_general_ledger_transactions_balance_index():
+    # Given a GeneralLedgerTransactions in verification mode
+    ledger = general.GeneralLedgerTransactions(verify_balances=True)
+    # When adding journals across periods
+    for month, amount in ((1, 100), (1, 50), (2, 25)):
+        ledger.add_journal(
+            GLJournal(
+                jnl_type="gnl",
+                transaction_date=datetime.datetime(2021, month, 1),
+                lines=[
+                    GLJournalLine(nominal="abc", description="abc", amount=amount),
+                    GLJournalLine(nominal="def", description="def", amount=-amount),
+                ],
+            )
+        )
+    # Then running totals agree to a full recompute
+    assert ledger.balance == 0
+    assert ledger.balances == {"abc": 175, "def": -175}
+    assert ledger.period_balances == {("abc", 1): 150, ("def", 1): -150, ("abc", 2): 25, ("def", 2): -25}
+
+
+def test_general_ledger_transactions_balance_index_mismatch():
+    # Given a GeneralLedgerTransactions whose frame was changed without updating the index
+    ledger = general.GeneralLedgerTransactions()
+    ledger.add_journal(
+        GLJournal(
+            jnl_type="gnl",
+            transaction_date=datetime.datetime(2021, 1, 1),
+            lines=[
+                GLJournalLine(nominal="abc", description="abc", amount=1),
+                GLJournalLine(nominal="def", description="def", amount=-1),
+            ],
+        )
+    )
+    ledger.update_transactions([0], "amount", 2)
+    # When verifying the index
+    # Then mismatch raised
+    with pytest.raises(general.BalanceIndexError):
+        ledger.verify_balance_index()
+
+
+def test_general_ledger_add_journals():
+    # Given a GeneralLedger with no transactions
+    ledger = general.GeneralLedger(ledger=general.GeneralLedgerTransactions(), chart_of_accounts=None)
+    # When adding a batch of journals including a reversing journal
+    journals = [
+        GLJournal(
+            jnl_type=jnl_type,
+            transaction_date=datetime.datetime(2021, 1, 1),
+            lines=[
+                GLJournalLine(nominal="abc", description="abc", amount=amount),
+                GLJournalLine(nominal="def", description="def", amount=-amount),
+            ],
+        )
+        for jnl_type, amount in (("gnl", 1), ("gnl_rev", 10), ("gnl", 100))
+    ]
+    transaction_ids = ledger.add_journals(journals)
+    # Then ids returned for supplied journals only
+    assert transaction_ids == [0, 1, 2, 3, 6, 7]
+    # Then same transactions as posting one at a time
+    single = general.GeneralLedger(ledger=general.GeneralLedgerTransactions(), chart_of_accounts=None)
+    for journal in journals:
+        single.add_journal(journal)
+    assert ledger.ledger.list_transactions() == single.ledger.list_transactions()
+    # Then reversal posted directly after reversing journal
+    assert [x.jnl_id for x in ledger.ledger.list_transactions()] == [0, 0, 1, 1, 2, 2, 3, 3]
+    assert ledger.ledger.balances == {"abc": 101, "def": -101}
+
+
+def test_general_ledger_add_journals_unbalanced(capsys):
+    # Given a GeneralLedger with no transactions
+    ledger = general.GeneralLedger(ledger=general.GeneralLedgerTransactions(), chart_of_accounts=None)
+    # When adding a batch where one journal does not balance
+    journals = [
+        GLJournal(
+            jnl_type="gnl",
+            transaction_date=datetime.datetime(2021, 1, 1),
+            lines=[
+                GLJournalLine(nominal="abc", description="abc", amount=amount),
+                GLJournalLine(nominal="def", description="def", amount=-1),
+            ],
+        )
+        for amount in (1, 2)
+    ]
+    # Then error raised with the lines of the unbalanced journal, and no journals posted
+    with pytest.raises(general.JournalBalanceError) as error:
+        ledger.add_journals(journals)
+    message, columns, *lines = str(error.value).splitlines()
+    assert message == "Journals do not balance: {2: 1}"
+    assert columns.split() == ["journal", "jnl_type", "transaction_date", "nominal", "description", "amount"]
+    assert [x.split()[-1] for x in lines] == ["2", "-1"]
+    assert capsys.readouterr().out == ""
+    assert ledger.ledger.list_transactions() == []
+
+
+def test_general_ledger_transactions_schema():
+    # Given a GeneralLedgerTransactions with many journals posted
+    ledger = general.GeneralLedgerTransactions()
+    ledger.add_journals(
+        [
+            GLJournal(
+                jnl_type="gnl",
+                transaction_date=datetime.datetime(2021, i % 12 + 1, 1),
+                lines=[
+                    GLJournalLine(nominal=f"nominal_{i % 20}", description="description", amount=i),
+                    GLJournalLine(nominal="contra", description="description", amount=-i),
+                ],
+            )
+            for i in range(2000)
+        ]
+    )
+    df = ledger.df
+    # Then columns have schema dtypes
+    assert df.dtypes.astype(str).to_dict() == ledger.schema
+    # Then memory use well below the same frame held as object columns
+    typed_memory = df.memory_usage(deep=True).sum()
+    untyped_memory = df.astype(object).memory_usage(deep=True).sum()
+    assert typed_memory * 3 < untyped_memory
+
+
+def test_sqlite_general_ledger_transactions():
+    # Given a SQLite and an in memory GeneralLedger
+    sqlite_ledger = general.GeneralLedger(ledger=general.SQLiteGeneralLedgerTransactions(), chart_of_accounts=None)
+    in_memory_ledger = general.GeneralLedger(ledger=general.GeneralLedgerTransactions(), chart_of_accounts=None)
+    # When adding the same journals to both
+    journals = [
+        GLJournal(
+            jnl_type=jnl_type,
+            transaction_date=datetime.datetime(2021, 3, 1),
+            lines=[
+                GLJournalLine(nominal="abc", description="abc", amount=amount),
+                GLJournalLine(nominal="def", description="def", amount=-amount),
+            ],
+        )
+        for jnl_type, amount in (("gnl", 5), ("gnl_rev", 7))
+    ]
+    sqlite_ledger.add_journals(journals)
+    in_memory_ledger.add_journals(journals)
+    # Then same transactions and balances
+    assert sqlite_ledger.ledger.list_transactions() == in_memory_ledger.ledger.list_transactions()
+    assert sqlite_ledger.ledger.balance == 0
+    assert sqlite_ledger.ledger.balances == in_memory_ledger.ledger.balances
+    assert sqlite_ledger.ledger.period_balances == in_memory_ledger.ledger.period_balances
+
+
+def test_general_ledger_transactions_snapshot(tmp_path):
+    # Given a GeneralLedgerTransactions with journals posted
+    ledger = general.GeneralLedgerTransactions()
+    ledger.add_journals(
+        [
+            GLJournal(
+                jnl_type="gnl",
+                transaction_date=datetime.datetime(2021, month, 1),
+                lines=[
+                    GLJournalLine(nominal="abc", description="abc", amount=month),
+                    GLJournalLine(nominal="def", description="def", amount=-month),
+                ],
+            )
+            for month in range(1, 13)
+        ]
+    )
+    # When saving and loading a snapshot into a new ledger
+    filename = str(tmp_path / "general_ledger.arrow")
+    ledger.save_snapshot(filename)
+    loaded = general.GeneralLedgerTransactions(verify_balances=True)
+    loaded.load_snapshot(filename)
+    # Then transactions, dtypes and balances restored
+    assert loaded.list_transactions() == ledger.list_transactions()
+    assert loaded.df.dtypes.to_dict() == ledger.df.dtypes.to_dict()
+    assert loaded.period_balances == ledger.period_balances
+    # Then ids continue after the snapshot
+    assert loaded.get_next_transaction_id() == 24
+    assert loaded.get_next_journal_id() == 12
+
+
+def test_general_ledger_transactions_partitioned():
+    # Given a GeneralLedger with a reversing journal spanning two periods, posted after a journal in period 2
+    gl = general.GeneralLedger(ledger=general.GeneralLedgerTransactions(), chart_of_accounts=None)
+    for month, jnl_type in [(2, "gnl"), (1, "gnl_rev")]:
+        gl.add_journal(
+            GLJournal(
+                jnl_type=jnl_type,
+                transaction_date=datetime.datetime(2021, month, 10),
+                lines=[
+                    GLJournalLine(nominal="abc", description="abc", amount=month),
+                    GLJournalLine(nominal="def", description="def", amount=-month),
+                ],
+            )
+        )
+    ledger = gl.ledger
+    # Then rows stored by period
+    assert ledger.periods == [1, 2]
+    assert list(ledger.select(period=1)["transaction_id"]) == [2, 3]
+    assert list(ledger.select(period=2, nominal="abc")["amount"]) == [2, -1]
+    # Then full frame still in transaction_id order
+    assert list(ledger.df["transaction_id"]) == [0, 1, 2, 3, 4, 5]
+    assert list(ledger.df["period"]) == [2, 2, 1, 1, 2, 2]
+    # Then full frame built once until more rows appended
+    assert ledger.df is ledger.df
+    df = ledger.df
+    gl.add_journal(
+        GLJournal(
+            jnl_type="gnl",
+            transaction_date=datetime.datetime(2021, 1, 20),
+            lines=[
+                GLJournalLine(nominal="abc", description="abc", amount=3),
+                GLJournalLine(nominal="def", description="def", amount=-3),
+            ],
+        )
+    )
+    assert ledger.df is not df
+    assert list(ledger.df["transaction_id"]) == [0, 1, 2, 3, 4, 5, 6, 7]
+    # When freezing period 1
+    ledger.freeze_period(1)
+    # Then further journals rejected for period 1 only
+    with pytest.raises(FrozenPartitionError):
+        gl.add_journal(
+            GLJournal(
+                jnl_type="gnl",
+                transaction_date=datetime.datetime(2021, 1, 31),
+                lines=[
+                    GLJournalLine(nominal="abc", description="abc", amount=1),
+                    GLJournalLine(nominal="def", description="def", amount=-1),
+                ],
+            )
+        )
+    assert ledger.periods == [1, 2]
+    assert ledger.select(period=1).shape[0] == 4
+    ledger.verify_balance_index()
+
+
+def test_general_ledger_transactions_for():
+    # Given a GeneralLedger with a reversing journal spanning two periods, posted after a journal in period 2
+    for ledger in (general.GeneralLedgerTransactions(), general.SQLiteGeneralLedgerTransactions()):
+        gl = general.GeneralLedger(ledger=ledger, chart_of_accounts=None)
+        for month, jnl_type in [(2, "gnl"), (1, "gnl_rev"), (3, "gnl")]:
+            gl.add_journal(
+                GLJournal(
+                    jnl_type=jnl_type,
+                    transaction_date=datetime.datetime(2021, month, 10),
+                    lines=[
+                        GLJournalLine(nominal="abc", description="abc", amount=month),
+                        GLJournalLine(nominal="def", description="def", amount=-month),
+                    ],
+                )
+            )
+        # When querying a nominal's transactions
+        # Then all periods returned in transaction_id order
+        df = ledger.transactions_for("abc")
+        assert list(df["transaction_id"]) == [0, 2, 4, 6]
+        assert list(df["amount"]) == [2, 1, -1, 3]
+        if isinstance(ledger, general.GeneralLedgerTransactions):
+            # Then row positions read held as a single integer array per period
+            for positions in ledger._nominal_rows["abc"].values():
+                assert len(positions) == 1 and positions[0].dtype == "int64"
+        # Then period range is inclusive
+        df = ledger.transactions_for("def", (2, 3))
+        assert list(df["transaction_id"]) == [1, 5, 7]
+        assert list(df["period"]) == [2, 2, 3]
+        # Then unknown nominal returns no transactions
+        assert ledger.transactions_for("xyz").shape[0] == 0
+
+
+def test_in_memory_chart_of_accounts_snapshot(tmp_path):
+    # Given a chart of accounts with nominals
+    coa = general.InMemoryChartOfAccounts()
+    for name in ("abc", "def"):
+        coa.add_nominal(
+            general.NewNominal(
+                name=name, statement="pl", heading="h", expected_sign="dr", control_account=False, bank_account=True
+            )
+        )
+    # When saving and loading a snapshot into a new chart of accounts
+    filename = str(tmp_path / "coa.arrow")
+    coa.save_snapshot(filename)
+    loaded = general.InMemoryChartOfAccounts()
+    loaded.load_snapshot(filename)
+    # Then nominals restored
+    assert loaded.nominals == coa.nominals
+
+
+def test_general_ledger_add_journal_reversing_fiscal_calendar():
+    # Given a General Ledger with a 4-4-5 calendar over two years
+    calendar = FiscalCalendar.weeks_445(datetime.datetime(2021, 1, 4), years=2)
+    ledger = general.GeneralLedgerTransactions(calendar=calendar)
+    gl = GeneralLedger(ledger=ledger, chart_of_accounts=None, calendar=calendar)
+    # When adding a reversing journal in the last period of the first year
+    lines = [GLJournalLine("abc", "x", 10), GLJournalLine("def", "x", -10)]
+    gl.add_journal(GLJournal(jnl_type="gnl_rev", transaction_date=datetime.datetime(2021, 12, 30), lines=lines))
+    # Then journal posted in period 12 and reversed at the start of the first period of the next year
+    assert ledger.df["period"].tolist() == [12, 12, 13, 13]
+    assert ledger.df["transaction_date"].tolist()[2:] == [Timestamp(2022, 1, 3)] * 2
+    # When adding a reversing journal in the last period of the calendar
+    last = datetime.datetime(2022, 12, 30)
+    # Then error raised as there is no period to reverse it in
+    with pytest.raises(ValueError):
+        gl.add_journal(GLJournal(jnl_type="gnl_rev", transaction_date=last, lines=lines))
+
+
+def test_general_ledger_transactions_outside_calendar():
+    # Given a General Ledger with the default calendar of 2021
+    ledger = general.GeneralLedgerTransactions()
+    lines = [GLJournalLine("abc", "x", 10), GLJournalLine("def", "x", -10)]
+    # When adding a journal dated after the calendar
+    # Then error raised rather than the journal posted to no period
+    with pytest.raises(ValueError, match="2 journal lines .* 2022-01-01"):
+        ledger.add_journal(GLJournal(jnl_type="gnl", transaction_date=datetime.datetime(2022, 1, 1), lines=lines))
+    assert ledger.df.shape[0] == 0
+
+
+def test_general_ledger_transactions_missing_nominal():
+    # Given a General Ledger
+    ledger = general.GeneralLedgerTransactions()
+    lines = [GLJournalLine("abc", "x", 10), GLJournalLine(None, "x", -10)]
+    # When adding a balanced journal with a line missing its nominal
+    # Then error raised rather than the line posted to no nominal
+    with pytest.raises(ValueError, match="1 journal lines missing a nominal"):
+        ledger.add_journal(GLJournal(jnl_type="gnl", transaction_date=datetime.datetime(2021, 1, 1), lines=lines))
+    assert ledger.df.shape[0] == 0
@@ -0,0 +1,65 @@
+import json
+
+import instrumentation
+
+
+def test_instrumentation_stage(capsys):
+    # Given a stage of a period entered twice, and a stage of the run
+    tracker = instrumentation.Instrumentation()
+    with tracker.stage("post", 1) as counts:
+        counts["rows"] = 2
+    with tracker.stage("post", 1) as counts:
+        counts["rows"] = 3
+        counts["journals"] = 1
+    with tracker.stage("post", 2) as counts:
+        counts["rows"] = 4
+    with tracker.stage("report"):
+        pass
+    # When summarising the run
+    summary = tracker.summary(entity="a")
+    # Then counts of the same stage and period added together, in the order first entered
+    assert [(x["stage"], x["period"], x["counts"]) for x in summary["stages"]] == [
+        ("post", 1, {"rows": 5, "journals": 1}),
+        ("post", 2, {"rows": 4}),
+        ("report", None, {}),
+    ]
+    # Then totals of each stage over all periods
+    assert summary["totals"]["post"]["counts"] == {"rows": 9, "journals": 1}
+    assert summary["entity"] == "a"
+    # Then each stage printed as it finished
+    assert "..period 1 post took" in capsys.readouterr().out
+
+
+def test_instrumentation_quiet(tmp_path, capsys):
+    # Given a quiet run
+    tracker = instrumentation.Instrumentation(quiet=True)
+    tracker.log("progress")
+    with tracker.stage("load") as counts:
+        counts["rows"] = 1
+    # When writing results
+    tracker.write_json(str(tmp_path / "runs" / "run.json"), entity="a")
+    # Then nothing printed, and results written as json
+    assert capsys.readouterr().out == ""
+    with open(tmp_path / "runs" / "run.json") as f:
+        summary = json.load(f)
+    assert summary["stages"][0]["counts"] == {"rows": 1}
+    assert summary["seconds"] >= summary["stages"][0]["seconds"]
+    # Then memory recorded as the stage's increase of the process peak, alongside the process peak itself
+    if instrumentation.process_peak_memory_bytes() is not None:
+        assert 0 <= summary["stages"][0]["peak_memory_increase_bytes"] <= summary["peak_memory_increase_bytes"]
+        assert summary["peak_memory_increase_bytes"] <= summary["process_peak_memory_bytes"]
+
+
+def test_instrumentation_stage_failed():
+    # Given a stage left by an exception
+    tracker = instrumentation.Instrumentation(quiet=True)
+    try:
+        with tracker.stage("validate", 3) as counts:
+            counts["checks"] = 1
+            raise AssertionError("unbalanced")
+    except AssertionError:
+        pass
+    # Then stage still recorded, as failed
+    (record,) = tracker.summary()["stages"]
+    assert (record["stage"], record["period"], record["counts"]) == ("validate", 3, {"checks": 1})
+    assert record["failed"] is True
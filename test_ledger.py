@@ -0,0 +1,102 @@
+import pandas as pd
+
+import ledger
+
+
+class ExampleLedger(ledger.PandasLedger):
+    def __init__(self) -> None:
+        self.columns = ["transaction_id", "batch_id", "amount"]
+        self.df = pd.DataFrame(columns=self.columns)
+        return
+
+
+def test_frame_buffer_lazy_concat():
+    # Given a FrameBuffer with chunks appended
+    buffer = ledger.FrameBuffer(pd.DataFrame(columns=["a"]))
+    buffer.append(pd.DataFrame({"a": [1, 2]}))
+    buffer.append(pd.DataFrame({"a": [3]}))
+    # Then length is known without building the frame
+    assert len(buffer) == 3
+    assert len(buffer._chunks) == 2
+    # When reading the frame
+    # Then all chunks concatenated in order
+    assert list(buffer.df["a"]) == [1, 2, 3]
+    assert buffer._chunks == []
+
+
+def test_pandas_ledger_append_many():
+    # Given an empty ledger
+    example = ExampleLedger()
+    # When appending many small batches
+    for i in range(50):
+        ids = example.append(pd.DataFrame({"batch_id": [i, i], "amount": [1, -1]}))
+        assert ids == [i * 2, i * 2 + 1]
+    # Then all rows present in order
+    assert list(example.df["transaction_id"]) == list(range(100))
+    assert example.get_next_batch_id() == 50
+    # When appending after reading the frame
+    example.append(pd.DataFrame({"batch_id": [50], "amount": [5]}))
+    # Then new rows included
+    assert example.df.shape[0] == 101
+    assert example.get_next_transaction_id() == 101
+
+
+def test_sequence_reserve_and_observe():
+    # Given a new sequence
+    sequence = ledger.Sequence()
+    # When reserving a block of ids
+    # Then block is contiguous and sequence continues after it
+    assert sequence.reserve(3) == range(0, 3)
+    assert sequence.peek() == 3
+    # When observing a used id ahead of the sequence
+    sequence.observe(10)
+    # Then sequence continues after it
+    assert sequence.peek() == 11
+    # When observing a used id behind the sequence
+    sequence.observe(5)
+    # Then sequence unchanged
+    assert sequence.peek() == 11
+
+
+def test_pandas_ledger_sequences_reloaded():
+    # Given a ledger reloaded from persisted state
+    example = ExampleLedger()
+    example.df = pd.DataFrame({"transaction_id": [0, 1, 7], "batch_id": [0, 0, 3], "amount": [1, 1, 1]})
+    # Then sequences continue after persisted ids
+    assert example.get_next_transaction_id() == 8
+    assert example.get_next_batch_id() == 4
+    # When reserving a block of transaction ids for a bulk post
+    ids = example.reserve_ids("transaction_id", 5)
+    # Then next append continues after the block
+    assert ids == range(8, 13)
+    assert example.append(pd.DataFrame({"batch_id": [4], "amount": [1]})) == [13]
+
+
+def test_frame_buffer_schema():
+    # Given a FrameBuffer with a schema
+    schema = {"amount": "int64", "nominal": "category"}
+    buffer = ledger.FrameBuffer(ledger.empty_frame(schema), schema)
+    # When appending chunks with different categories
+    buffer.append(pd.DataFrame({"amount": [1.0, 2.0], "nominal": ["abc", "def"]}))
+    buffer.append(pd.DataFrame({"amount": [3], "nominal": ["ghi"]}))
+    df = buffer.df
+    buffer.append(pd.DataFrame({"amount": [4], "nominal": ["abc"]}))
+    df = buffer.df
+    # Then frame keeps schema dtypes
+    assert df["amount"].dtype == "int64"
+    assert isinstance(df["nominal"].dtype, pd.CategoricalDtype)
+    assert list(df["nominal"]) == ["abc", "def", "ghi", "abc"]
+
+
+def test_pandas_ledger_transactions_since():
+    # Given a ledger with rows both in its built frame and in chunks appended since
+    example = ExampleLedger()
+    example.append(pd.DataFrame({"batch_id": [0, 0], "amount": [1, 2]}))
+    example.df
+    example.append(pd.DataFrame({"batch_id": [1, 1], "amount": [3, 4]}))
+    example.append(pd.DataFrame({"batch_id": [2], "amount": [5]}))
+    # When reading rows from a transaction id
+    # Then only rows from that id onwards returned, in order
+    assert list(example.transactions_since(1)["amount"]) == [2, 3, 4, 5]
+    assert list(example.transactions_since(3)["amount"]) == [4, 5]
+    assert example.transactions_since(5).shape[0] == 0
@@ -0,0 +1,172 @@
+import datetime
+import os
+
+import openpyxl
+import pandas as pd
+import pytest
+
+import fiscal
+import loaders
+
+
+def test_read_excel_sheets(tmp_path):
+    # Given a workbook with several sheets including empty cells, whole floats and dates
+    filename = str(tmp_path / "book.xlsx")
+    sheets = {
+        "first": pd.DataFrame({"a": [1.0, 2.5, None], "b": ["x", None, "z"]}),
+        "second": pd.DataFrame({"date": [datetime.datetime(2021, 1, 1), datetime.datetime(2021, 2, 1)], "c": [1, 2]}),
+        "third": pd.DataFrame({"d": [True, False]}),
+    }
+    with pd.ExcelWriter(filename) as writer:
+        for sheet_name, df in sheets.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    # When reading a subset of sheets in one pass
+    read = list(loaders.read_excel_sheets(filename, ["third", "first"]))
+    # Then sheets yielded in workbook order, skipping those not requested
+    assert [sheet_name for sheet_name, _ in read] == ["first", "third"]
+    # Then frames same as read by pd.read_excel
+    for sheet_name, df in read:
+        pd.testing.assert_frame_equal(df, pd.read_excel(filename, sheet_name=sheet_name, index_col=None))
+
+
+def write_cashbook(filename: str) -> None:
+    sheets = {
+        "bank": pd.DataFrame(
+            {
+                "date": [datetime.datetime(2021, 1, 4), datetime.datetime(2021, 2, 1)],
+                "transaction_type": ["payment", "receipt"],
+                "amount": [-10.5, 20.0],
+                "notes": [None, "x"],
+            }
+        ),
+        "coa": pd.DataFrame({"nominal": ["a", "b"], "control_account": ["y", "n"], "bank_account": ["n", "y"]}),
+        "sales_invoice_headers": pd.DataFrame({"id": [1], "date": [datetime.datetime(2021, 1, 5)], "debtor": ["d"]}),
+        "sales_invoice_lines": pd.DataFrame(
+            {"header_id": [1, 1], "amount": [1.25, 2.0], "transaction_date": [datetime.datetime(2021, 1, 5)] * 2}
+        ),
+        "gl_journal_headers": pd.DataFrame({"id": [1], "transaction_date": [datetime.datetime(2021, 3, 1)]}),
+        "gl_journal_lines": pd.DataFrame({"header_id": [1, 1], "nominal": ["a", "b"], "amount": [3.0, -3.0]}),
+    }
+    with pd.ExcelWriter(filename) as writer:
+        for sheet_name, df in sheets.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    return
+
+
+def make_loader(loader_class, filename: str):
+    return loader_class(
+        filename=filename,
+        bank_sheet="bank",
+        coa_sheet="coa",
+        si_headers_sheet="sales_invoice_headers",
+        si_lines_sheet="sales_invoice_lines",
+        gl_jnl_headers_sheet="gl_journal_headers",
+        gl_jnl_lines_sheet="gl_journal_lines",
+    )
+
+
+def test_source_data_loaders(tmp_path):
+    # Given a cashbook workbook and the same sheets exported to folders of csv and parquet files
+    workbook = str(tmp_path / "cashbook_a.xlsx")
+    write_cashbook(workbook)
+    os.makedirs(tmp_path / "csv")
+    os.makedirs(tmp_path / "parquet")
+    for sheet_name, df in pd.read_excel(workbook, sheet_name=None).items():
+        df.to_csv(tmp_path / "csv" / f"{sheet_name}.csv", index=False)
+        df.to_parquet(tmp_path / "parquet" / f"{sheet_name}.parquet", index=False)
+    # Then loader class chosen by format
+    assert loaders.source_loader_class(workbook) is loaders.ExcelSourceDataLoader
+    assert loaders.source_loader_class(str(tmp_path / "csv")) is loaders.CSVSourceDataLoader
+    assert loaders.source_loader_class(str(tmp_path / "parquet")) is loaders.ParquetSourceDataLoader
+    # When loading each format
+    expected = make_loader(loaders.ExcelSourceDataLoader, workbook)
+    expected.load()
+    for folder in ["csv", "parquet"]:
+        filename = str(tmp_path / folder)
+        loader = make_loader(loaders.source_loader_class(filename), filename)
+        loader.load()
+        # Then datasets same as loaded from the workbook
+        for name in loaders.SourceDataLoader.datasets:
+            pd.testing.assert_frame_equal(getattr(loader, name), getattr(expected, name))
+    assert list(expected.bank["period"]) == [1, 2]
+    assert list(expected.bank["amount"]) == [-1050, 2000]
+    assert list(expected.gl_journal_lines["line_id"]) == [0, 1]
+
+
+def test_source_data_loader_outside_calendar(tmp_path):
+    # Given a cashbook with bank rows dated in 2021
+    workbook = str(tmp_path / "cashbook_a.xlsx")
+    write_cashbook(workbook)
+    # When loading with a calendar of 2022
+    loader = make_loader(loaders.ExcelSourceDataLoader, workbook)
+    loader.calendar = fiscal.FiscalCalendar.monthly(2022)
+    # Then rows which would go unposted reported rather than dropped
+    with pytest.raises(ValueError, match="2 bank rows .* 2021-01-04"):
+        loader.load(["bank"])
+
+
+def test_source_data_loader_blank_dates(tmp_path):
+    # Given a cashbook with a bank row missing its date
+    workbook = str(tmp_path / "cashbook_a.xlsx")
+    write_cashbook(workbook)
+    book = openpyxl.load_workbook(workbook)
+    book["bank"].append([None, "payment", -1.0, "no date"])
+    book.save(workbook)
+    # When loading the whole sheet, and a row at a time
+    loader = make_loader(loaders.ExcelSourceDataLoader, workbook)
+    loader.load(["bank"])
+    chunks = list(loader.iter_bank_chunks(chunk_rows=1))
+    # Then the row skipped and counted rather than failing the load
+    assert list(loader.bank["period"]) == [1, 2]
+    assert loader.blank_date_rows == {"bank": 1}
+    assert sum(x.shape[0] for x in chunks) == 2
+
+
+def test_source_data_loaders_bank_chunks(tmp_path):
+    # Given a cashbook workbook and the same sheets exported to folders of csv and parquet files
+    workbook = str(tmp_path / "cashbook_a.xlsx")
+    write_cashbook(workbook)
+    os.makedirs(tmp_path / "csv")
+    os.makedirs(tmp_path / "parquet")
+    for sheet_name, df in pd.read_excel(workbook, sheet_name=None).items():
+        df.to_csv(tmp_path / "csv" / f"{sheet_name}.csv", index=False)
+        df.to_parquet(tmp_path / "parquet" / f"{sheet_name}.parquet", index=False)
+    for filename in [workbook, str(tmp_path / "csv"), str(tmp_path / "parquet")]:
+        expected = make_loader(loaders.source_loader_class(filename), filename)
+        expected.load(["bank"])
+        # When reading the bank dataset a row at a time
+        loader = make_loader(loaders.source_loader_class(filename), filename)
+        chunks = list(loader.iter_bank_chunks(chunk_rows=1))
+        # Then one chunk per row, together the same as the whole dataset
+        assert [x.shape[0] for x in chunks] == [1, 1]
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected.bank)
+
+
+def test_read_excel_sheet_chunks(tmp_path):
+    # Given a sheet with an empty row between rows and empty rows at the end
+    filename = str(tmp_path / "book.xlsx")
+    workbook = openpyxl.Workbook()
+    for row in [["a", "b"], [1, "x"], [None, None], [2.5, "y"], [3, None], [None, None], [None, None]]:
+        workbook.active.append(row)
+    workbook.save(filename)
+    # When reading in chunks of two rows
+    chunks = list(loaders.read_excel_sheet_chunks(filename, workbook.active.title, chunk_rows=2))
+    # Then chunks together same as read by pd.read_excel, without the trailing empty rows
+    assert [x.shape[0] for x in chunks] == [2, 2]
+    df = pd.read_excel(filename, index_col=None)
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), df)
+
+
+def test_excel_source_data_loader_processes(tmp_path):
+    # Given a cashbook workbook
+    workbook = str(tmp_path / "cashbook_a.xlsx")
+    write_cashbook(workbook)
+    expected = make_loader(loaders.ExcelSourceDataLoader, workbook)
+    expected.load()
+    # When loading with sheets parsed in a pool of processes
+    loader = make_loader(loaders.ExcelSourceDataLoader, workbook)
+    loader.processes = 2
+    loader.load()
+    # Then datasets same as loaded in one process
+    for name in loaders.SourceDataLoader.datasets:
+        pd.testing.assert_frame_equal(getattr(loader, name), getattr(expected, name))
@@ -0,0 +1,360 @@
+import json
+import os
+import threading
+import time
+
+import openpyxl
+import pandas as pd
+import pytest
+
+from benchmarks import write_synthetic_cashbook
+import bank
+import loaders
+import main
+from recovery import RecoveryManager
+
+
+def test_get_entities_data(tmp_path):
+    # Given a folder with a workbook, folders of csv and parquet sheets, an open temp file and other files
+    for filename in ["cashbook_a.xlsx", "~$cashbook_a.xlsx", "notes.txt"]:
+        (tmp_path / filename).write_text("")
+    for folder, sheet in [("cashbook_b", "bank.csv"), ("cashbook_c", "bank.parquet"), ("cashbook_d", "notes.txt")]:
+        os.makedirs(tmp_path / folder)
+        (tmp_path / folder / sheet).write_text("")
+    # When identifying entities
+    entities = main.get_entities_data(str(tmp_path))
+    # Then an entity for each cashbook in a supported format
+    assert sorted((x.name, x.cashbook) for x in entities) == [
+        ("a", str(tmp_path / "cashbook_a.xlsx")),
+        ("b", str(tmp_path / "cashbook_b")),
+        ("c", str(tmp_path / "cashbook_c")),
+    ]
+
+
+def test_ingest_bank_sheet(tmp_path):
+    # Given a folder of csv sheets with bank rows matched to each kind of account
+    os.makedirs(tmp_path / "cashbook_a")
+    bank_sheet = pd.DataFrame(
+        {
+            "date": ["2021-01-04", "2021-01-05", "2021-02-01"],
+            "transaction_type": ["dd", "dd", "dd"],
+            "description": ["a", "b", "c"],
+            "amount": [-1.5, 2.0, 3.25],
+            "transfer_type": ["out", "in", "in"],
+            "bank_code": ["bank_current", "bank_current", "bank_savings"],
+            "creditor": ["acme", None, None],
+            "debtor": [None, "dan", None],
+            "bs": [None, None, "loan"],
+        }
+    )
+    bank_sheet.to_csv(tmp_path / "cashbook_a" / "bank.csv", index=False)
+    data_loader = loaders.CSVSourceDataLoader(
+        str(tmp_path / "cashbook_a"), "bank", "coa", "si_headers", "si_lines", "jnl_headers", "jnl_lines"
+    )
+    ledger = bank.InMemoryBankLedgerTransactions()
+    # When ingesting the bank sheet two rows at a time
+    rows = main.ingest_bank_sheet(data_loader, ledger, chunk_rows=2)
+    # Then every row added in one batch, with its matched account
+    assert rows == 3
+    transactions = ledger.list_transactions()
+    assert [x.raw_id for x in transactions] == [0, 1, 2]
+    assert {x.batch_id for x in transactions} == {0}
+    assert [(x.matched_account, x.matched_type) for x in transactions] == [
+        ("acme", "creditor"),
+        ("dan", "debtor"),
+        ("loan", "bs"),
+    ]
+    assert [x.amount for x in transactions] == [-150, 200, 325]
+
+
+def test_source_data_parser_gl_journals():
+    # Given journal headers of one period and lines of every period, out of header order
+    parser = main.SourceDataParser()
+    parser.gl_journal_headers = pd.DataFrame(
+        {"id": [2, 1], "transaction_date": pd.to_datetime(["2021-01-02", "2021-01-01"]), "jnl_type": ["gnl", "gnl"]}
+    )
+    parser.gl_journal_lines = pd.DataFrame(
+        {
+            "header_id": [1, 3, 2, 1, 2],
+            "nominal": ["a", "x", "c", "b", "d"],
+            "description": "",
+            "amount": [1, 5, 2, -1, -2],
+        }
+    )
+    # When building journals
+    journals = parser.gl_journals
+    # Then a journal per header, in header order, with its lines in sheet order
+    assert [[line.nominal for line in x.lines] for x in journals] == [["c", "d"], ["a", "b"]]
+    assert [x.transaction_date for x in journals] == list(parser.gl_journal_headers["transaction_date"])
+
+
+def test_source_data_parser_bank_transactions_frame():
+    # Given bank rows matched to none, one or several of creditor, debtor and bs, including a non text value
+    bank = pd.DataFrame(
+        {
+            "date": pd.to_datetime(["2021-01-01"] * 4),
+            "transaction_type": "dd",
+            "description": "x",
+            "amount": [1, 2, 3, 4],
+            "transfer_type": "out",
+            "raw_id": [0, 1, 2, 3],
+            "bank_code": "bank_current",
+            "creditor": ["acme", None, "bolt", None],
+            "debtor": [None, "dan", 5, None],
+            "bs": [None, None, "loan", None],
+        }
+    )
+    # When building transactions
+    df = main.SourceDataParser.bank_transactions_frame(bank)
+    # Then matched to the last column holding text
+    assert df["matched_account"].tolist()[:3] == ["acme", "dan", "loan"]
+    assert df["matched_type"].tolist()[:3] == ["creditor", "debtor", "bs"]
+    assert df[["matched_account", "matched_type"]].iloc[3].isnull().all()
+    # When a column holds no text at all, e.g. numeric codes in a period's rows
+    bank["debtor"] = pd.Series([None, 5, 6, None], dtype=object)
+    df = main.SourceDataParser.bank_transactions_frame(bank)
+    # Then its values never matched
+    assert df["matched_type"].tolist()[::2] == ["creditor", "bs"]
+    assert df[["matched_account", "matched_type"]].iloc[[1, 3]].isnull().all().all()
+
+
+def test_period_partitions():
+    # Given journal headers in two periods and lines, one without a header
+    headers = pd.DataFrame({"id": [1, 2, 3], "period": [1, 2, 1]})
+    lines = pd.DataFrame({"header_id": [1, 2, 3, 4, 1], "amount": [1, 2, 3, 4, 5]})
+    # When partitioning headers by their period and lines by the period of their header
+    headers_by_period = main.PeriodPartitions(headers)
+    lines_by_period = main.PeriodPartitions(lines, main.journal_line_periods(lines, headers))
+    # Then each period holds its rows in their original order
+    assert headers_by_period[1]["id"].tolist() == [1, 3]
+    assert lines_by_period[1]["amount"].tolist() == [1, 3, 5]
+    assert lines_by_period[2]["amount"].tolist() == [2]
+    # Then a period without rows is empty, with the same columns
+    assert lines_by_period[3].shape == (0, 2)
+
+
+def test_run_entities_in_processes(tmp_path, monkeypatch, capsys):
+    # Given a valid cashbook and a cashbook missing its sheets
+    monkeypatch.chdir(tmp_path)
+    write_synthetic_cashbook(str(tmp_path / "cashbook_good.xlsx"), bank_rows=50)
+    pd.DataFrame({"a": [1]}).to_excel(tmp_path / "cashbook_bad.xlsx", index=False)
+    entities = main.get_entities_data(str(tmp_path))
+    # When running entities in worker processes
+    errors = main.run_entities_in_processes(entities, "out", workers=2)
+    # Then failure of one entity reported without stopping the other
+    assert errors["good"] is None
+    assert "ValueError" in errors["bad"]
+    # Then each entity's output written to its own folder, and its logs labelled by entity
+    assert os.path.exists(tmp_path / "out" / "entities" / "good" / "reporting_pack.json")
+    assert os.path.exists(tmp_path / "out" / "entities" / "good" / "html" / "good")
+    assert "[good] Bookkeeping Demo" in capsys.readouterr().out
+
+
+def test_entity_loop_replays_from_changed_period(tmp_path, monkeypatch, capsys):
+    # Given an entity processed with its state kept
+    monkeypatch.chdir(tmp_path)
+    filename = str(tmp_path / "cashbook.xlsx")
+    write_synthetic_cashbook(filename, bank_rows=50)
+    main.entity_loop(filename, "entity", state_path="state", output_path="first")
+    # Given an April bank row then edited
+    workbook = openpyxl.load_workbook(filename)
+    sheet = workbook["bank"]
+    row = next(x for x in sheet.iter_rows(min_row=2) if x[0].value.month == 4)
+    row[3].value = row[3].value + 1
+    workbook.save(filename)
+    capsys.readouterr()
+    # When processing again with the same state
+    main.entity_loop(filename, "entity", state_path="state", output_path="rerun")
+    # Then periods before April skipped, and April onwards replayed
+    out = capsys.readouterr().out
+    assert "Source data changed from period 4" in out
+    assert "Skipped periods 1 to 3" in out
+    assert "Current Period: 3\n" not in out
+    assert "Current Period: 4\n" in out
+    # Then reports the same as processing the edited cashbook from scratch
+    main.entity_loop(filename, "entity", output_path="full")
+    for folder, _, filenames in os.walk(tmp_path / "full"):
+        if os.path.basename(folder) == "runs":
+            continue
+        for name in filenames:
+            full_filename = os.path.join(folder, name)
+            rerun_filename = os.path.join(tmp_path / "rerun", os.path.relpath(full_filename, tmp_path / "full"))
+            with open(full_filename) as f, open(rerun_filename) as g:
+                assert f.read() == g.read()
+
+
+def test_entity_loop_resume_database(tmp_path, monkeypatch):
+    # Given a run into a database which crashed in period 2, before its first checkpoint
+    monkeypatch.chdir(tmp_path)
+    filename = str(tmp_path / "cashbook.xlsx")
+    write_synthetic_cashbook(filename, bank_rows=50)
+    commit_period = RecoveryManager.commit_period
+    init = RecoveryManager.__init__
+    managers = []
+
+    def recording_init(self, *args, **kwargs):
+        managers.append(self)
+        return init(self, *args, **kwargs)
+
+    def crashing_commit_period(self, period, **kwargs):
+        if period == 2:
+            raise RuntimeError("crash")
+        return commit_period(self, period, **kwargs)
+
+    monkeypatch.setattr(RecoveryManager, "__init__", recording_init)
+    monkeypatch.setattr(RecoveryManager, "commit_period", crashing_commit_period)
+    with pytest.raises(RuntimeError):
+        main.entity_loop(filename, "entity", database="entity.db", state_path="state", checkpoint_every=3)
+    monkeypatch.setattr(RecoveryManager, "commit_period", commit_period)
+    # When resuming with the same database and state
+    main.entity_loop(
+        filename, "entity", database="entity.db", state_path="state", checkpoint_every=3, output_path="resumed"
+    )
+    # Then the journal log is closed by the crashed run and the resumed run alike
+    assert len(managers) == 2
+    assert all(x.log._file.closed for x in managers)
+    # Then reports the same as an uninterrupted run
+    main.entity_loop(filename, "entity", database="full.db", output_path="full")
+    with open(tmp_path / "resumed" / "reporting_pack.json") as f, open(tmp_path / "full" / "reporting_pack.json") as g:
+        assert f.read() == g.read()
+
+
+def test_entity_loop_database_twice(tmp_path, monkeypatch):
+    # Given an entity processed into a database
+    monkeypatch.chdir(tmp_path)
+    filename = str(tmp_path / "cashbook.xlsx")
+    write_synthetic_cashbook(filename, bank_rows=50)
+    main.entity_loop(filename, "entity", database="entity.db", quiet=True)
+    # When processing again into the same database
+    # Then refused rather than a second copy of every row posted
+    with pytest.raises(ValueError, match="already holds ledgers"):
+        main.entity_loop(filename, "entity", database="entity.db", quiet=True)
+    # When processing twice into a database with state kept
+    main.entity_loop(filename, "entity", database="state.db", state_path="state", output_path="first", quiet=True)
+    main.entity_loop(filename, "entity", database="state.db", state_path="state", output_path="second", quiet=True)
+    # Then the second run resumes from the first, with the same reports
+    with open(tmp_path / "first" / "reporting_pack.json") as f, open(tmp_path / "second" / "reporting_pack.json") as g:
+        assert f.read() == g.read()
+
+
+def test_entity_loop_quiet(tmp_path, monkeypatch, capsys):
+    # Given a cashbook
+    monkeypatch.chdir(tmp_path)
+    filename = str(tmp_path / "cashbook.xlsx")
+    write_synthetic_cashbook(filename, bank_rows=50)
+    # When processing quietly
+    main.entity_loop(filename, "entity", output_path="out", quiet=True)
+    # Then nothing printed
+    assert capsys.readouterr().out == ""
+    # Then each stage of each period timed and counted in the run's json file
+    (run_filename,) = os.listdir(tmp_path / "out" / "runs")
+    with open(tmp_path / "out" / "runs" / run_filename) as f:
+        run = json.load(f)
+    assert run["entity"] == "entity"
+    assert {(x["stage"], x["period"]) for x in run["stages"]} == {("load", None), ("report", None)} | {
+        (stage, period) for stage in ["parse", "post", "disperse", "validate"] for period in range(1, 13)
+    }
+    assert run["totals"]["load"]["counts"]["bank_rows"] == 50
+    assert run["totals"]["post"]["counts"]["bank_transactions"] == 50
+    assert run["totals"]["post"]["counts"]["gl_journals"] == run["totals"]["parse"]["counts"]["gl_journals"]
+
+
+def test_main_calendar(tmp_path, monkeypatch):
+    # Given a cashbook of 2021 with a bank row missing its date
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / "cashbooks")
+    filename = str(tmp_path / "cashbooks" / "cashbook_x.xlsx")
+    write_synthetic_cashbook(filename, bank_rows=50)
+    book = openpyxl.load_workbook(filename)
+    sheet = book["bank"]
+    sheet.append([None] + [cell.value for cell in sheet[2][1:]])
+    book.save(filename)
+    # When processing with a calendar of two fiscal years from July 2020
+    assert main.main(["--cashbooks", "cashbooks", "--calendar-start", "2020-07", "--years", "2", "--quiet"]) == 0
+    # Then every period of that calendar processed, and the undated row skipped
+    (run_filename,) = os.listdir(tmp_path / "data" / "runs")
+    with open(tmp_path / "data" / "runs" / run_filename) as f:
+        run = json.load(f)
+    assert run["last_period"] == 24
+    assert run["totals"]["load"]["counts"]["bank_rows"] == 50
+    assert run["totals"]["load"]["counts"]["bank_blank_date_rows"] == 1
+    # Then a calendar start which is not a month rejected
+    with pytest.raises(SystemExit):
+        main.main(["--cashbooks", "cashbooks", "--calendar-start", "2020-13"])
+
+
+def test_entity_loop_failed_run_file(tmp_path, monkeypatch):
+    # Given a cashbook whose posting fails in period 2
+    monkeypatch.chdir(tmp_path)
+    filename = str(tmp_path / "cashbook.xlsx")
+    write_synthetic_cashbook(filename, bank_rows=50)
+    add_journals = main.GeneralLedger.add_journals
+    calls = []
+
+    def failing_add_journals(self, journals):
+        calls.append(journals)
+        if len(calls) == 2:
+            raise ValueError("bad journal")
+        return add_journals(self, journals)
+
+    monkeypatch.setattr(main.GeneralLedger, "add_journals", failing_add_journals)
+    threads = threading.active_count()
+    # When processing
+    with pytest.raises(ValueError) as error:
+        main.entity_loop(filename, "entity", output_path="out", quiet=True)
+    # Then the thread parsing periods ahead stopped with the run, though its traceback still refers to it
+    assert error.traceback
+    assert threading.active_count() == threads
+    # Then run file still written, with the error and the stages reached
+    (run_filename,) = os.listdir(tmp_path / "out" / "runs")
+    with open(tmp_path / "out" / "runs" / run_filename) as f:
+        run = json.load(f)
+    assert run["error"] == "ValueError: bad journal"
+    assert [(x["stage"], x["period"]) for x in run["stages"] if x["failed"]] == [("post", 2)]
+    assert ("validate", 1) in [(x["stage"], x["period"]) for x in run["stages"]]
+
+
+def test_prefetch():
+    # Given a build step recording the keys it has built
+    built = []
+
+    def build(key):
+        built.append(key)
+        return key * 10
+
+    # When prefetching results
+    results = main.prefetch(build, range(5), max_pending=1)
+    # Then results yielded in order
+    assert next(results) == 0
+    # Then at most max_pending results built ahead of the one being built by the thread
+    time.sleep(0.3)
+    assert len(built) <= 3
+    assert list(results) == [10, 20, 30, 40]
+    # Then same results built in turn without a thread
+    assert list(main.prefetch(build, range(5), max_pending=0)) == [0, 10, 20, 30, 40]
+
+
+def test_prefetch_error():
+    # Given a build step failing on the third key
+    def build(key):
+        if key == 2:
+            raise KeyError(key)
+        return key
+
+    # When prefetching results
+    results = main.prefetch(build, range(5))
+    # Then results before the failure yielded, then the error raised
+    assert [next(results), next(results)] == [0, 1]
+    with pytest.raises(KeyError):
+        next(results)
+
+
+def test_prefetch_close():
+    # Given results prefetched from many keys
+    threads = threading.active_count()
+    results = main.prefetch(lambda x: x, range(1000), max_pending=2)
+    assert next(results) == 0
+    # When the consumer stops early
+    results.close()
+    # Then the background thread stopped
+    assert threading.active_count() == threads
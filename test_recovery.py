@@ -0,0 +1,115 @@
+import json
+
+import recovery
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.values = []
+        return
+
+    def add(self, value: int) -> None:
+        self.values.append(value)
+        return
+
+    def save_snapshot(self, filename: str) -> None:
+        with open(filename, "w") as f:
+            json.dump(self.values, f)
+        return
+
+    def load_snapshot(self, filename: str) -> None:
+        with open(filename, "r") as f:
+            self.values = json.load(f)
+        return
+
+
+def test_recovery_manager_recover(tmp_path):
+    # Given a registered component with operations over several periods, checkpointed every 2 periods
+    manager = recovery.RecoveryManager(str(tmp_path), checkpoint_every=2)
+    counter = manager.register("counter", Counter(), ["add"])
+    for period in range(1, 4):
+        counter.add(period)
+        manager.commit_period(period)
+    # Given a crash part way through period 4
+    counter.add(4)
+    manager.close()
+    # When recovering into a new component
+    manager = recovery.RecoveryManager(str(tmp_path), checkpoint_every=2)
+    recovered = Counter()
+    counter = manager.register("counter", recovered, ["add"])
+    period = manager.recover()
+    # Then state at end of last completed period restored, incomplete period discarded
+    assert period == 3
+    assert recovered.values == [1, 2, 3]
+    # When continuing and recovering again
+    counter.add(40)
+    manager.commit_period(4)
+    manager.close()
+    manager = recovery.RecoveryManager(str(tmp_path), checkpoint_every=2)
+    recovered = Counter()
+    manager.register("counter", recovered, ["add"])
+    # Then log tail after the discarded operations replayed
+    assert manager.recover() == 4
+    assert recovered.values == [1, 2, 3, 40]
+
+
+def test_recovery_manager_recover_empty(tmp_path):
+    # Given a new state folder
+    manager = recovery.RecoveryManager(str(tmp_path))
+    counter = Counter()
+    manager.register("counter", counter, ["add"])
+    # When recovering
+    # Then nothing restored
+    assert manager.recover() == 0
+    assert counter.values == []
+
+
+def test_recovery_manager_recover_persistent(tmp_path):
+    # Given a component whose state outlives the process, like a database, recovered at the start of a run
+    manager = recovery.RecoveryManager(str(tmp_path), checkpoint_every=3)
+    persistent = Counter()
+    counter = manager.register("counter", persistent, ["add"])
+    assert manager.recover() == 0
+    # Given a crash part way through period 2, before any period end checkpoint
+    counter.add(1)
+    manager.commit_period(1)
+    counter.add(2)
+    manager.close()
+    # When recovering onto the state the crashed run left behind
+    manager = recovery.RecoveryManager(str(tmp_path), checkpoint_every=3)
+    manager.register("counter", persistent, ["add"])
+    # Then state reset to the start of the first run before the log is replayed
+    assert manager.recover() == 1
+    assert persistent.values == [1]
+
+
+def test_recovery_manager_recover_until(tmp_path):
+    # Given five completed periods with source hashes, checkpointed every 2 periods
+    manager = recovery.RecoveryManager(str(tmp_path), checkpoint_every=2)
+    counter = manager.register("counter", Counter(), ["add"])
+    for period in range(1, 6):
+        counter.add(period)
+        manager.commit_period(period, source_hash=f"hash{period}", seconds=0.5)
+    manager.close()
+    # When rewinding to the end of period 3
+    manager = recovery.RecoveryManager(str(tmp_path), checkpoint_every=2)
+    recovered = Counter()
+    counter = manager.register("counter", recovered, ["add"])
+    period = manager.recover(until=3)
+    # Then state at end of period 3 restored from the period 2 checkpoint and log
+    assert period == 3
+    assert recovered.values == [1, 2, 3]
+    # Then later checkpoints and source hashes discarded
+    assert [x.period for x in manager.list_checkpoints()] == [2]
+    assert manager.period_sources() == {x: {"source_hash": f"hash{x}", "seconds": 0.5} for x in range(1, 4)}
+    # When processing period 4 again and recovering
+    counter.add(40)
+    manager.commit_period(4, source_hash="changed")
+    manager.close()
+    manager = recovery.RecoveryManager(str(tmp_path), checkpoint_every=2)
+    recovered = Counter()
+    manager.register("counter", recovered, ["add"])
+    # Then discarded log records of periods 4 and 5 not replayed
+    assert manager.recover() == 4
+    assert recovered.values == [1, 2, 3, 40]
+    assert manager.period_sources()[4]["source_hash"] == "changed"